@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+import numpy as np
+
+class MicroBatcher(object):
+    """Collects licences from incoming frames and reads them together. A batch is sent to the
+    reader as soon as max_batch licences are waiting, or once the oldest waiting licence is
+    max_wait_ms old, so every licence is answered within about max_wait_ms plus one inference.
+
+    The letters of a licence are copied when it is submitted, so the frame and the shared
+    extraction buffers are free to be reused straight away. Results are handed to each
+    licence's callback from the batching thread. An error while reading a batch is logged and
+    passed to the errback of each of its licences, and an error in a callback is logged, so
+    neither stops the batching thread.
+
+    Attributes:
+        stats (dict): number of 'batches', 'licences', batches flushed because they were 'full'
+        or 'timeout', batches whose read 'failed', 'callback_errors' and the worst submit to
+        callback 'max_latency_ms'
+    """
+    def __init__(self, read, max_batch=4, max_wait_ms=20, letters=6, img_shape=(50, 50, 1)):
+        """
+        Args:
+            read (callable): reads a (letters * licences, h, w, 1) batch and returns one result per
+            licence, e.g. LicenceOCR.read_letters
+            max_batch (int, optional): most licences read in one call. Defaults to 4.
+            max_wait_ms (float, optional): longest a licence waits for others to join its batch. Defaults to 20.
+            letters (int, optional): letters per licence. Defaults to 6.
+            img_shape (tuple, optional): shape of each letter image. Defaults to (50, 50, 1).
+        """
+        self.read = read
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1e3
+        self.letters = letters
+        self.stats = {'batches': 0, 'licences': 0, 'full': 0, 'timeout': 0, 'failed': 0, 'callback_errors': 0,
+            'max_latency_ms': 0.0}
+        self._batch = np.zeros((max_batch * letters,) + tuple(img_shape), np.float32)
+        self._pending = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='licence-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, licence, callback, errback=None):
+        """Queues a licence to be read
+
+        Args:
+            licence (LicencePlate): licence that was found
+            callback (callable): called with the unpacked result read returns for the licence
+            errback (callable, optional): called with the exception if its batch could not be
+            read. Defaults to None.
+        """
+        self.submit_letters(licence.batch.copy(), callback, errback)
+
+    def submit_letters(self, letters, callback, errback=None):
+        """Queues the letters of one licence to be read
+
+        Args:
+            letters (numpy.ndarray): (letters, h, w, 1) letter images, not copied
+            callback (callable): called with the unpacked result read returns for the licence
+            errback (callable, optional): called with the exception if its batch could not be
+            read. Defaults to None.
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('MicroBatcher is closed')
+            self._pending.append((time.time(), letters, callback, errback))
+            self._cond.notify()
+
+    @property
+    def pending(self):
+        """int: licences waiting to be read"""
+        return len(self._pending)
+
+    def close(self):
+        """Reads everything still waiting and stops the batching thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _take(self):
+        """Waits until a batch is due and removes it from the queue, None once closed and empty"""
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            while 0 < len(self._pending) < self.max_batch and not self._closed:
+                remaining = self._pending[0][0] + self.max_wait - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if not self._pending:
+                return None
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            self.stats['full' if len(batch) == self.max_batch else 'timeout'] += 1
+            n = self.letters
+            for i, (_, letters, _, _) in enumerate(batch):
+                self._batch[i*n:(i+1)*n] = letters
+            try:
+                results = self.read(self._batch[:len(batch)*n])
+            except Exception as e:
+                logging.exception('reading a batch of {} licences failed'.format(len(batch)))
+                self.stats['failed'] += 1
+                for _, _, _, errback in batch:
+                    if errback is not None:
+                        self._call(errback, e)
+                continue
+
+            # The first licence of a batch has waited the longest
+            latency = 1e3 * (time.time() - batch[0][0])
+            for (_, _, callback, _), result in zip(batch, results):
+                self._call(callback, *result)
+            self.stats['batches'] += 1
+            self.stats['licences'] += len(batch)
+            self.stats['max_latency_ms'] = max(self.stats['max_latency_ms'], latency)
+
+    def _call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception('licence callback failed')
+            self.stats['callback_errors'] += 1
@@ -0,0 +1,814 @@
+"""Micro benchmarks for the licence pipeline.
+
+Run from the repository root, e.g.:
+
+    python -m ldriver.licence.benchmark hsv --images 'test_images/*.png'
+"""
+from __future__ import print_function
+import argparse
+import glob
+import timeit
+import cv2
+import numpy as np
+from functools import reduce
+
+from ldriver.licence import geometry, segmentation
+from ldriver.licence.hsv_config import licence_ranges
+from ldriver.licence.detection import hsv_threshold, dilate_erode, rect_contours, combine_rects, \
+    rect_components, LicencePlate, LetterExtractor, LICENCE_PTS
+
+def load_images(pattern):
+    """Loads every image matching a glob pattern
+
+    Args:
+        pattern (str): glob pattern
+
+    Returns:
+        list: (file name, numpy.ndarray) pairs in sorted file name order
+    """
+    return [(f, cv2.imread(f)) for f in sorted(glob.glob(pattern))]
+
+def time_call(func, args, repeat):
+    """Best per-call time of func(*args) in milliseconds
+
+    Args:
+        func (callable): function to be timed
+        args (tuple): arguments to func
+        repeat (int): number of calls timed
+
+    Returns:
+        float: fastest call in ms
+    """
+    return 1e3 * min(timeit.repeat(lambda: func(*args), number=1, repeat=repeat))
+
+def report(title, rows):
+    """Prints a table of (name, reference ms, new ms, extra) rows
+    """
+    print(title)
+    print('{:<24}{:>12}{:>12}{:>10}  {}'.format('image', 'before (ms)', 'after (ms)', 'speedup', ''))
+    for name, before, after, extra in rows:
+        print('{:<24}{:>12.3f}{:>12.3f}{:>9.1f}x  {}'.format(name, before, after, before / after, extra))
+
+def hsv_threshold_reference(img):
+    """hsv_threshold as it was before HSVClassifier: one cv2.inRange per range OR-ed together
+    """
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    msks = [cv2.inRange(hsv, l, u) for l, u in licence_ranges.get_ranges()]
+    return reduce((lambda x, y: cv2.bitwise_or(x, y)), msks)
+
+def bench_hsv(images, repeat):
+    rows = []
+    for f, img in images:
+        same = np.array_equal(hsv_threshold_reference(img), hsv_threshold(img))
+        rows.append((f.split('/')[-1],
+            time_call(hsv_threshold_reference, (img,), repeat),
+            time_call(hsv_threshold, (img,), repeat),
+            'identical' if same else 'MISMATCH'))
+    report('hsv_threshold: reduce of cv2.inRange vs HSVClassifier', rows)
+
+def combine_rects_reference(contours, thresh=0.3):
+    """combine_rects as it was before the geometry module: overlap by rasterising each pair
+    """
+    if len(contours)==0:
+        return contours
+    contours = np.resize(contours, (contours.shape[0],4,2))
+    size = np.max(contours)
+    black = np.zeros((size, size))
+    unique_boxes = [contours[0]]
+    for cont in contours:
+        new = True
+        for b in unique_boxes:
+            A1 = cv2.contourArea(cont)
+            b1 = cv2.fillPoly(black.copy(), pts = [cont], color =(255,255,255))
+            b2 = cv2.fillPoly(black.copy(), pts = [b], color =(255,255,255))
+            inter_area = np.count_nonzero(cv2.bitwise_and(b1, b2))
+            if inter_area / A1 > thresh:
+                new = False
+                break
+        if new:
+            unique_boxes.append(cont)
+    return np.array(unique_boxes)
+
+def bench_rects(images, repeat):
+    rows = []
+    for f, img in images:
+        conts, _ = rect_contours(dilate_erode(hsv_threshold(img)), img)
+        before, after = combine_rects_reference(conts), combine_rects(conts)
+        rows.append((f.split('/')[-1],
+            time_call(combine_rects_reference, (conts,), repeat),
+            time_call(combine_rects, (conts,), repeat),
+            '{} candidates -> {} before, {} after'.format(len(conts), len(before), len(after))))
+    report('combine_rects: raster overlap vs analytic overlap', rows)
+
+def bench_engines(images, repeat):
+    rows, found = [], {'contours': 0, 'components': 0}
+    for f, img in images:
+        thresh = dilate_erode(hsv_threshold(img))
+        extra = []
+        for engine, detector in (('contours', rect_contours), ('components', rect_components)):
+            conts, _ = detector(thresh, img)
+            valid = LicencePlate(img, engine=engine).valid
+            found[engine] += valid
+            extra.append('{}: {} rects, plate {}'.format(engine, len(combine_rects(conts)), 'yes' if valid else 'no'))
+        rows.append((f.split('/')[-1],
+            time_call(rect_contours, (thresh, img), repeat),
+            time_call(rect_components, (thresh, img), repeat),
+            ' | '.join(extra)))
+    report('rect_contours vs rect_components', rows)
+    print('valid plates found: ' + ', '.join('{} {}/{}'.format(k, v, len(images)) for k, v in sorted(found.items())))
+
+def bench_pyramid(images, repeat, scales=(2, 4)):
+    from ldriver.licence.detection import MAX_SCALES
+    from ldriver.licence.ocr import LicenceOCR
+    ocr = LicenceOCR()
+    for engine in ('contours', 'components'):
+        for scale in scales:
+            if scale > MAX_SCALES[engine]:
+                print('locate_licence ({}): 1/{} scale not supported, see MAX_SCALES'.format(engine, scale))
+                continue
+            rows = []
+            for f, img in images:
+                full = LicencePlate.locate_licence(img, engine)
+                coarse, refined = [LicencePlate.locate_licence(img, engine, scale, refine=r) for r in (False, True)]
+                if full.shape[0] and coarse.shape[0]:
+                    err = [np.abs(geometry.order_corners(full) - geometry.order_corners(pts)).max()
+                        for pts in (coarse, refined)]
+                    extra = 'corner error coarse {:.0f}px, refined {:.0f}px'.format(*err)
+                else:
+                    extra = 'found full: {}, coarse: {}'.format(bool(full.shape[0]), bool(coarse.shape[0]))
+                plates = [LicencePlate(img, engine=engine, scale=s) for s in (1, scale)]
+                extra += ', valid full: {}, refined: {}'.format(*[lp.valid for lp in plates])
+                if all(lp.found for lp in plates):
+                    extra += ', read {} / {}'.format(*[''.join(ocr.read_letters(lp.batch)[0][0]) for lp in plates])
+                coarse_ms = time_call(LicencePlate.locate_licence, (img, engine, scale, None, False), repeat)
+                rows.append((f.split('/')[-1],
+                    time_call(LicencePlate.locate_licence, (img, engine, 1), repeat),
+                    time_call(LicencePlate.locate_licence, (img, engine, scale), repeat),
+                    'coarse only {:.3f}ms, {}'.format(coarse_ms, extra)))
+            report('locate_licence ({}): full resolution vs 1/{} scale, refined'.format(engine, scale), rows)
+
+def bench_segment(images, repeat, jitter=4, trials=25):
+    # Imported here so the other benchmarks run without tensorflow
+    from ldriver.licence.ocr import LicenceOCR
+    ocr = LicenceOCR()
+    fixed = LetterExtractor(LicencePlate._lbbox)
+    segmented = LetterExtractor(LicencePlate._lbbox, rows=LicencePlate._letter_rows)
+    rng = np.random.RandomState(0)
+    rows = []
+    for f, img in images:
+        plate = LicencePlate(img, engine='components')
+        if not plate.found:
+            continue
+        segmented.stats = {'segmented': 0, 'fixed': 0}
+        segmented.extract(img, plate.M)
+        stats = dict(segmented.stats)
+        p = segmented.pad
+        profile_ms = 0.0
+        for row, (T, dsize, boxes) in zip(segmented.rows, segmented._bands):
+            band = cv2.warpPerspective(img, T.dot(plate.M), dsize)[p:-p, p:-p]
+            profile_ms += time_call(lambda b, nominal: segmentation.segment_row(segmentation.ink_mask(b), nominal),
+                (band, boxes), repeat)
+        # Reads with the licence corners moved up to jitter pixels, against the read with the located corners
+        truth = ocr.read_letters(fixed.fill(fixed.extract(img, plate.M)))[0][0]
+        corners = cv2.perspectiveTransform(LICENCE_PTS[None], np.linalg.inv(plate.M))[0]
+        correct = [0, 0]
+        for _ in range(trials):
+            noisy = corners + rng.uniform(-jitter, jitter, corners.shape).astype(np.float32)
+            M = cv2.getPerspectiveTransform(noisy, LICENCE_PTS)
+            for i, extractor in enumerate((fixed, segmented)):
+                correct[i] += ocr.read_letters(extractor.fill(extractor.extract(img, M)))[0][0] == truth
+        rows.append((f.split('/')[-1],
+            time_call(fixed.extract, (img, plate.M), repeat),
+            time_call(segmented.extract, (img, plate.M), repeat),
+            'profiles {:.3f}ms, rows segmented: {segmented}, fixed: {fixed}, read {} / {} of {} at +-{}px'.format(
+                profile_ms, correct[0], correct[1], trials, jitter, **stats)))
+    report('letter extraction: fixed boxes vs projection profile segmentation', rows)
+
+def bench_ocr_batch(images, repeat, sizes=(2, 4, 8)):
+    # Imported here so the other benchmarks run without tensorflow
+    from ldriver.licence.ocr import LicenceOCR
+    ocr = LicenceOCR()
+    plates = [p for _, img in images for p in LicencePlate.find_all(img, engine='components') if p.valid]
+    batches = [p.batch.copy() for p in plates]
+    for size in sizes:
+        batch = np.concatenate([batches[i % len(batches)] for i in range(size)])
+        single = time_call(lambda: [ocr.predict(batches[i % len(batches)]) for i in range(size)], (), repeat)
+        batched = time_call(ocr.predict, (batch,), repeat)
+        report('OCR: {} licences one at a time vs one batch (ms per licence)'.format(size),
+            [('{} licences'.format(size), single / size, batched / size,
+            '{:.0f} vs {:.0f} licences/s'.format(1e3 * size / single, 1e3 * size / batched))])
+
+def bench_ocr_engines(images, repeat):
+    from ldriver.licence.ocr import LicenceOCR
+    plates = [p for _, img in images for p in LicencePlate.find_all(img, engine='components') if p.valid]
+    batch = LicencePlate.letter_batch(plates).copy()
+    start = timeit.default_timer()
+    numpy_ocr = LicenceOCR(engine='numpy')
+    numpy_load = timeit.default_timer() - start
+    try:
+        start = timeit.default_timer()
+        keras_ocr = LicenceOCR(engine='keras')
+        keras_load = timeit.default_timer() - start
+    except ImportError:
+        print('tensorflow is not installed, numpy engine: load {:.2f}s, {} licences {:.3f}ms'.format(
+            numpy_load, len(plates), time_call(numpy_ocr.predict, (batch,), repeat)))
+        return
+    diff = np.abs(keras_ocr.predict(batch) - numpy_ocr.predict(batch)).max()
+    report('OCR inference: keras vs numpy engine', [('{} licences'.format(len(plates)),
+        time_call(keras_ocr.predict, (batch,), repeat), time_call(numpy_ocr.predict, (batch,), repeat),
+        'load {:.2f}s vs {:.2f}s, max probability difference {:.1e}'.format(keras_load, numpy_load, diff))])
+
+def bench_cascade(images, repeat, thresholds=(0.5, 0.8, 0.9, 0.95, 0.99)):
+    from ldriver.licence.ocr import LicenceOCR
+    plates = [p for _, img in images for p in LicencePlate.find_all(img, engine='components') if p.valid]
+    batch = LicencePlate.letter_batch(plates).copy()
+    ocr = LicenceOCR(engine='cascade')
+    cascade = ocr.model
+    # Accuracy is measured as agreement with the full ensemble, a threshold above 1 runs every model
+    cascade.thresholds[:] = 2
+    ensemble = cascade.predict(batch).argmax(axis=1)
+    single = cascade.nets[0].predict(batch).argmax(axis=1)
+    single_ms = time_call(cascade.nets[0].predict, (batch,), repeat)
+    rows = []
+    for thresh in thresholds:
+        cascade.thresholds[:] = thresh
+        cascade.stats = {'letters': 0, 'stage': [0] * len(cascade.nets)}
+        preds = cascade.predict(batch).argmax(axis=1)
+        stages = list(cascade.stats['stage'])
+        rows.append(('threshold {}'.format(thresh), single_ms, time_call(cascade.predict, (batch,), repeat),
+            'ensemble agreement {:.0%} (single model {:.0%}), letters per stage {}'.format(
+            np.mean(preds == ensemble), np.mean(single == ensemble), stages)))
+    report('OCR: single model vs confidence gated cascade, {} letters'.format(len(batch)), rows)
+
+def bench_student(images, repeat):
+    import os
+    from ldriver.licence.distillation import parameter_count
+    from ldriver.licence.ocr import LicenceOCR
+    try:
+        student = LicenceOCR(engine='student')
+    except (IOError, OSError) as e:
+        print('no student model, train one with python -m ldriver.licence.distillation ({})'.format(e))
+        return
+    teacher, ensemble = LicenceOCR(), LicenceOCR(engine='cascade')
+    # A threshold above 1 runs every model of the cascade, giving the full ensemble
+    ensemble.model.thresholds[:] = 2
+    rows = []
+    for f, img in images:
+        plates = [p for p in LicencePlate.find_all(img, engine='components') if p.valid]
+        if not plates:
+            continue
+        batch = LicencePlate.letter_batch(plates).copy()
+        truth = ensemble.predict(batch).argmax(axis=1)
+        rows.append((os.path.basename(f), time_call(teacher.read_letters, (batch,), repeat),
+            time_call(student.read_letters, (batch,), repeat),
+            'ensemble agreement {:.0%} vs {:.0%}, read {}'.format(
+            np.mean(teacher.predict(batch).argmax(axis=1) == truth),
+            np.mean(student.predict(batch).argmax(axis=1) == truth),
+            ' '.join(''.join(p) for p, _ in student.read_letters(batch)))))
+    report('OCR: best_letters_2 ({} params) vs distilled student ({} params), ms per frame'.format(
+        parameter_count(teacher.model), parameter_count(student.model)), rows)
+
+def nrmse_reference(a, b):
+    """skimage.measure.compare_nrmse as LicencePlate.__eq__ used it, Euclidean normalisation
+    """
+    a, b = np.float64(a), np.float64(b)
+    return np.sqrt(np.mean((a - b) ** 2)) / np.sqrt(np.mean(a * a))
+
+def bench_identity(images, repeat, shifts=(0, 2, 4), index_sizes=(100, 1000, 10000)):
+    from ldriver.licence.identity import PlateIndex, hamming
+    plates, names = [], []
+    for f, img in images:
+        for s in shifts:
+            moved = cv2.warpAffine(img, np.float32([[1, 0, s], [0, 1, s]]), (img.shape[1], img.shape[0]))
+            found = [p for p in LicencePlate.find_all(moved, engine='components') if p.valid]
+            plates += found[:1]
+            names += ['{}+{}'.format(f.split('/')[-1][:-4], s)] * len(found[:1])
+    a, b = plates[0], plates[-1]
+    rows = [('equality, fresh plates',
+        time_call(lambda: nrmse_reference(LicencePlate.from_transform(a.frame, a.M).img, b.img)
+            < 0.17, (), repeat),
+        time_call(lambda: LicencePlate.from_transform(a.frame, a.M) == b, (), repeat), 'hash computed once per plate'),
+        ('equality, memoised', time_call(lambda: nrmse_reference(a.img, b.img) < 0.17, (), repeat),
+        time_call(lambda: a == b, (), repeat), '')]
+    # Unrelated random hashes stand in for every other plate of a long run
+    rng = np.random.RandomState(0)
+    for size in index_sizes:
+        index = PlateIndex()
+        noise = rng.randint(0, 256, (size, a.hash.size)).astype(np.uint8)
+        for i, h in enumerate(noise):
+            index.add(h, -1 - i)
+        for i, p in enumerate(plates):
+            index.add(p.hash, i)
+        hashes = np.concatenate([noise, np.array([p.hash for p in plates])])
+        same = index.nearest(b.hash)[0] == np.argmin(hamming(hashes, b.hash)) - size
+        rows.append(('nearest in {}'.format(len(index)),
+            time_call(lambda: np.argmin(hamming(hashes, b.hash)), (), repeat),
+            time_call(index.nearest, (b.hash,), repeat), 'same plate' if same else 'MISMATCH'))
+    report('plate identity: NRMSE of warped licences vs perceptual hash '
+        '(byte table scan vs uint64 popcount for lookups)', rows)
+    print('same plate (nrmse < 0.17 / hash distance <= {}):'.format(LicencePlate._compare_bits))
+    for i, p in enumerate(plates):
+        print('{:<14} {}'.format(names[i], ' '.join('{}/{:<3}'.format(
+            'Y' if nrmse_reference(p.img, q.img) < 0.17 else 'n', ('Y' if p == q else 'n') + str(hamming(p.hash, q.hash)))
+            for q in plates)))
+
+def bench_pipeline(images, repeat, fps=60, seconds=4, configs=((0, 2), (2, 2))):
+    import collections
+    import threading
+    import time
+    from ldriver.licence.ocr import LicenceOCR
+    from ldriver.licence.pipeline import DetectionPipeline
+    ocr = LicenceOCR()
+    frames = [img for _, img in images]
+    n = int(fps * seconds)
+
+    def camera(put):
+        # Frames arrive at the camera rate whatever the consumer is doing
+        start = timeit.default_timer()
+        for i in range(n):
+            put(frames[i % len(frames)])
+            time.sleep(max(0, start + (i + 1) / float(fps) - timeit.default_timer()))
+
+    def read(plates):
+        if plates:
+            ocr.read_letters(LicencePlate.letter_batch(plates))
+
+    # Before: every message is handled in arrival order by the subscriber thread
+    backlog, ages, done = collections.deque(), [], threading.Event()
+    def subscriber():
+        while not done.is_set() or backlog:
+            if not backlog:
+                time.sleep(0.001)
+                continue
+            stamp, img = backlog.popleft()
+            read([lp for lp in LicencePlate.find_all(img, engine='components') if lp.valid])
+            ages.append(1e3 * (time.time() - stamp))
+    worker = threading.Thread(target=subscriber)
+    worker.start()
+    camera(lambda img: backlog.append((time.time(), img)))
+    left = len(backlog)
+    done.set()
+    worker.join()
+    print('{} frames at {} fps'.format(n, fps))
+    print('{:<26} handled {:>4}, dropped {:>4}, age mean {:>7.1f}ms, max {:>7.1f}ms, backlog at end {}'.format(
+        'subscriber thread', len(ages), 0, np.mean(ages), max(ages), left))
+
+    for processes, maxlen in configs:
+        ages = []
+        pipeline = DetectionPipeline(lambda seq, stamp, img, plates: (read(plates),
+            ages.append(1e3 * (time.time() - stamp))), processes=processes, maxlen=maxlen)
+        camera(pipeline.put)
+        depth = pipeline.depth
+        pipeline.close()
+        print('{:<26} handled {:>4}, dropped {:>4}, age mean {:>7.1f}ms, max {:>7.1f}ms, queue at end {}'.format(
+            'pipeline, {} processes'.format(processes), len(ages), pipeline.frames.stats['dropped'],
+            np.mean(ages), max(ages), depth))
+
+def merge_reference(best, preds, conf):
+    """LicenceDetector.record as it was before PlateFusion: per letter, the most confident
+    reading so far wins
+
+    Returns:
+        tuple: merged (preds, conf), or best unchanged
+        bool: the reading changed, which was published
+    """
+    if best is None:
+        return (preds, conf), True
+    if np.all(conf < best[1]) or preds == best[0]:
+        return best, False
+    return ([l if c > c_old else l_old for l, l_old, c, c_old in zip(preds, best[0], conf, best[1])],
+        np.maximum(best[1], conf)), True
+
+def bench_fusion(images, repeat, frames=12, trials=50, glitch=0.15, corner_noise=3.0):
+    from ldriver.licence.fusion import PlateFusion
+    from ldriver.licence.ocr import LicenceOCR, ALL_LETTERS
+    ocr = LicenceOCR()
+    rng = np.random.RandomState(0)
+    for f, img in images:
+        plate = LicencePlate(img, engine='components')
+        if not plate.valid:
+            continue
+        truth = ocr.read_letters(plate.batch)[0][0]
+        corners = cv2.perspectiveTransform(LICENCE_PTS[None], np.linalg.inv(plate.M))[0]
+        old_ok = new_ok = old_pub = frame_ok = 0
+        used, old_ms, new_ms = [], 0.0, 0.0
+        for trial in range(trials):
+            # The plate seen from slightly different places, with the odd overconfident misread
+            readings = []
+            for i in range(frames):
+                noisy = corners + rng.uniform(-corner_noise, corner_noise, corners.shape).astype(np.float32)
+                M = cv2.getPerspectiveTransform(noisy, LICENCE_PTS)
+                probs = ocr.read_probs(LicencePlate.from_transform(img, M).batch)[0]
+                if rng.rand() < glitch:
+                    pos = rng.randint(2, 6)
+                    wrong = rng.choice(np.flatnonzero(ocr.position_masks[pos] &
+                        (np.arange(len(ALL_LETTERS)) != probs[pos].argmax())))
+                    probs[pos] = 1e-4
+                    probs[pos, wrong] = 1 - 1e-4 * (len(ALL_LETTERS) - 1)
+                readings.append(probs)
+                frame_ok += [ALL_LETTERS[i] for i in probs.argmax(axis=1)] == truth
+            start = timeit.default_timer()
+            best = None
+            for probs in readings:
+                best, changed = merge_reference(best, [ALL_LETTERS[i] for i in probs.argmax(axis=1)],
+                    probs.max(axis=1))
+                old_pub += changed
+            old_ms += timeit.default_timer() - start
+            old_ok += best[0] == truth
+            start = timeit.default_timer()
+            fusion = PlateFusion(ALL_LETTERS)
+            for n, probs in enumerate(readings, 1):
+                if fusion.update(probs)[1]:
+                    break
+            else:
+                fusion.flush()
+            new_ms += timeit.default_timer() - start
+            used.append(n)
+            new_ok += fusion.committed[truth[1]] == truth if truth[1] in fusion.committed else 0
+        print('{:<16} truth {}, single frames {:.0%} correct  max confidence: {:.0%} correct, {:.1f} publishes, '
+            '{:.3f}ms per plate | fusion: {:.0%} correct, 1 publish after {:.1f} frames (max {}), {:.3f}ms per plate'.format(
+            f.split('/')[-1], ''.join(truth), frame_ok / float(trials * frames), old_ok / float(trials), old_pub / float(trials),
+            1e3 * old_ms / trials, new_ok / float(trials), np.mean(used), max(used), 1e3 * new_ms / trials))
+    print('{} frames per plate, {:.0%} of frames have one letter misread with 0.999 confidence'.format(frames, glitch))
+
+def bench_registry(images, repeat, frames_per_plate=30, shift=4):
+    import time
+    from ldriver.licence.fusion import PlateFusion
+    from ldriver.licence.identity import PlateIndex
+    from ldriver.licence.ocr import LicenceOCR, ALL_LETTERS
+    from ldriver.licence.pipeline import detect_plates, _init_worker
+    cpu_time = getattr(time, 'process_time', getattr(time, 'clock', None))
+    ocr = LicenceOCR()
+    # One lap drives past every plate, seeing it from slowly changing positions
+    rng = np.random.RandomState(0)
+    lap = [cv2.warpAffine(img, np.float32([[1, 0, dx], [0, 1, dy]]), (img.shape[1], img.shape[0]))
+        for _, img in images for dx, dy in rng.randint(-shift, shift + 1, (frames_per_plate, 2))]
+
+    def drive(use_registry):
+        _init_worker(True)
+        fusion, registry = PlateFusion(ALL_LETTERS), PlateIndex()
+        skipped = read = 0
+        start = cpu_time()
+        for frame in lap:
+            known = registry.words(), registry.max_distance
+            plates, _ = detect_plates(frame, 'components', *(known if use_registry else ()))
+            for lp in plates:
+                if use_registry and registry.nearest(lp.hash)[0] is not None:
+                    skipped += 1
+                    continue
+                read += 1
+                pid, _ = fusion.update(ocr.read_probs(lp.batch)[0])
+                if pid in fusion.committed and registry.nearest(lp.hash)[1] is None:
+                    registry.add(lp.hash, pid)
+        return 1e3 * (cpu_time() - start), read, skipped, sorted(''.join(v) for v in fusion.committed.values())
+
+    before, read_before, _, plates_before = drive(False)
+    after, read_after, skipped, plates_after = drive(True)
+    report('one lap of {} frames: read every plate vs skip committed plates (CPU ms per lap)'.format(len(lap)),
+        [('lap', before, after, 'OCR on {} vs {} plates, {} skipped ({:.0%} CPU saved), committed {} / {}'.format(
+            read_before, read_after, skipped, 1 - after / before, plates_before, plates_after))])
+
+def remove_plates(img):
+    """
+    Args:
+        img (numpy.ndarray): camera frame
+
+    Returns:
+        numpy.ndarray: a copy of the frame with every pixel near plate coloured ones blacked out
+    """
+    frame = img.copy()
+    frame[cv2.dilate(hsv_threshold(img), np.ones((15, 15), np.uint8)) > 0] = 0
+    return frame
+
+def bench_quality(images, repeat, frames=16, trials=10, smear=0.3, start_scale=0.75, fps=30):
+    import time
+    from ldriver.licence.detection import measure_blur
+    from ldriver.licence.fusion import PlateFusion
+    from ldriver.licence.ocr import LicenceOCR, ALL_LETTERS
+    from ldriver.licence.pipeline import DetectionPipeline
+    from ldriver.licence.quality import QualityGate, plate_blur, plate_quality
+    cpu_time = getattr(time, 'process_time', getattr(time, 'clock', None))
+    ocr = LicenceOCR()
+    rng = np.random.RandomState(0)
+    rows, plates = [], []
+    for f, img in images:
+        plate = LicencePlate(img, engine='components')
+        if plate.valid:
+            plates.append((f, img, ocr.read_letters(plate.batch)[0][0]))
+            rows.append((f.split('/')[-1], time_call(measure_blur, (img,), repeat),
+                time_call(lambda: plate_quality(plate.M, plate_blur(img, plate.M)), (), repeat),
+                'quality {:.2f}'.format(plate.quality)))
+    report('plate blur: Laplacian of the frame vs quality score from the warped letters', rows)
+
+    def approach(img):
+        # The plate grows from start_scale to full size, some frames are smeared by a turn
+        h, w = img.shape[:2]
+        seq = []
+        for s in np.linspace(start_scale, 1.0, frames):
+            frame = cv2.warpAffine(img, cv2.getRotationMatrix2D((w / 2.0, h / 2.0), 0, s), (w, h),
+                borderMode=cv2.BORDER_REPLICATE)
+            if rng.rand() < smear:
+                frame = cv2.filter2D(frame, -1, np.ones((1, 9), np.float32) / 9)
+            seq.append(frame)
+        return seq
+
+    def drive(views, gate):
+        fusion, calls = PlateFusion(ALL_LETTERS), 0
+        for lp, probs in views:
+            if fusion.committed or (gate is not None and not gate.admit(lp.quality)):
+                continue
+            calls += 1
+            fusion.update(probs)
+        fusion.flush()
+        return calls, fusion.committed
+
+    print('{} frames approaching each plate from {:.0%} of its size, {:.0%} smeared, {} trials'.format(
+        frames, start_scale, smear, trials))
+    for f, img, truth in plates:
+        seen, every, gated = 0, [0, 0, 0], [0, 0, 0]
+        for _ in range(trials):
+            views = [(lp, ocr.read_probs(lp.batch)[0]) for frame in approach(img)
+                for lp in LicencePlate.find_all(frame, engine='components') if lp.valid]
+            seen += len(views)
+            for gate, result in ((None, every), (QualityGate(), gated)):
+                n, committed = drive(views, gate)
+                result[0] += n
+                result[1] += committed.get(truth[1]) == truth
+                result[2] += sum(letters != truth for letters in committed.values())
+        print('{:<16} {:>5.1f} plate views | '.format(f.split('/')[-1], seen / float(trials)) + ' | '.join(
+            '{}: {:>4.1f} OCR calls, {:>4.0%} correct, {:>3.1f} wrong plates'.format(name, *(v / float(trials) for v in result))
+            for name, result in (('every view', every), ('quality gate', gated))))
+
+    # Stretches of track without a plate
+    empty = [remove_plates(img) for _, img, _ in plates]
+    lap = [empty[i % len(empty)] for i in range(3 * fps)] + [img for _, img, _ in plates for _ in range(fps // 2)] + \
+        [empty[i % len(empty)] for i in range(3 * fps)]
+    for stride in (1, 3):
+        seen = []
+        pipeline = DetectionPipeline(lambda seq, stamp, frame, found: seen.append(len(found)), processes=0,
+            idle_stride=stride)
+        start, cpu = timeit.default_timer(), cpu_time()
+        for i, frame in enumerate(lap):
+            pipeline.put(frame)
+            time.sleep(max(0, start + (i + 1) / float(fps) - timeit.default_timer()))
+        pipeline.close()
+        print('idle stride {}: {} frames at {} fps, {} detected, {} skipped, {} dropped, {} with plates, '
+            'CPU {:.0f}ms'.format(stride, len(lap), fps, pipeline.stats['detected'], pipeline.stats['skipped'],
+            pipeline.frames.stats['dropped'], sum(n > 0 for n in seen), 1e3 * (cpu_time() - cpu)))
+
+def track_lap(rate, speed=0.5, size=(4.0, 3.0)):
+    """Poses of a robot driving once counter-clockwise around a rectangular track
+
+    Args:
+        rate (float): poses per second
+        speed (float, optional): in m/s. Defaults to 0.5.
+        size (tuple, optional): (w, h) of the track in m. Defaults to (4.0, 3.0).
+
+    Returns:
+        numpy.ndarray: (N, 3) x, y and heading of each pose
+    """
+    w, h = size
+    corners = np.float64([[0, 0], [w, 0], [w, h], [0, h], [0, 0]])
+    poses = []
+    for a, b in zip(corners[:-1], corners[1:]):
+        n = int(np.hypot(*(b - a)) / speed * rate)
+        heading = np.arctan2(*(b - a)[::-1])
+        poses.extend([(x, y, heading) for x, y in a + np.linspace(0, 1, n, endpoint=False)[:, None] * (b - a)])
+    return np.float64(poses)
+
+def bench_plate_map(images, repeat, fps=30, record_rate=10, sight=1.5, odom_noise=(0.02, 1.0), strides=(3, 10),
+        frame_timeout=5.0):
+    import time
+    from ldriver.licence.plate_map import build_map, wrap_angle, CAMERA_FOV
+    from ldriver.licence.pipeline import DetectionPipeline
+    cpu_time = getattr(time, 'process_time', getattr(time, 'clock', None))
+    rng = np.random.RandomState(0)
+    frames = [img for _, img in images if LicencePlate(img, engine='components').valid]
+    empty = [remove_plates(img) for img in frames]
+    # Plates stand 0.6m to the left of the road, facing it, along the straights
+    lap = track_lap(fps)
+    plates = []
+    for x, y, heading in track_lap(2.0)[[6, 13, 22, 36, 50]]:
+        left = np.float64([-np.sin(heading), np.cos(heading)])
+        plates.append((np.float64([x, y]) + 0.6 * left, -left))
+    codes = rng.randint(0, 256, (len(plates), 8)).astype(np.uint8)
+
+    def visible(pose):
+        # Plates within sight, in the camera field of view and facing the robot
+        found = []
+        for i, (pt, normal) in enumerate(plates):
+            d = pose[:2] - pt
+            if np.hypot(*d) <= sight and d.dot(normal) > 0 and \
+                    abs(wrap_angle(np.arctan2(-d[1], -d[0]) - pose[2])) <= CAMERA_FOV / 2:
+                found.append(i)
+        return found
+
+    def odometry(pose):
+        return pose + np.append(rng.normal(0, odom_noise[0], 2), np.radians(rng.normal(0, odom_noise[1])))
+
+    # Offline: a recorded lap gives each visible plate's bearing, its hash gets noisier with distance
+    views = []
+    for pose in track_lap(record_rate):
+        odom = odometry(pose)
+        for i in visible(pose):
+            d = plates[i][0] - pose[:2]
+            h = codes[i].copy()
+            for bit in rng.choice(64, int(3 * np.hypot(*d) / sight), replace=False):
+                h[bit // 8] ^= 1 << (bit % 8)
+            views.append((odom[0], odom[1], np.arctan2(d[1], d[0]) + np.radians(rng.normal(0, 1.0)), h))
+    start = timeit.default_timer()
+    plate_map = build_map(views)
+    build_ms = 1e3 * (timeit.default_timer() - start)
+    errors = [min(np.hypot(*(pt - (p['x'], p['y']))) for p in plate_map.plates) for pt, _ in plates]
+    print('map of {} plates built from {} views in {:.1f}ms, location error mean {:.2f}m, max {:.2f}m'.format(
+        len(plate_map), len(views), build_ms, np.mean(errors), max(errors)))
+
+    truth = [visible(pose) for pose in lap]
+    odoms = [odometry(pose) for pose in lap]
+    print('lookup: {:.4f}ms per pose, {:.1f} plates checked of {}'.format(
+        time_call(lambda: [plate_map.in_view(*o) for o in odoms], (), 3) / len(odoms),
+        plate_map.stats['checked'] / float(max(plate_map.stats['lookups'], 1)), len(plate_map)))
+    missed = sum(1 for o, t in zip(odoms, truth) if t and not plate_map.in_view(*o))
+    print('{} of {} lap frames have a plate in view, the map expects one in {} frames and misses {}'.format(
+        sum(1 for t in truth if t), len(lap), sum(1 for o in odoms if plate_map.in_view(*o)), missed))
+
+    configs = (('every frame', None, 1, 1), ('idle stride', None, strides[0], 1),
+        ('plate map', plate_map, strides[0], strides[1]))
+    for name, gate_map, idle_stride, background_stride in configs:
+        current, seen = [None], {}
+        # Without tracking, the frames of different plates follow each other with no transition
+        pipeline = DetectionPipeline(lambda seq, stamp, frame, found: seen.__setitem__(seq, len(found)), processes=0,
+            track=False, idle_stride=idle_stride, background_stride=background_stride,
+            expected=(lambda: bool(gate_map.in_view(*current[0]))) if gate_map is not None else None)
+        cpu = cpu_time()
+        for i, (odom, t) in enumerate(zip(odoms, truth)):
+            current[0] = odom
+            pipeline.put(frames[t[0] % len(frames)] if t else empty[i % len(empty)])
+            # Every frame is waited for, so none is dropped and runs are comparable. A failed frame
+            # counts as done, and a frame that never finishes stops the benchmark
+            deadline = time.time() + frame_timeout
+            while pipeline.stats['detected'] + pipeline.stats['skipped'] + pipeline.stats['failed'] <= i:
+                if time.time() > deadline:
+                    pipeline.close()
+                    raise RuntimeError('{}: frame {} not detected after {}s'.format(name, i, frame_timeout))
+                time.sleep(0.0002)
+        cpu = 1e3 * (cpu_time() - cpu)
+        pipeline.close()
+        found = set(t[0] for i, t in enumerate(truth) if t and seen.get(i))
+        print('{:<12} {:>5} frames detected, {:>5} skipped, {} failed, CPU {:>6.0f}ms, frames with a plate detected {}/{}, '
+            'plates found {}/{}'.format(name, pipeline.stats['detected'], pipeline.stats['skipped'], pipeline.stats['failed'], cpu,
+            sum(1 for i, t in enumerate(truth) if t and seen.get(i)), sum(1 for t in truth if t), len(found), len(plates)))
+
+STARTUP_SCRIPT = """
+import timeit
+start = timeit.default_timer()
+from ldriver.licence.detection import LicencePlate
+from ldriver.licence.ocr import LicenceOCR
+imported = timeit.default_timer()
+ocr = LicenceOCR(engine='{}')
+loaded = timeit.default_timer()
+ocr.warm_up()
+first = timeit.default_timer()
+ocr.warm_up()
+print(imported - start, loaded - imported, first - loaded, timeit.default_timer() - first)
+"""
+
+def bench_startup(images, repeat, engines=('numpy', 'keras')):
+    # Each measurement runs in a fresh interpreter so imports are cold
+    import subprocess
+    import sys
+    for engine in engines:
+        try:
+            out = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT.format(engine)],
+                stderr=subprocess.STDOUT).decode().strip().split('\n')[-1]
+        except subprocess.CalledProcessError as e:
+            print('{}: failed to start, {}'.format(engine, e.output.decode().strip().split('\n')[-1]))
+            continue
+        times = [1e3 * float(t) for t in out.split()]
+        print('{:<8} import {:.0f}ms, model load {:.0f}ms, first inference {:.1f}ms, second {:.1f}ms'.format(
+            engine, *times))
+
+def bench_cache(images, repeat, shifts=(-1.5, -1.0, -0.5, 0.0, 0.5, 1.0, 1.5)):
+    from ldriver.licence.ocr import LicenceOCR
+    plain, cached = LicenceOCR(), LicenceOCR(cache_size=256)
+    rows = []
+    for f, img in images:
+        plate = LicencePlate(img, engine='components')
+        if not plate.valid:
+            continue
+        # A parked robot sees the plate again with the corners moved by up to a pixel or so
+        frames = [LicencePlate.from_transform(img, np.float64([[1, 0, dx], [0, 1, dy], [0, 0, 1]]).dot(plate.M))
+            for dx in shifts for dy in shifts]
+        batches = [p.batch.copy() for p in frames]
+        cached.model.clear()
+        cached.model.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        changed = sum(int(np.count_nonzero(plain.predict(b).argmax(axis=1) != cached.predict(b).argmax(axis=1)))
+            for b in batches)
+        stats = dict(cached.model.stats)
+        rows.append((f.split('/')[-1],
+            time_call(lambda: [plain.predict(b) for b in batches], (), repeat) / len(batches),
+            time_call(lambda: [cached.predict(b) for b in batches], (), repeat) / len(batches),
+            'first pass hits {hits}, misses {misses}, letters changed {changed} of {total}'.format(
+                changed=changed, total=6 * len(batches), **stats)))
+    report('OCR per frame: no cache vs hash cache (distance {}), plate shifted by {} px in x and y'.format(
+        cached.model.max_distance, list(shifts)), rows)
+    print('not used by licence_detection.py: PlateFusion would count every hit as a new reading')
+
+# Post-hoc remapping LicenceOCR.decode used before position constrained decoding
+DIG2ALPHA = {
+    '1': 'T',
+    '2': 'Z',
+    '3': 'E',
+    '4': 'A',
+    '5': 'S',
+    '6': 'G',
+    '7': 'Z',
+    '8': 'B',
+    '9': 'P',
+    '0': 'C',
+}
+ALPHA2DIG = {
+    'A': '4',
+    'B': '8',
+    'C': '6',
+    'D': '0',
+    'E': '3',
+    'F': '7',
+    'G': '6',
+    'H': '8',
+    'I': '1',
+    'J': '7',
+    'K': '4',
+    'L': '1',
+    'M': '4',
+    'N': '4',
+    'O': '0',
+    'P': '9',
+    'Q': '0',
+    'R': '9',
+    'S': '5',
+    'T': '1',
+    'U': '0',
+    'V': '4',
+    'W': '1',
+    'X': '4',
+    'Y': '4',
+    'Z': '2',
+}
+
+def decode_reference(preds_oh):
+    from ldriver.licence.ocr import ALL_LETTERS
+    preds = [ALL_LETTERS[np.argmax(p)] for p in preds_oh]
+    conf = np.array([np.max(p) for p in preds_oh])
+    preds[1] = ALPHA2DIG.get(preds[1], preds[1])
+    preds[2], preds[3] = DIG2ALPHA.get(preds[2], preds[2]), DIG2ALPHA.get(preds[3], preds[3])
+    preds[4], preds[5] = ALPHA2DIG.get(preds[4], preds[4]), ALPHA2DIG.get(preds[5], preds[5])
+    return preds, conf
+
+def bench_decode(images, repeat):
+    from ldriver.licence.ocr import LicenceOCR
+    ocr = LicenceOCR()
+    rows = []
+    for f, img in images:
+        plates = [p for p in LicencePlate.find_all(img, engine='components') if p.valid]
+        if not plates:
+            continue
+        probs = ocr.predict(LicencePlate.letter_batch(plates))
+        n = len(plates[0].letters)
+        old = [decode_reference(probs[i:i+n]) for i in range(0, probs.shape[0], n)]
+        new = [ocr.decode(probs[i:i+n]) for i in range(0, probs.shape[0], n)]
+        rows.append((f.split('/')[-1],
+            time_call(lambda: [decode_reference(probs[i:i+n]) for i in range(0, probs.shape[0], n)], (), repeat),
+            time_call(lambda: [ocr.decode(probs[i:i+n]) for i in range(0, probs.shape[0], n)], (), repeat),
+            ', '.join('{} -> {} (min conf {:.2f} -> {:.2f})'.format(''.join(o[0]), ''.join(c[0]), o[1].min(), c[1].min())
+                for o, c in zip(old, new))))
+    report('licence decoding: argmax and remapping vs position constrained', rows)
+
+BENCHMARKS = {
+    'hsv': bench_hsv,
+    'rects': bench_rects,
+    'engines': bench_engines,
+    'pyramid': bench_pyramid,
+    'segment': bench_segment,
+    'ocr_batch': bench_ocr_batch,
+    'ocr_engines': bench_ocr_engines,
+    'cascade': bench_cascade,
+    'student': bench_student,
+    'identity': bench_identity,
+    'pipeline': bench_pipeline,
+    'fusion': bench_fusion,
+    'registry': bench_registry,
+    'quality': bench_quality,
+    'plate_map': bench_plate_map,
+    'startup': bench_startup,
+    'cache': bench_cache,
+    'decode': bench_decode,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark stages of the licence pipeline')
+    parser.add_argument('bench', choices=sorted(BENCHMARKS))
+    parser.add_argument('--images', default='test_images/*.png', help='glob of camera frames')
+    parser.add_argument('--repeat', type=int, default=50, help='timed calls per measurement')
+    args = parser.parse_args()
+    BENCHMARKS[args.bench](load_images(args.images), args.repeat)
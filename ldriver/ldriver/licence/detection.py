@@ -1,13 +1,12 @@
 import cv2
-from skimage.measure import compare_nrmse
-import imutils
 import numpy as np
-from operator import itemgetter
 
 from hsv_config import licence_ranges
-from functools import reduce
 import logging
 import ldriver.data.licence
+from ldriver.licence import geometry, segmentation
+from ldriver.licence.identity import plate_hash, hamming
+from ldriver.licence.quality import plate_blur, plate_quality
 from importlib_resources import files
 
 def hsv_threshold(img):
@@ -19,12 +18,7 @@ def hsv_threshold(img):
     Returns:
         numpy.ndarray: thresholded image
     """
-    out_img = img.copy()
-    hsv = cv2.cvtColor(out_img, cv2.COLOR_BGR2HSV)
-    cv2.medianBlur(hsv,5)
-    msks = [cv2.inRange(hsv, l, u) for l, u in licence_ranges.get_ranges()]
-    out_img = reduce((lambda x, y: cv2.bitwise_or(x,y)), msks)
-    return out_img
+    return licence_ranges.classifier(img)
 
 def rect_contours(img, orig_img=None, min_area=800):
     """ Finds large rectangular contours. 
@@ -43,8 +37,9 @@ def rect_contours(img, orig_img=None, min_area=800):
     # Grab largest contours in reverse area order
     edged = cv2.Canny(img.copy(), 30, 200) 
     contours = cv2.findContours(edged.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    contours = imutils.grab_contours(contours)
-    contours = sorted(contours, key=cv2.contourArea, reverse = True)[:5] # 5 largest
+    # OpenCV 3 returns (image, contours, hierarchy), 2 and 4 return (contours, hierarchy)
+    contours = contours[-2]
+    contours = sorted(contours, key=cv2.contourArea, reverse = True)[:10] # 10 largest, room for two plates with inner and outer edges
 
     # Approximate rectangular contours
     def approx_rect(c):
@@ -62,30 +57,67 @@ def rect_contours(img, orig_img=None, min_area=800):
 
     return best_conts, out_img
 
+def rect_components(img, orig_img=None, min_area=800, min_fill=0.5, aspect_range=(0.5, 8.0)):
+    """ Finds large rectangular blobs from connected component statistics. Alternative to
+    rect_contours that skips edge detection and contour hierarchies.
+
+    Args:
+        img (numpy.ndarray): binary image that rectangles will be detected in
+        orig_img (numpy.ndarray): original, unaltered version that found rectangles will be drawn on
+        min_area (int): all rectangles that have a smaller area will be filtered out
+        min_fill (float): minimum fraction of the bounding box covered by the component
+        aspect_range (tuple): (min, max) bounding box width / height
+
+    Returns:
+        numpy.ndarray: Rectangles detected (Opencv2 style contours)
+        numpy.ndarray: orig_img with rectangles drawn on (Red)
+    """
+    out_img = orig_img.copy() if orig_img is not None else img.copy()
+
+    # 16 bit labels are enough after dilate_erode and label about twice as fast
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(img, connectivity=8, ltype=cv2.CV_16U)
+    x, y, w, h, area = stats[1:].T
+    aspect = w / np.maximum(h, 1).astype(np.float64)
+    candidates = 1 + np.flatnonzero(
+        (w*h > min_area) & (area >= min_fill*w*h) &
+        (aspect >= aspect_range[0]) & (aspect <= aspect_range[1]))
+
+    # Corners are the extreme pixels along both diagonals of each component
+    quads = np.zeros((candidates.size, 4, 2), np.int32)
+    for i, c in enumerate(candidates):
+        cx, cy, cw, ch = stats[c, :4]
+        ys, xs = np.nonzero(labels[cy:cy+ch, cx:cx+cw] == c)
+        diag, anti = xs + ys, xs - ys
+        idx = np.array([np.argmin(diag), np.argmax(anti), np.argmax(diag), np.argmin(anti)])
+        quads[i] = np.stack((xs[idx] + cx, ys[idx] + cy), axis=-1)
+
+    areas = np.abs(geometry.polygon_area(quads.astype(np.float64)))
+    order = np.argsort(-areas, kind='mergesort')
+    order = order[areas[order] > min_area][:6] # 6 largest, room for three plates
+    best_conts = quads[order].reshape(-1, 4, 1, 2)
+    cv2.drawContours(out_img, list(best_conts), -1, (0, 0, 255), 3)
+
+    return best_conts, out_img
+
+RECT_ENGINES = {
+    'contours': rect_contours,
+    'components': rect_components,
+}
+
 def combine_rects(contours, thresh=0.3):
+    """Removes duplicate rectangles: a rectangle is dropped when more than thresh of its area
+    overlaps a larger rectangle that was kept
+
+    Args:
+        contours (numpy.ndarray): Opencv2 style rectangular contours, largest first
+        thresh (float, optional): overlap ratio above which a rectangle is a duplicate. Defaults to 0.3.
+
+    Returns:
+        numpy.ndarray: unique contours
+    """
     if len(contours)==0:
         return contours
-    contours = np.resize(contours, (contours.shape[0],4,2))
-    size = np.max(contours)
-    black = np.zeros((size, size))
-    unique_boxes = [contours[0]]
-    for cont in contours:
-        new = True
-        for b in unique_boxes:
-            A1, A2= cv2.contourArea(cont), cv2.contourArea(b)
-
-            b1 = cv2.fillPoly(black.copy(), pts = [cont], color =(255,255,255))
-            b2 = cv2.fillPoly(black.copy(), pts = [b], color =(255,255,255))
-
-            intersection = cv2.bitwise_and(b1, b2)
-            inter_area = np.count_nonzero(intersection)
-
-            if inter_area / A1 > thresh:
-                new = False
-                break
-        if new:
-            unique_boxes.append(cont)
-    return np.array(unique_boxes)
+    return contours[geometry.combine_rects(geometry.as_quads(contours), thresh)]
 
 def combine_plate(contours, orig_img=None):
     """Combine the two rectangles that represents the parts of a licence plate
@@ -102,16 +134,11 @@ def combine_plate(contours, orig_img=None):
     # 
     rect_pts = np.array([])
     if contours.shape[0] >= 2:
-        all_pts = contours.reshape(-1, contours.shape[-1]) if contours.size else contours
-        N = all_pts.shape[0]
-
-        x_sort = sorted(all_pts, key=itemgetter(0))
-        left_pts, right_pts = x_sort[:N/2], x_sort[-(N/2):]
-        left_pts_y, right_pts_y = sorted(left_pts, key=itemgetter(1)), sorted(right_pts, key=itemgetter(1))
-        best = left_pts_y[0], left_pts_y[-1], right_pts_y[0], right_pts_y[-1] 
-        rect_pts = np.int32(best)
-        line_pts = rect_pts.reshape((-1, 1, 2))
-        cv2.polylines(orig_img, line_pts, True, (0, 255 ,0), 3)
+        all_pts = contours.reshape(1, -1, contours.shape[-1])
+        rect_pts = np.int32(geometry.merge_plate(all_pts)[0])
+        if out_img is not None:
+            line_pts = rect_pts.reshape((-1, 1, 2))
+            cv2.polylines(out_img, line_pts, True, (0, 255 ,0), 3)
 
     return rect_pts, out_img
 
@@ -124,18 +151,13 @@ def sort_rect_pts(pts):
     Returns:
         numpy.float32: list of ordered points
     """
-
     # This only works if the right two points and the left two points never cross axes
-    # sort by x
-    x_sort = sorted(pts, key=itemgetter(0))
-    left_pts, right_pts = x_sort[:2], x_sort[-2:]
+    return np.float32(geometry.order_corners(np.reshape(pts, (4, 2))))
     
-    # sort by y
-    left_pts, right_pts = sorted(left_pts, key=itemgetter(1)), sorted(right_pts, key=itemgetter(1))
+LICENCE_SIZE = (300,300)
+LICENCE_PTS = np.float32([[0,0],[300,0],[0,300],[300,300]])
 
-    return np.float32(left_pts+right_pts)
-    
-def warp_rect(img, in_pts, out_pts=np.float32([[0,0],[300,0],[0,300],[300,300]]), size=(300,300)):
+def warp_rect(img, in_pts, out_pts=LICENCE_PTS, size=LICENCE_SIZE):
     """ Using rectangular corner coordinates, warps the shape specified by in_pts in img to a new image
         of size size specified by out_pts
 
@@ -149,32 +171,320 @@ def warp_rect(img, in_pts, out_pts=np.float32([[0,0],[300,0],[0,300],[300,300]])
     Returns:
         numpy.ndarray: output image.
     """
-    # To match all points by sorting cartesianly
-    inpts, outpts = sort_rect_pts(in_pts), sort_rect_pts(out_pts)
     # Compute the perspective transform M
-    M = cv2.getPerspectiveTransform(inpts, outpts)
+    M = plate_transform(in_pts, out_pts)
 
     # Apply the perspective transformation to the image
     dest = cv2.warpPerspective(img,M,size)
     return dest
 
-def dilate_erode(img):
+def plate_transform(in_pts, out_pts=LICENCE_PTS):
+    """ Perspective transform that maps the rectangle corners in_pts onto out_pts
+
+    Args:
+        in_pts (numpy.float32): 4 corner points in the original image
+        out_pts (numpy.float32, optional): 4 corner points to map to. Defaults to LICENCE_PTS.
+
+    Returns:
+        numpy.ndarray: 3x3 perspective transform
+    """
+    # To match all points by sorting cartesianly
+    return cv2.getPerspectiveTransform(sort_rect_pts(in_pts), sort_rect_pts(out_pts))
+
+class LetterExtractor(object):
+    """Extracts the binarised letters of a licence straight from the camera frame. Each letter box
+    is warped on its own through the licence transform, padded by half the adaptive threshold
+    block so thresholding it gives the same pixels as thresholding the whole licence, and then
+    resized into a preallocated OCR input batch.
+
+    When rows are given, each row of letters is warped as one band instead and the letters are
+    located in it from projection profiles (see segmentation.segment_row). The fixed boxes are
+    moved onto the located characters, or used as they are when the profiles are ambiguous.
+
+    Attributes:
+        batch (numpy.ndarray): (N, h, w, 1) float32 OCR input, overwritten by every extract call
+        stats (dict): number of rows that were 'segmented' and that used the 'fixed' boxes
+    """
+    def __init__(self, boxes, size=(50,50), block_size=15, C=2, rows=None, margin=10, licence_size=LICENCE_SIZE):
+        """
+        Args:
+            boxes (iterable): letter bbox locations [x1, x2, y1, y2] in the warped licence
+            size (tuple, optional): size of each letter in the batch. Defaults to (50,50).
+            block_size (int, optional): adaptive threshold block size. Defaults to 15.
+            C (int, optional): adaptive threshold constant. Defaults to 2.
+            rows (iterable, optional): tuples of the box indices on each row of letters, the
+            letters are segmented when given. Defaults to None.
+            margin (int, optional): pixels around each row's boxes searched for letters. Defaults to 10.
+            licence_size (tuple, optional): size of the warped licence. Defaults to LICENCE_SIZE.
+        """
+        self.size = size
+        self.block_size = block_size
+        self.C = C
+        self.pad = block_size // 2
+        self.boxes = np.int32(boxes)
+        self.rows = rows
+        self.stats = {'segmented': 0, 'fixed': 0}
+        # Translation from licence to padded letter coordinates and the padded letter size
+        self._crops = [(np.float64([[1, 0, self.pad-x1], [0, 1, self.pad-y1], [0, 0, 1]]),
+            (x2-x1+2*self.pad, y2-y1+2*self.pad)) for x1,x2,y1,y2 in boxes]
+        if rows is not None:
+            # Each row is cropped as the union of its boxes grown by margin, with boxes relative to it
+            self._bands = []
+            for row in rows:
+                b = self.boxes[list(row)]
+                x1, y1 = max(b[:, 0].min() - margin, 0), max(b[:, 2].min() - margin, 0)
+                x2, y2 = min(b[:, 1].max() + margin, licence_size[0]), min(b[:, 3].max() + margin, licence_size[1])
+                self._bands.append((np.float64([[1, 0, self.pad-x1], [0, 1, self.pad-y1], [0, 0, 1]]),
+                    (x2-x1+2*self.pad, y2-y1+2*self.pad), b - [x1, x1, y1, y1]))
+        self.batch = np.zeros((len(self._crops), size[1], size[0], 1), np.float32)
+        self._resized = np.zeros((size[1], size[0]), np.uint8)
+        self._many = self.batch.copy()
+
+    def extract(self, img, M, indices=None):
+        """
+        Args:
+            img (numpy.ndarray): camera frame
+            M (numpy.ndarray): perspective transform from img to the warped licence
+            indices (iterable, optional): letters to extract. Defaults to all of them.
+
+        Returns:
+            tuple: binarised letter images at licence resolution
+        """
+        if self.rows is not None:
+            return self._extract_rows(img, M, indices)
+        letters = []
+        p = self.pad
+        crops = self._crops if indices is None else [self._crops[i] for i in indices]
+        for T, dsize in crops:
+            crop = cv2.warpPerspective(img, T.dot(M), dsize)
+            gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+            letters.append(cv2.adaptiveThreshold(gray,255,cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY_INV,
+                self.block_size,self.C)[p:-p, p:-p])
+        return tuple(letters)
+
+    def _extract_rows(self, img, M, indices=None):
+        letters = [None] * len(self.boxes)
+        wanted = range(len(self.boxes)) if indices is None else indices
+        p = self.pad
+        for row, (T, dsize, boxes) in zip(self.rows, self._bands):
+            if not any(i in row for i in wanted):
+                continue
+            band = cv2.warpPerspective(img, T.dot(M), dsize)
+            gray = cv2.cvtColor(band, cv2.COLOR_BGR2GRAY)
+            bi = cv2.adaptiveThreshold(gray,255,cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY_INV,
+                self.block_size,self.C)[p:-p, p:-p]
+            glyphs = segmentation.segment_row(segmentation.ink_mask(band[p:-p, p:-p]), boxes)
+            if glyphs is not None and segmentation.matches_boxes(glyphs, boxes):
+                boxes = segmentation.centre_boxes(glyphs, boxes, bi.shape)
+                self.stats['segmented'] += 1
+            else:
+                self.stats['fixed'] += 1
+            for i, (x1, x2, y1, y2) in zip(row, boxes):
+                letters[i] = bi[y1:y2, x1:x2]
+        return tuple(letters[i] for i in wanted)
+
+    def fill(self, letters):
+        """
+        Args:
+            letters (tuple): letter images from extract
+
+        Returns:
+            numpy.ndarray: the batch buffer filled with the resized letters
+        """
+        return self._fill(letters, self.batch)
+
+    def fill_many(self, letter_sets):
+        """
+        Args:
+            letter_sets (iterable): letter tuples from extract, one per plate
+
+        Returns:
+            numpy.ndarray: (N * plates, h, w, 1) batch of every plate's letters in order, a view
+            of a buffer that is reused by the next call
+        """
+        letters = [l for letter_set in letter_sets for l in letter_set]
+        if self._many.shape[0] < len(letters):
+            self._many = np.zeros((len(letters),) + self.batch.shape[1:], np.float32)
+        return self._fill(letters, self._many[:len(letters)])
+
+    def _fill(self, letters, batch):
+        for i, letter in enumerate(letters):
+            cv2.resize(letter, self.size, dst=self._resized)
+            batch[i, ..., 0] = self._resized
+        return batch
+
+def scaled_kernel(size, scale=1):
+    """Square morphology kernel shrunk for an image downscaled by scale
+
+    Args:
+        size (int): kernel size at full resolution
+        scale (int, optional): downscale factor of the image. Defaults to 1.
+
+    Returns:
+        numpy.ndarray: kernel of size max(1, round(size/scale))
+    """
+    k = max(1, int(size / float(scale) + 0.5))
+    return np.ones((k,k), np.uint8)
+
+def dilate_erode(img, scale=1):
     """ Denoise salt and pepper noise in an image through dilation and erosion
 
     Args:
         img (numpy.ndarray): binary image matrix
+        scale (int, optional): downscale factor of img relative to the camera frame. Defaults to 1.
 
     Returns:
         numpy.ndarray: denoised binary image
     """
-    kernel5 = np.ones((5,5), np.uint8)
-    kernel3 = np.ones((3,3), np.uint8)
+    kernel5 = scaled_kernel(5, scale)
+    kernel3 = scaled_kernel(3, scale)
     img = cv2.dilate(img, kernel5, iterations=1)
     img = cv2.erode(img, kernel5, iterations=1)
-    img = cv2.erode(img, kernel3, iterations=2)
+    # An even kernel (3 at 1/2 scale) only erodes the top and left edges from its centre anchor,
+    # the second pass erodes the bottom and right ones so the plate does not shift
+    img = cv2.erode(img, kernel3)
+    img = cv2.erode(img, kernel3, anchor=(0, 0) if kernel3.shape[0] % 2 == 0 else (-1, -1))
     img = cv2.dilate(img, kernel5, iterations=2)
     return img
 
+def plate_aspect(pts):
+    """ Width over height of a plate quadrilateral, using the mean length of opposite sides
+
+    Args:
+        pts (numpy.ndarray): 4 corner points
+
+    Returns:
+        float: aspect ratio
+    """
+    tl, bl, tr, br = geometry.order_corners(np.float64(pts).reshape(4, 2))
+    width = np.hypot(*(tr - tl)) + np.hypot(*(br - bl))
+    height = np.hypot(*(bl - tl)) + np.hypot(*(br - tr))
+    return width / max(height, 1e-6)
+
+# Largest downscale factor each rectangle detector still finds plates at. At 1/4 scale the
+# contours of a plate are too coarse for approxPolyDP to see four corners.
+MAX_SCALES = {
+    'contours': 2,
+    'components': 4,
+}
+
+def locate_plates(img, engine='contours', scale=1, stats=None, aspect_range=(0.3, 2.0)):
+    """ Finds the corners of every licence plate in an image. With scale > 1 the search runs on img
+    downscaled by scale, with morphology kernels and the minimum rectangle area scaled to match,
+    and the corners are mapped back to img, so they are only as precise as the downscaled pixels.
+
+    The rectangles of each plate are paired by adjacency (geometry.pair_rects). When no pair is
+    found all rectangles are merged into a single plate.
+
+    The search is a cascade that stops at the first failing stage, cheapest first: too few
+    thresholded pixels ('mask'), fewer than two rectangles ('candidates') and no plate with a
+    plausible shape ('aspect').
+
+    Args:
+        img (numpy.ndarray): input image matrix
+        engine (str, optional): rectangle detector, a key of RECT_ENGINES. Defaults to 'contours'.
+        scale (int, optional): downscale factor, at most MAX_SCALES[engine]. Defaults to 1.
+        stats (dict, optional): counts of rejections per stage, updated in place. Defaults to None.
+        aspect_range (tuple, optional): (min, max) plate width / height. Defaults to (0.3, 2.0).
+
+    Returns:
+        numpy.ndarray: (P, 4, 2) plate corners in img coordinates, largest plate first
+    """
+    if scale > MAX_SCALES[engine]:
+        raise ValueError('the {} engine finds no plates below 1/{} scale, got 1/{}'.format(
+            engine, MAX_SCALES[engine], scale))
+
+    def reject(stage):
+        if stats is not None:
+            stats[stage] += 1
+        return np.zeros((0, 4, 2), np.int32)
+
+    small = img
+    if scale > 1:
+        small = cv2.resize(img, None, fx=1.0/scale, fy=1.0/scale, interpolation=cv2.INTER_AREA)
+    min_area = 800.0/scale**2
+    thresh = hsv_threshold(small)
+    # Two plate rectangles are at least half filled
+    if cv2.countNonZero(thresh) < min_area:
+        return reject('mask')
+
+    thresh = dilate_erode(thresh, scale)
+    conts, _ = RECT_ENGINES[engine](thresh, small, min_area=min_area)
+    conts = combine_rects(conts)
+    if len(conts) < 2:
+        return reject('candidates')
+
+    if scale > 1:
+        # Map back to the centre of each downscaled pixel's full resolution block
+        conts = conts * scale + scale // 2
+    quads = geometry.as_quads(conts)
+    pairs = geometry.pair_rects(quads)
+    if pairs.shape[0]:
+        plates = geometry.merge_plate(quads[pairs].reshape(-1, 8, 2))
+    else:
+        plates = geometry.merge_plate(quads.reshape(1, -1, 2))
+    plates = np.int32(plates)
+
+    aspect = np.array([plate_aspect(pts) for pts in plates])
+    plates = plates[(aspect >= aspect_range[0]) & (aspect <= aspect_range[1])]
+    if not plates.shape[0]:
+        return reject('aspect')
+    area = np.abs(geometry.polygon_area(geometry.orient_convex(plates)))
+    return plates[np.argsort(-area, kind='mergesort')]
+
+def locate_plate(img, engine='contours', scale=1, stats=None):
+    """ Finds the corners of the largest licence plate, see locate_plates
+
+    Returns:
+        numpy.ndarray: plate corners in img coordinates, empty array if not found
+    """
+    plates = locate_plates(img, engine, scale, stats)
+    return plates[0] if plates.shape[0] else np.array([])
+
+def padded_roi(pts, shape, pad):
+    """ Bounding box of pts grown by pad on every side and clipped to an image
+
+    Args:
+        pts (numpy.ndarray): (x,y) points
+        shape (tuple): image shape
+        pad (int): pixels added on each side
+
+    Returns:
+        tuple: x0, y0, x1, y1
+    """
+    x, y, w, h = cv2.boundingRect(np.int32(pts).reshape(-1, 1, 2))
+    return max(x - pad, 0), max(y - pad, 0), min(x + w + pad, shape[1]), min(y + h + pad, shape[0])
+
+# Direction each corner of geometry.order_corners lies in from the plate centre
+_CORNER_DIRS = np.int32([[-1, -1], [-1, 1], [1, -1], [1, 1]])
+
+def refine_corners(img, pts, scale):
+    """ Moves plate corners found at a downscaled resolution onto the full resolution mask. Only
+    the plate's bounding box is thresholded and denoised, and each corner becomes the extreme mask
+    pixel along its diagonal in a window of 4 downscaled pixels around it, the corner rect_components
+    finds at full resolution.
+
+    Args:
+        img (numpy.ndarray): full resolution image
+        pts (numpy.ndarray): (4, 2) plate corners mapped back from the downscaled image
+        scale (int): downscale factor the corners were found at
+
+    Returns:
+        numpy.ndarray: (4, 2) refined corners, ordered as geometry.order_corners
+    """
+    pts = np.int32(geometry.order_corners(np.reshape(pts, (4, 2))))
+    pad = 4 * scale
+    x0, y0, x1, y1 = padded_roi(pts, img.shape, 2 * pad)
+    mask = dilate_erode(hsv_threshold(img[y0:y1, x0:x1]))
+    refined = pts.copy()
+    for i, ((x, y), (dx, dy)) in enumerate(zip(pts - [x0, y0], _CORNER_DIRS)):
+        wx, wy = max(x - pad, 0), max(y - pad, 0)
+        ys, xs = np.nonzero(mask[wy:y + pad + 1, wx:x + pad + 1])
+        if xs.size:
+            j = np.argmax(xs * dx + ys * dy)
+            refined[i] = xs[j] + wx + x0, ys[j] + wy + y0
+    return refined
+
 def measure_blur(img):
     """Measures the blurriness of an image using the variation of the Laplacian inspired by
     Pech-Pacheco et al. 2000 (optica.csic.es/papers/icpr2k.pdf)
@@ -199,66 +509,288 @@ class LicencePlate(object):
     ) #list of bbox locations [x1, x2, y1, y2]
     _parking_template = cv2.imread(str(files(ldriver.data.licence).joinpath('P.png')), cv2.IMREAD_UNCHANGED)
     _match_threshold = 0.15
+    # Zero mean template and its norm for the normalised correlation in check_valid
+    _template = np.float32(_parking_template) - np.mean(_parking_template)
+    _template_norm = np.linalg.norm(_template)
+    # Frames seen and frames rejected at each stage of the detection cascade, then every plate
+    # located in them rejected by the P template or accepted
+    cascade_stats = {'frames': 0, 'mask': 0, 'candidates': 0, 'aspect': 0, 'template': 0, 'accepted': 0}
 
-    def __init__(self, img, grayscale=False, binary=False):
-        self.valid = False
-        found, licence_img = self.find_licence(img)
-
-        if found:
-            #Image Preproccesing
-            gray = cv2.cvtColor(licence_img, cv2.COLOR_BGR2GRAY)
-            bi = cv2.adaptiveThreshold(gray,255,cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY_INV,15,2)
-            self.letters = tuple([bi[y1:y2,x1:x2] for x1,x2,y1,y2 in self._lbbox])
-            self.valid = self.check_valid(self.letters[0])
-
-            if grayscale:
-                licence_img = gray
-            elif binary:
-                licence_img = bi
-            self.img = licence_img
+    # Box indices of each row of letters. The letters are segmented in each row so the boxes
+    # follow the characters when the licence corners are a few pixels off
+    _letter_rows = ((0, 1), (2, 3, 4, 5))
+    _letter_extractor = LetterExtractor(_lbbox, rows=_letter_rows)
+
+    __slots__ = ('frame', 'M', 'grayscale', 'binary', '_letters', '_valid', '_img', '_blur', '_hash', '_quality')
+
+    def __init__(self, img, grayscale=False, binary=False, engine='contours', scale=1, tracker=None):
+        """Locates a licence in img. Everything derived from it (letters, validity, licence image,
+        blur, hash, quality) is computed on first access and memoised.
+
+        Args:
+            img (numpy.ndarray): camera frame
+            grayscale (bool, optional): img is the grayscale licence. Defaults to False.
+            binary (bool, optional): img is the binarised licence. Defaults to False.
+            engine (str, optional): rectangle detector, a key of RECT_ENGINES. Defaults to 'contours'.
+            scale (int, optional): pyramid downscale factor used to locate the licence. Defaults to 1.
+            tracker (PlateTracker, optional): tracker used to locate the licence instead. Defaults to None.
+        """
+        M = None
+        self.cascade_stats['frames'] += 1
+        if tracker is not None:
+            corners, transforms = tracker.locate_all(img, self.cascade_stats)
+            M = transforms[0] if transforms else None
         else:
-            self.img = img
+            pts = self.locate_licence(img, engine, scale, self.cascade_stats)
+            M = plate_transform(pts) if pts.shape[0] else None
+        if M is None:
+            print('no licence')
+        self._setup(img, M, grayscale, binary)
+        if self.found:
+            self._count_valid()
+
+    @classmethod
+    def from_transform(cls, img, M, letters=None, blur=None, grayscale=False, binary=False):
+        """Builds a plate from already computed intermediates without running detection
 
-        self.blur = measure_blur(img)
+        Args:
+            img (numpy.ndarray): camera frame
+            M (numpy.ndarray): perspective transform from img to the licence, None if not found
+            letters (tuple, optional): binarised letters, extracted lazily if None. Defaults to None.
+            blur (float, optional): sharpness of the licence, measured lazily if None. Defaults to None.
+            grayscale (bool, optional): img is the grayscale licence. Defaults to False.
+            binary (bool, optional): img is the binarised licence. Defaults to False.
+
+        Returns:
+            LicencePlate: the plate
+        """
+        lp = cls.__new__(cls)
+        lp._setup(img, M, grayscale, binary)
+        lp._letters, lp._blur = letters, blur
+        return lp
+
+    def _setup(self, img, M, grayscale, binary):
+        self.frame = img
+        self.M = M
+        self.grayscale = grayscale
+        self.binary = binary
+        self._letters = self._valid = self._img = self._blur = self._hash = self._quality = None
+
+    @property
+    def found(self):
+        return self.M is not None
+
+    @property
+    def letters(self):
+        """tuple: binarised letter images, None if no licence was found"""
+        if self._letters is None and self.found:
+            self._letters = self._letter_extractor.extract(self.frame, self.M)
+        return self._letters
+
+    @property
+    def batch(self):
+        """numpy.ndarray: (6, 50, 50, 1) OCR input. The buffer is shared by all plates and is
+        refilled on every access, so it must be used before another plate's batch is read."""
+        return self._letter_extractor.fill(self.letters) if self.found else None
+
+    @property
+    def valid(self):
+        """bool: a licence was found and its first letter is a P. Only the P is extracted for
+        the check if the letters have not been extracted yet."""
+        if self._valid is None:
+            self._valid = False
+            if self.found:
+                first = self._letters[0] if self._letters is not None \
+                    else self._letter_extractor.extract(self.frame, self.M, (0,))[0]
+                self._valid = bool(self.check_valid(first))
+        return self._valid
+
+    def _count_valid(self):
+        # The template stage of the cascade runs on every located plate, so its counts cover the
+        # same plates whichever callers read valid afterwards
+        self.cascade_stats['accepted' if self.valid else 'template'] += 1
+
+    @property
+    def img(self):
+        """numpy.ndarray: the warped licence (the camera frame if none was found)"""
+        if self._img is None:
+            if not self.found:
+                self._img = self.frame
+            else:
+                licence_img = cv2.warpPerspective(self.frame, self.M, LICENCE_SIZE)
+                if self.grayscale or self.binary:
+                    licence_img = cv2.cvtColor(licence_img, cv2.COLOR_BGR2GRAY)
+                if self.binary:
+                    licence_img = cv2.adaptiveThreshold(licence_img,255,cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY_INV,15,2)
+                self._img = licence_img
+        return self._img
+
+    @property
+    def blur(self):
+        """float: sharpness of the licence letters, see quality.plate_blur, or of the whole camera
+        frame if no licence was found, see measure_blur"""
+        if self._blur is None:
+            self._blur = plate_blur(self.frame, self.M) if self.found else measure_blur(self.frame)
+        return self._blur
+
+    @property
+    def hash(self):
+        """numpy.ndarray: perceptual hash of the licence letters, see identity.plate_hash, None if
+        no licence was found"""
+        if self._hash is None and self.found:
+            self._hash = plate_hash(self.frame, self.M)
+        return self._hash
+
+    @property
+    def quality(self):
+        """float: how readable the licence is likely to be, see quality.plate_quality, 0 if no
+        licence was found"""
+        if self._quality is None:
+            self._quality = plate_quality(self.M, self.blur) if self.found else 0.0
+        return self._quality
+
+    def detach(self, letters=True):
+        """Computes every field derived from the camera frame, then drops the frame so a plate
+        that is kept around only holds licence sized images
+
+        Args:
+            letters (bool, optional): also extract the letters, they can not be extracted once the
+            frame is dropped. Defaults to True.
+        """
+        if letters:
+            self.letters
+        self.valid, self.img, self.blur, self.hash, self.quality
+        if self.found:
+            self.frame = None
 
     def __bool__(self):
         return self.valid
 
+    # Slots are not pickled by default with Python 2, detached plates are sent between processes
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
     @classmethod
     def check_valid(cls, img):
-        img = cv2.resize(img, cls._parking_template.shape[:2])
-        res = cv2.matchTemplate(img,cls._parking_template,cv2.TM_CCOEFF_NORMED)
-        return np.max(res) > cls._match_threshold
+        # Same as cv2.matchTemplate TM_CCOEFF_NORMED for an image the size of the template
+        img = np.float32(cv2.resize(img, cls._parking_template.shape[:2]))
+        img -= img.mean()
+        norm = np.linalg.norm(img) * cls._template_norm
+        return norm > 0 and np.vdot(img, cls._template) / norm > cls._match_threshold
+
+    @classmethod
+    def letter_batch(cls, plates):
+        """Stacks the OCR input of several plates so they can be read in one inference call
+
+        Args:
+            plates (list): LicencePlates that were found
+
+        Returns:
+            numpy.ndarray: (6 * len(plates), 50, 50, 1) batch, reused by the next call
+        """
+        return cls._letter_extractor.fill_many([lp.letters for lp in plates])
+
+    @classmethod
+    def reset_stats(cls):
+        """Zeroes cascade_stats"""
+        for k in cls.cascade_stats:
+            cls.cascade_stats[k] = 0
     
-    @staticmethod
-    def find_licence(image):
+    @classmethod
+    def locate_licences(cls, image, engine='contours', scale=1, stats=None, refine=True):
+        """Find the corners of every licence in an image. With scale > 1 the licences are located
+        on a downscaled image and the rescaled corners are, unless refine is False, moved onto the
+        full resolution mask around each plate (see refine_corners).
+
+        Args:
+            image (numpy.ndarray): input image matrix
+            engine (str, optional): rectangle detector, a key of RECT_ENGINES. Defaults to 'contours'.
+            scale (int, optional): pyramid downscale factor, at most MAX_SCALES[engine]. Defaults to 1.
+            stats (dict, optional): rejections per stage, see locate_plates. Defaults to None.
+            refine (bool, optional): refine the rescaled corners. Defaults to True.
+
+        Returns:
+            numpy.ndarray: (P, 4, 2) licence corners in image coordinates, largest first
+        """
+        plates = locate_plates(image, engine, scale, stats)
+        if scale > 1 and refine:
+            for i, pts in enumerate(plates):
+                plates[i] = refine_corners(image, pts, scale)
+        return plates
+
+    @classmethod
+    def locate_licence(cls, image, engine='contours', scale=1, stats=None, refine=True):
+        """Find the corners of the largest licence in an image, see locate_licences
+
+        Returns:
+            numpy.ndarray: licence corners in image coordinates, empty array if not found.
+        """
+        plates = cls.locate_licences(image, engine, scale, stats, refine)
+        return plates[0] if plates.shape[0] else np.array([])
+
+    @classmethod
+    def find_all(cls, img, grayscale=False, binary=False, engine='contours', scale=1, tracker=None):
+        """Builds a LicencePlate for every licence in a camera frame
+
+        Args:
+            img (numpy.ndarray): camera frame
+            tracker (PlateTracker, optional): tracker used to locate the licences. Defaults to None.
+            Other arguments are the same as for LicencePlate.
+
+        Returns:
+            list: LicencePlate for each licence found, largest first, already checked against
+            the P template
+        """
+        cls.cascade_stats['frames'] += 1
+        if tracker is not None:
+            plates = [cls.from_transform(img, M, grayscale=grayscale, binary=binary)
+                for M in tracker.locate_all(img, cls.cascade_stats)[1]]
+        else:
+            plates = [cls.from_transform(img, plate_transform(pts), grayscale=grayscale, binary=binary)
+                for pts in cls.locate_licences(img, engine, scale, cls.cascade_stats)]
+        for lp in plates:
+            lp._count_valid()
+        if not plates:
+            print('no licence')
+        return plates
+
+    @classmethod
+    def find_licence(cls, image, engine='contours', scale=1):
         """Find licence from image
 
         Args:
             image (numpy.ndarray): input image matrix
+            engine (str, optional): rectangle detector, a key of RECT_ENGINES. Defaults to 'contours'.
+            scale (int, optional): pyramid downscale factor used to locate the licence, it is
+            always warped from the full resolution image. Defaults to 1.
 
         Returns:
             numpy.ndarray: extracted licence image if found, empty array if not.
         """
-        orig_img = image.copy()
         detected, new_img = False, None
-        thresh = hsv_threshold(orig_img)
-        thresh = dilate_erode(thresh)
-        conts, img = rect_contours(thresh, orig_img)
-        # conts = combine_rects(conts)
-        pts, img = combine_plate(conts, img)
+        pts = cls.locate_licence(image, engine, scale)
         if pts.shape[0]:
-            new_img = warp_rect(orig_img, pts)
+            new_img = warp_rect(image, pts)
             detected = True
         else:
             print('no licence')
         return detected, new_img
     
-    _compare_thresh = 0.17
+    # Largest Hamming distance between the hashes of two views of the same plate
+    _compare_bits = 6
     def __eq__(self, other):
-        diff = compare_nrmse(self.img, other.img)
-        logging.debug('similarity: {}'.format(diff))
-        return diff < self._compare_thresh
+        if not (self.found and other.found):
+            return False
+        diff = hamming(self.hash, other.hash)
+        logging.debug('hash distance: {}'.format(diff))
+        return diff <= self._compare_bits
+
+    def __ne__(self, other):
+        return not self == other
 
 if __name__ == '__main__':
     logging.getLogger("").setLevel(logging.DEBUG)
@@ -0,0 +1,347 @@
+"""Distillation of a compact letter model from the best_letters_* teachers.
+
+Trains a small CNN in NumPy on CPU (no tensorflow needed) to match the averaged, temperature
+softened outputs of the teachers on augmented letter crops, from the plate_data/ folder written
+by letter_collector.py or from licences found in camera frames. The student is saved as a Keras
+style .h5 file so LicenceOCR loads it like any other model, e.g.:
+
+    python -m ldriver.licence.distillation --data plate_data --epochs 30
+    LicenceOCR(model='student_letters.h5')
+"""
+from __future__ import print_function
+import argparse
+import json
+import timeit
+import cv2
+import numpy as np
+from importlib_resources import files
+
+import ldriver.data.models
+from ldriver.licence.inference import LetterNet, conv2d, max_pool
+from ldriver.licence.quantization import load_crops, load_frame_letters
+
+STUDENT_MODEL = 'student_letters.h5'
+TEACHER_MODELS = ('best_letters_1.h5', 'best_letters_2.h5', 'best_letters_3.h5')
+
+def student_layers(filters=(8, 16, 16, 16), classes=36, img_shape=(50, 50, 1), seed=0):
+    """Randomly initialised layers of a student network: 3x3 convolutions each followed by 2x2
+    max pooling, then one softmax Dense layer. The defaults give about 6.5k parameters.
+
+    Args:
+        filters (tuple, optional): filters of each convolution. Defaults to (8, 16, 16, 16).
+        classes (int, optional): number of classes. Defaults to 36.
+        img_shape (tuple, optional): input letter shape. Defaults to (50, 50, 1).
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        list: (kind, config, weights) layers, see LetterNet
+    """
+    rng = np.random.RandomState(seed)
+    layers, (h, w, c) = [], img_shape
+    for i, f in enumerate(filters):
+        # He initialisation for ReLU layers
+        kernel = np.float32(rng.randn(3, 3, c, f) * np.sqrt(2.0 / (9 * c)))
+        layers.append(('Conv2D', {'name': 'conv2d_{}'.format(i), 'filters': f, 'kernel_size': [3, 3],
+            'strides': [1, 1], 'padding': 'valid', 'activation': 'relu', 'use_bias': True,
+            'dilation_rate': [1, 1], 'data_format': 'channels_last'}, (kernel, np.zeros(f, np.float32))))
+        layers.append(('MaxPooling2D', {'name': 'max_pooling2d_{}'.format(i), 'pool_size': [2, 2],
+            'strides': [2, 2], 'padding': 'valid', 'data_format': 'channels_last'}, None))
+        h, w, c = (h - 2) // 2, (w - 2) // 2, f
+    layers.append(('Flatten', {'name': 'flatten', 'data_format': 'channels_last'}, None))
+    kernel = np.float32(rng.randn(h * w * c, classes) * np.sqrt(1.0 / (h * w * c)))
+    layers.append(('Dense', {'name': 'dense', 'units': classes, 'activation': 'softmax', 'use_bias': True},
+        (kernel, np.zeros(classes, np.float32))))
+    return layers
+
+def forward(layers, x):
+    """Forward pass that keeps what backward needs
+
+    Args:
+        layers (list): (kind, config, weights) layers
+        x (numpy.ndarray): (N, h, w, 1) letters
+
+    Returns:
+        numpy.ndarray: (N, classes) logits of the last layer, before its softmax
+        list: cached values of each layer
+    """
+    cache = []
+    for i, (kind, conf, params) in enumerate(layers):
+        last = i == len(layers) - 1
+        if kind == 'Conv2D':
+            cache.append(x)
+            x = np.maximum(conv2d(x, *params), 0)
+        elif kind == 'MaxPooling2D':
+            cache.append(x)
+            x = max_pool(x, conf['pool_size'])
+        elif kind == 'Flatten':
+            cache.append(x.shape)
+            x = x.reshape(x.shape[0], -1)
+        else:
+            cache.append(x)
+            x = x.dot(params[0]) + params[1]
+            if not last:
+                x = np.maximum(x, 0)
+        # ReLU outputs are kept to mask their gradient
+        cache[-1] = (cache[-1], x if kind in ('Conv2D', 'Dense') and not last else None)
+    return x, cache
+
+def _conv_backward(x, kernel, dout):
+    n, h, w, c = x.shape
+    kh, kw, _, f = kernel.shape
+    oh, ow = h - kh + 1, w - kw + 1
+    sn, sh, sw, sc = x.strides
+    cols = np.lib.stride_tricks.as_strided(x, (n, oh, ow, kh, kw, c), (sn, sh, sw, sh, sw, sc))
+    cols = cols.reshape(-1, kh * kw * c)
+    dout = dout.reshape(-1, f)
+    dkernel = cols.T.dot(dout).reshape(kernel.shape)
+    dcols = dout.dot(kernel.reshape(-1, f).T).reshape(n, oh, ow, kh, kw, c)
+    dx = np.zeros_like(x)
+    for i in range(kh):
+        for j in range(kw):
+            dx[:, i:i+oh, j:j+ow] += dcols[:, :, :, i, j]
+    return dx, dkernel, dout.sum(axis=0)
+
+def _pool_backward(x, size, dout):
+    ph, pw = size
+    oh, ow = dout.shape[1], dout.shape[2]
+    # Route each gradient to the first maximum of its window
+    windows = np.stack([x[:, i:oh*ph:ph, j:ow*pw:pw] for i in range(ph) for j in range(pw)], axis=-1)
+    first = windows.argmax(axis=-1)
+    dx = np.zeros_like(x)
+    for k in range(ph * pw):
+        dx[:, k // pw:oh*ph:ph, k % pw:ow*pw:pw] = np.where(first == k, dout, 0)
+    return dx
+
+def backward(layers, cache, dlogits):
+    """
+    Args:
+        layers (list): (kind, config, weights) layers
+        cache (list): cache from forward
+        dlogits (numpy.ndarray): gradient of the loss with respect to the logits
+
+    Returns:
+        dict: (dkernel, dbias) of each weighted layer, by layer index
+    """
+    grads, d = {}, dlogits
+    for i in reversed(range(len(layers))):
+        kind, conf, params = layers[i]
+        x, relu_out = cache[i]
+        if relu_out is not None:
+            d = d * (relu_out > 0)
+        if kind == 'Dense':
+            grads[i] = (x.T.dot(d), d.sum(axis=0))
+            d = d.dot(params[0].T)
+        elif kind == 'Flatten':
+            d = d.reshape(x)
+        elif kind == 'MaxPooling2D':
+            d = _pool_backward(x, conf['pool_size'], d)
+        else:
+            d, dkernel, dbias = _conv_backward(x, params[0], d)
+            grads[i] = (dkernel, dbias)
+    return grads
+
+class Adam(object):
+    """Adam optimiser updating the weights of layers in place"""
+    def __init__(self, layers, lr=3e-3, beta1=0.9, beta2=0.999, eps=1e-8):
+        self.layers = layers
+        self.lr, self.beta1, self.beta2, self.eps = lr, beta1, beta2, eps
+        self.t = 0
+        self.m = dict((i, [np.zeros_like(p) for p in params]) for i, (_, _, params) in enumerate(layers)
+            if params is not None)
+        self.v = dict((i, [np.zeros_like(p) for p in ps]) for i, ps in self.m.items())
+
+    def step(self, grads):
+        self.t += 1
+        lr = self.lr * np.sqrt(1 - self.beta2 ** self.t) / (1 - self.beta1 ** self.t)
+        for i, layer_grads in grads.items():
+            for p, g, m, v in zip(self.layers[i][2], layer_grads, self.m[i], self.v[i]):
+                m *= self.beta1
+                m += (1 - self.beta1) * g
+                v *= self.beta2
+                v += (1 - self.beta2) * g * g
+                p -= np.float32(lr) * m / (np.sqrt(v) + self.eps)
+
+def augment(batch, rng, max_angle=8, max_shift=3, scale_range=(0.9, 1.1)):
+    """Random small affine distortions and stroke width changes of binary letters
+
+    Args:
+        batch (numpy.ndarray): (N, h, w, 1) letters
+        rng (numpy.random.RandomState): random source
+        max_angle (float, optional): largest rotation in degrees. Defaults to 8.
+        max_shift (float, optional): largest shift in pixels. Defaults to 3.
+        scale_range (tuple, optional): (min, max) scale. Defaults to (0.9, 1.1).
+
+    Returns:
+        numpy.ndarray: distorted letters, same shape
+    """
+    n, h, w, _ = batch.shape
+    out = np.empty_like(batch)
+    kernel = np.ones((2, 2), np.uint8)
+    for i in range(n):
+        M = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), rng.uniform(-max_angle, max_angle),
+            rng.uniform(*scale_range))
+        M[:, 2] += rng.uniform(-max_shift, max_shift, 2)
+        letter = cv2.warpAffine(np.uint8(batch[i, ..., 0]), M, (w, h))
+        _, letter = cv2.threshold(letter, 127, 255, cv2.THRESH_BINARY)
+        stroke = rng.randint(3)
+        if stroke == 1:
+            letter = cv2.dilate(letter, kernel)
+        elif stroke == 2:
+            letter = cv2.erode(letter, kernel)
+        out[i, ..., 0] = letter
+    return out
+
+def soft_targets(teachers, batch, temperature):
+    """Average of the teachers' probabilities, softened as if their logits were divided by the
+    temperature
+    """
+    probs = np.mean([t.predict(batch) for t in teachers], axis=0)
+    soft = np.power(np.maximum(probs, 1e-12), 1.0 / temperature)
+    return soft / soft.sum(axis=1, keepdims=True)
+
+def train(teachers, batch, labels=None, epochs=30, copies=4, batch_size=64, temperature=3.0,
+        hard_weight=0.3, lr=3e-3, seed=0, verbose=True, **kwargs):
+    """Distils the teachers into a new student network
+
+    Args:
+        teachers (list): teacher networks with a predict method
+        batch (numpy.ndarray): (N, 50, 50, 1) training letters
+        labels (numpy.ndarray, optional): class index of each letter, -1 where unknown. Defaults to None.
+        epochs (int, optional): passes over the augmented letters. Defaults to 30.
+        copies (int, optional): augmented copies of each letter per epoch. Defaults to 4.
+        batch_size (int, optional): letters per gradient step. Defaults to 64.
+        temperature (float, optional): softening of teacher and student outputs. Defaults to 3.0.
+        hard_weight (float, optional): weight of the true label where it is known. Defaults to 0.3.
+        lr (float, optional): Adam learning rate. Defaults to 3e-3.
+        seed (int, optional): random seed. Defaults to 0.
+        verbose (bool, optional): print the loss of every epoch. Defaults to True.
+        kwargs: passed to student_layers
+
+    Returns:
+        LetterNet: trained student
+    """
+    rng = np.random.RandomState(seed)
+    layers = student_layers(seed=seed, **kwargs)
+    opt = Adam(layers, lr)
+    if labels is None:
+        labels = -np.ones(len(batch), np.intp)
+    for epoch in range(epochs):
+        idx = np.tile(np.arange(len(batch)), copies)
+        x = augment(batch[idx], rng)
+        target = soft_targets(teachers, x, temperature)
+        # Trained on 0-1 pixels so Adam's steps suit every layer, the scale is folded back below
+        x /= 255
+        known = labels[idx] >= 0
+        order = rng.permutation(len(x))
+        total = 0.0
+        for start in range(0, len(x), batch_size):
+            sel = order[start:start+batch_size]
+            logits, cache = forward(layers, x[sel])
+            z = logits / temperature
+            p = np.exp(z - z.max(axis=1, keepdims=True))
+            p /= p.sum(axis=1, keepdims=True)
+            # Soft cross entropy, scaled by T^2 so gradients do not shrink with the temperature
+            dlogits = temperature * (p - target[sel])
+            total -= np.sum(target[sel] * np.log(np.maximum(p, 1e-12)))
+            hard = np.flatnonzero(known[sel])
+            if hard.size:
+                ph = np.exp(logits[hard] - logits[hard].max(axis=1, keepdims=True))
+                ph /= ph.sum(axis=1, keepdims=True)
+                ph[np.arange(hard.size), labels[idx][sel][hard]] -= 1
+                dlogits *= 1 - hard_weight
+                dlogits[hard] += hard_weight * ph
+            opt.step(backward(layers, cache, dlogits / len(sel)))
+        if verbose:
+            print('epoch {}: loss {:.4f}'.format(epoch + 1, total / len(x)))
+    kind, conf, (kernel, bias) = layers[0]
+    layers[0] = (kind, conf, (kernel / np.float32(255), bias))
+    return LetterNet(layers)
+
+def save_h5(net, path, name='student_letters'):
+    """Writes a LetterNet in the layout Keras' model.save uses, readable by LetterNet.from_h5
+
+    Args:
+        net (LetterNet): network
+        path (str): output .h5 file
+        name (str, optional): model name. Defaults to 'student_letters'.
+    """
+    import h5py
+    config = {'class_name': 'Sequential', 'config': {'name': name,
+        'layers': [{'class_name': kind, 'config': conf} for kind, conf, _ in net.layers]}}
+    with h5py.File(path, 'w') as f:
+        f.attrs['model_config'] = json.dumps(config).encode('utf-8')
+        f.attrs['keras_version'] = b'2.2.4-tf'
+        f.attrs['backend'] = b'tensorflow'
+        weights = f.create_group('model_weights')
+        weights.attrs['layer_names'] = [conf['name'].encode('utf-8') for _, conf, _ in net.layers]
+        for kind, conf, params in net.layers:
+            group = weights.create_group(conf['name'])
+            names = []
+            if params is not None:
+                for weight, value in zip(('kernel:0', 'bias:0'), params):
+                    group.create_dataset('{}/{}'.format(conf['name'], weight), data=value)
+                    names.append('{}/{}'.format(conf['name'], weight).encode('utf-8'))
+            group.attrs['weight_names'] = names
+
+def parameter_count(net):
+    """int: number of weights of a LetterNet"""
+    return sum(sum(p.size for p in params) for _, _, params in net.layers if params is not None)
+
+def report(teachers, student, batch, labels, repeat=20, batch_size=6):
+    """Prints accuracy and per licence latency of the student against the teachers
+
+    Args:
+        teachers (list): teacher networks, named by TEACHER_MODELS
+        student (LetterNet): student network
+        batch (numpy.ndarray): (N, 50, 50, 1) evaluation letters
+        labels (numpy.ndarray): class index of each letter, -1 where unknown
+        repeat (int, optional): timing repetitions. Defaults to 20.
+        batch_size (int, optional): letters per timed call, one licence. Defaults to 6.
+    """
+    ensemble = np.mean([t.predict(batch) for t in teachers], axis=0).argmax(axis=1)
+    known = labels >= 0
+    sample = batch[:batch_size]
+    for name, net in list(zip(TEACHER_MODELS, teachers)) + [(STUDENT_MODEL, student)]:
+        preds = net.predict(batch).argmax(axis=1)
+        ms = 1e3 * min(timeit.repeat(lambda: net.predict(sample), number=1, repeat=repeat))
+        accuracy = 'accuracy {:.1%}'.format(np.mean(preds[known] == labels[known])) if known.any() else ''
+        print('{:<20} {:>7} params {:.3f} ms per licence, ensemble agreement {:.1%} {}'.format(
+            name, parameter_count(net), ms, np.mean(preds == ensemble), accuracy))
+
+def main():
+    from ldriver.licence.ocr import ALL_LETTERS
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data', default='plate_data', help='folder of letter crops from letter_collector.py')
+    parser.add_argument('--images', help='glob of camera frames to take letters from instead of --data')
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--copies', type=int, default=4, help='augmented copies of each letter per epoch')
+    parser.add_argument('--temperature', type=float, default=3.0)
+    parser.add_argument('--holdout', type=float, default=0.2, help='fraction of letters kept for the report')
+    parser.add_argument('--out', help='output .h5, defaults to {} next to the teachers'.format(STUDENT_MODEL))
+    args = parser.parse_args()
+
+    if args.images:
+        batch = load_frame_letters(args.images)
+        labels = -np.ones(len(batch), np.intp)
+    else:
+        batch, names = load_crops(args.data)
+        labels = np.array([ALL_LETTERS.index(l) if l is not None else -1 for l in names], np.intp)
+    if not len(batch):
+        parser.error('no training letters found')
+    teachers = [LetterNet.from_h5(str(files(ldriver.data.models).joinpath(m))) for m in TEACHER_MODELS]
+
+    order = np.random.RandomState(0).permutation(len(batch))
+    split = max(int(len(batch) * (1 - args.holdout)), 1)
+    train_idx, test_idx = order[:split], order[split:]
+    start = timeit.default_timer()
+    student = train(teachers, batch[train_idx], labels[train_idx], args.epochs, args.copies,
+        temperature=args.temperature)
+    print('trained in {:.0f}s'.format(timeit.default_timer() - start))
+    out = args.out or str(files(ldriver.data.models).joinpath(STUDENT_MODEL))
+    save_h5(student, out)
+    print('saved {}'.format(out))
+    test_idx = test_idx if len(test_idx) else train_idx
+    report(teachers, LetterNet.from_h5(out), batch[test_idx], labels[test_idx])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import time
+import numpy as np
+
+class PlateFusion(object):
+    """Fuses the readings of each plate over frames. The log probabilities of every letter are
+    summed per plate, so the reading with the most evidence across frames wins instead of the
+    single most confident frame. Probabilities are floored, which bounds how much one frame,
+    however confident, can outvote the others.
+
+    A plate is committed once every letter's log posterior margin, between its best and second
+    best class, reaches the threshold. Later readings of a committed plate are ignored. A
+    pending plate that goes unseen, for max_unseen readings of other plates or for max_age
+    seconds, has been left behind: it is committed with its best reading so far if it was read
+    at least min_frames times, and dropped otherwise, as it is usually a misread plate id.
+    Plates seen in turn, such as two plates in the same frames, never expire each other.
+
+    Attributes:
+        committed (dict): letters of each committed plate, by plate id
+        stats (dict): 'readings' fused, 'ignored' after commit, plates 'committed' on their
+        margin, 'flushed' before reaching it and 'dropped' with too few readings, and the
+        'frames' it took to commit them
+    """
+    def __init__(self, labels, id_index=1, margin=8.0, min_frames=2, floor=1e-4, max_unseen=10, max_age=3.0):
+        """
+        Args:
+            labels (list): class label of each probability column, e.g. ocr.ALL_LETTERS
+            id_index (int, optional): letter position holding the plate id. Defaults to 1.
+            margin (float, optional): log posterior margin every letter needs to commit. Defaults to 8.0.
+            min_frames (int, optional): fewest readings a plate is committed on. Defaults to 2.
+            floor (float, optional): smallest probability a frame can give a class. Defaults to 1e-4.
+            max_unseen (int, optional): readings of other plates after which a pending plate
+            expires. Defaults to 10.
+            max_age (float, optional): seconds without a reading after which a pending plate
+            expires, None to only count readings. Defaults to 3.0.
+        """
+        self.labels = labels
+        self.id_index = id_index
+        self.margin = margin
+        self.min_frames = min_frames
+        self.log_floor = np.log(floor)
+        self.max_unseen = max_unseen
+        self.max_age = max_age
+        self.committed = {}
+        self.stats = {'readings': 0, 'ignored': 0, 'committed': 0, 'flushed': 0, 'dropped': 0, 'frames': []}
+        self._scores = {}
+        self._frames = {}
+        # Reading count and time of the last reading of each pending plate
+        self._seen = {}
+        self._clock = 0
+
+    def plate_id(self, probs):
+        """
+        Args:
+            probs (numpy.ndarray): (letters, classes) probabilities of one reading
+
+        Returns:
+            str: id of the plate that was read
+        """
+        return self.labels[int(np.argmax(probs[self.id_index]))]
+
+    def update(self, probs, stamp=None):
+        """Adds one reading of a plate
+
+        Args:
+            probs (numpy.ndarray): (letters, classes) class probabilities of one reading
+            stamp (float, optional): time of the frame it was read in. Defaults to now.
+
+        Returns:
+            str: id of the plate that was read
+            list: (plate id, letters, margins) of every plate committed by this reading
+        """
+        stamp = time.time() if stamp is None else stamp
+        pid = self.plate_id(probs)
+        self._clock += 1
+        if pid in self.committed:
+            self.stats['ignored'] += 1
+            return pid, self.expire(stamp)
+        self.stats['readings'] += 1
+        log_probs = np.maximum(np.log(np.maximum(probs, 1e-30)), self.log_floor)
+        if pid in self._scores:
+            self._scores[pid] += log_probs
+            self._frames[pid] += 1
+        else:
+            self._scores[pid] = log_probs
+            self._frames[pid] = 1
+        self._seen[pid] = self._clock, stamp
+        commits = self.expire(stamp)
+        if self._frames[pid] >= self.min_frames and self.margins(pid).min() >= self.margin:
+            commits.append(self._commit(pid, 'committed'))
+        return pid, commits
+
+    def expire(self, stamp=None):
+        """Commits or drops the pending plates that went unseen, see PlateFusion
+
+        Args:
+            stamp (float, optional): current time. Defaults to now.
+
+        Returns:
+            list: (plate id, letters, margins) of every plate committed
+        """
+        stamp = time.time() if stamp is None else stamp
+        commits = []
+        for pid in list(self._scores):
+            clock, seen = self._seen[pid]
+            if self._clock - clock <= self.max_unseen and (self.max_age is None or stamp - seen <= self.max_age):
+                continue
+            if self._frames[pid] >= self.min_frames:
+                commits.append(self._commit(pid, 'flushed'))
+            else:
+                self._drop(pid)
+        return commits
+
+    def margins(self, pid):
+        """
+        Args:
+            pid (str): plate id
+
+        Returns:
+            numpy.ndarray: log posterior margin of each letter of a pending plate
+        """
+        top = np.sort(self._scores[pid], axis=1)[:, -2:]
+        return top[:, 1] - top[:, 0]
+
+    def reading(self, pid):
+        """
+        Args:
+            pid (str): plate id
+
+        Returns:
+            list: current best letters of a pending or committed plate
+        """
+        if pid in self.committed:
+            return self.committed[pid]
+        return [self.labels[i] for i in self._scores[pid].argmax(axis=1)]
+
+    def flush(self, min_frames=1):
+        """Commits every pending plate with its current best reading
+
+        Args:
+            min_frames (int, optional): fewest readings a plate needs to be committed. Defaults to 1.
+
+        Returns:
+            list: (plate id, letters, margins) of every plate committed
+        """
+        return [self._commit(pid, 'flushed') for pid in list(self._scores) if self._frames[pid] >= min_frames]
+
+    def _commit(self, pid, reason):
+        letters, margins = self.reading(pid), self.margins(pid)
+        self.committed[pid] = letters
+        self.stats[reason] += 1
+        self.stats['frames'].append(self._frames[pid])
+        self._drop(pid)
+        return pid, letters, margins
+
+    def _drop(self, pid):
+        if pid not in self.committed:
+            self.stats['dropped'] += 1
+        del self._scores[pid], self._frames[pid], self._seen[pid]
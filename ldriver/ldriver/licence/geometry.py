@@ -0,0 +1,193 @@
+import numpy as np
+
+def _cross(a, b):
+    return a[..., 0]*b[..., 1] - a[..., 1]*b[..., 0]
+
+def as_quads(contours):
+    """Reshapes Opencv2 style quadrilateral contours to an (N, 4, 2) float array
+
+    Args:
+        contours (numpy.ndarray): contours of shape (N, 4, 1, 2) or (N, 4, 2)
+
+    Returns:
+        numpy.ndarray: (N, 4, 2) float64 corners
+    """
+    return np.asarray(contours, np.float64).reshape(-1, 4, 2)
+
+def polygon_area(polys):
+    """Signed shoelace area of a batch of polygons, positive for counter-clockwise
+    (in image coordinates: clockwise on screen) corner order
+
+    Args:
+        polys (numpy.ndarray): (..., K, 2) polygon corners
+
+    Returns:
+        numpy.ndarray: (...) signed areas
+    """
+    return 0.5 * _cross(polys, np.roll(polys, -1, axis=-2)).sum(axis=-1)
+
+def orient_convex(polys):
+    """Orders the corners of each convex polygon by angle around its centroid, giving every
+    polygon the same (positive area) orientation
+
+    Args:
+        polys (numpy.ndarray): (N, K, 2) convex polygon corners in any order
+
+    Returns:
+        numpy.ndarray: (N, K, 2) reordered corners
+    """
+    polys = np.asarray(polys, np.float64)
+    d = polys - polys.mean(axis=1, keepdims=True)
+    order = np.argsort(np.arctan2(d[..., 1], d[..., 0]), axis=1)
+    return polys[np.arange(polys.shape[0])[:, None], order]
+
+def _clipped_edge_integral(a, b, collinear_inside):
+    """Sum of x dy - y dx over the parts of the edges of a that lie inside b, for every pair.
+    Each edge is clipped against the half-planes of b with the Cyrus-Beck algorithm.
+
+    Args:
+        a (numpy.ndarray): (N, K, 2) positively oriented convex polygons
+        b (numpy.ndarray): (M, L, 2) positively oriented convex polygons
+        collinear_inside (bool): keep edge parts lying on an edge of b that runs the same way
+
+    Returns:
+        numpy.ndarray: (N, M) twice the signed area contributed by the edges of a
+    """
+    p = a[:, None, :, None, :]                                  # (N, 1, K, 1, 2) edge start
+    d = (np.roll(a, -1, axis=1) - a)[:, None, :, None, :]      # (N, 1, K, 1, 2) edge vector
+    q = b[None, :, None, :, :]                                  # (1, M, 1, L, 2) half-plane origin
+    e = (np.roll(b, -1, axis=1) - b)[None, :, None, :, :]      # (1, M, 1, L, 2) half-plane edge
+
+    num = _cross(e, p - q)  # f(t) = num + t*den must be >= 0 inside
+    den = _cross(e, d)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = -num / den
+    t0 = np.where(den > 0, t, 0.0).max(axis=-1)
+    t1 = np.where(den < 0, t, 1.0).min(axis=-1)
+    parallel = den == 0
+    outside = parallel & (num < 0)
+    on_edge = parallel & (num == 0)
+    if not collinear_inside:
+        # An edge shared by both polygons is only counted once, from a
+        outside |= on_edge & ((e*d).sum(axis=-1) > 0)
+    t0, t1 = np.clip(t0, 0, 1), np.clip(t1, 0, 1)
+    valid = (t1 > t0) & ~outside.any(axis=-1)
+
+    p, d = p[..., 0, :], d[..., 0, :]
+    s, f = p + t0[..., None]*d, p + t1[..., None]*d
+    return np.where(valid, _cross(s, f), 0.0).sum(axis=-1)
+
+def intersection_area(a, b):
+    """Pairwise intersection area of two batches of convex polygons, computed analytically as
+    the boundary integral over the clipped edges of both polygons
+
+    Args:
+        a (numpy.ndarray): (N, K, 2) convex polygon corners in any order
+        b (numpy.ndarray): (M, L, 2) convex polygon corners in any order
+
+    Returns:
+        numpy.ndarray: (N, M) intersection areas
+    """
+    a, b = orient_convex(a), orient_convex(b)
+    twice = _clipped_edge_integral(a, b, True) + _clipped_edge_integral(b, a, False).T
+    return np.maximum(0.5 * twice, 0.0)
+
+def combine_rects(quads, thresh=0.3):
+    """Drops boxes that mostly overlap an earlier kept box
+
+    Args:
+        quads (numpy.ndarray): (N, 4, 2) box corners, most important first
+        thresh (float): fraction of a box's own area that may overlap a kept box
+
+    Returns:
+        numpy.ndarray: boolean mask of the boxes that are kept
+    """
+    n = quads.shape[0]
+    keep = np.zeros(n, bool)
+    if not n:
+        return keep
+    areas = np.abs(polygon_area(quads))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overlap = intersection_area(quads, quads) / areas[:, None] > thresh
+    keep[0] = True
+    for i in range(1, n):
+        keep[i] = not overlap[i, keep].any()
+    return keep
+
+def order_corners(pts):
+    """Batched corner ordering: left to right first, then top to bottom, giving
+    [top left, bottom left, top right, bottom right] for each rectangle
+
+    Args:
+        pts (numpy.ndarray): (..., 4, 2) corners
+
+    Returns:
+        numpy.ndarray: (..., 4, 2) ordered corners
+    """
+    pts = np.asarray(pts)
+    batch = pts.reshape(-1, 4, 2)
+    rows = np.arange(batch.shape[0])[:, None]
+    batch = batch[rows, np.argsort(batch[..., 0], axis=1, kind='mergesort')]
+    halves = batch.reshape(-1, 2, 2, 2)
+    halves = halves[np.arange(halves.shape[0])[:, None, None], np.arange(2)[None, :, None],
+        np.argsort(halves[..., 1], axis=2, kind='mergesort')]
+    return halves.reshape(pts.shape)
+
+def merge_plate(pts):
+    """Merges the corners of the rectangles that make up plates into one quadrilateral per
+    plate: the points are split into left and right halves by x, and the top and bottom point
+    of each half are kept
+
+    Args:
+        pts (numpy.ndarray): (P, N, 2) corner points of each plate's rectangles, N >= 2
+
+    Returns:
+        numpy.ndarray: (P, 4, 2) [top left, bottom left, top right, bottom right] corners
+    """
+    pts = np.asarray(pts)
+    n = pts.shape[1]
+    rows = np.arange(pts.shape[0])[:, None]
+    x_sort = pts[rows, np.argsort(pts[..., 0], axis=1, kind='mergesort')]
+    left, right = x_sort[:, :n//2], x_sort[:, -(n//2):]
+    left = left[rows, np.argsort(left[..., 1], axis=1, kind='mergesort')]
+    right = right[rows, np.argsort(right[..., 1], axis=1, kind='mergesort')]
+    return np.stack((left[:, 0], left[:, -1], right[:, 0], right[:, -1]), axis=1)
+
+def pair_rects(quads, min_overlap=0.6, gap_range=(-0.25, 0.5), width_range=(0.7, 1.4)):
+    """Pairs the upper (parking spot) and lower (licence number) rectangles of each plate by
+    geometric adjacency: the lower rectangle starts just below the upper one and spans about
+    the same columns. Pairs are picked greedily, best match first, using each rectangle once.
+
+    Args:
+        quads (numpy.ndarray): (N, 4, 2) rectangle corners
+        min_overlap (float, optional): minimum shared x extent over the narrower width. Defaults to 0.6.
+        gap_range (tuple, optional): (min, max) vertical gap between the rectangles as a
+        fraction of the upper height. Defaults to (-0.25, 0.5).
+        width_range (tuple, optional): (min, max) lower width over upper width. Defaults to (0.7, 1.4).
+
+    Returns:
+        numpy.ndarray: (P, 2) indices of the [upper, lower] rectangle of each plate
+    """
+    q = order_corners(np.asarray(quads, np.float64))
+    x0, x1 = q[..., 0].min(axis=1), q[..., 0].max(axis=1)
+    top, bottom = (q[:, 0, 1] + q[:, 2, 1]) / 2, (q[:, 1, 1] + q[:, 3, 1]) / 2
+    w, h = np.maximum(x1 - x0, 1e-6), np.maximum(bottom - top, 1e-6)
+
+    # Row i is the upper rectangle, column j the lower one
+    overlap = (np.minimum(x1[:, None], x1) - np.maximum(x0[:, None], x0)) / np.minimum(w[:, None], w)
+    gap = (top - bottom[:, None]) / h[:, None]
+    ratio = w / w[:, None]
+    ok = (overlap >= min_overlap) & (gap >= gap_range[0]) & (gap <= gap_range[1]) & \
+        (ratio >= width_range[0]) & (ratio <= width_range[1])
+    np.fill_diagonal(ok, False)
+    score = np.where(ok, np.abs(gap) + np.abs(1 - ratio), np.inf)
+
+    pairs, used = [], set()
+    for k in np.argsort(score, axis=None, kind='mergesort'):
+        i, j = np.unravel_index(k, score.shape)
+        if not np.isfinite(score[i, j]):
+            break
+        if i not in used and j not in used:
+            pairs.append((i, j))
+            used.update((i, j))
+    return np.array(pairs, np.intp).reshape(-1, 2)
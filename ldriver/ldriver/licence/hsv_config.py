@@ -1,4 +1,9 @@
+import cv2
 import numpy as np
+from functools import reduce
+
+# Exclusive upper bound of each channel in OpenCV's 8-bit HSV representation
+HSV_LIMITS = (180, 256, 256)
 
 class HSVRanges:
     """stores two lists of
@@ -10,14 +15,103 @@ class HSVRanges:
     def __init__(self):
         self.lower = []
         self.upper = []
+        self._classifier = None
 
     def add_range(self, hsv_upper, hsv_lower):
         self.upper.append(np.array(hsv_upper))
         self.lower.append(np.array(hsv_lower))
+        self._classifier = None
 
     def get_ranges(self):
         return zip(self.lower, self.upper)
 
+    @property
+    def classifier(self):
+        """HSVClassifier compiled from the current ranges, rebuilt only when a range is added
+        """
+        if self._classifier is None:
+            self._classifier = HSVClassifier(self.lower, self.upper)
+        return self._classifier
+
+class HSVClassifier(object):
+    """Precompiled equivalent of OR-ing cv2.inRange over several hsv ranges.
+
+    Bounds that every range shares are checked once. The channels whose bounds differ between
+    ranges go through 256 entry lookup tables holding one bit per range, so a pixel passes when
+    the AND of its table entries is non-zero. Channels that no range constrains are skipped.
+    When every range requires S == 0 only grey pixels (B == G == R) can pass, and those always
+    have H == 0 and V == B, so the mask is computed straight from the BGR frame.
+
+    Attributes:
+        achromatic (bool): True if the mask is computed without an hsv conversion
+        shared (tuple): (lower, upper) bounds common to all ranges, None if unconstrained
+        channels (tuple): channels looked up in luts
+        luts (numpy.ndarray): (3, 256) uint8 table of range bits per channel value
+    """
+    max_ranges = 8
+
+    def __init__(self, lower, upper):
+        if len(lower) > self.max_ranges:
+            raise ValueError('at most {} ranges are supported, got {}'.format(self.max_ranges, len(lower)))
+        lower = np.array(lower, np.int32).reshape(-1, 3)
+        upper = np.array(upper, np.int32).reshape(-1, 3)
+        self.achromatic = bool(len(lower)) and bool(np.all(upper[:, 1] <= 0))
+        if self.achromatic:
+            # For grey pixels H and S are both 0, so the H and S bounds of a range are either
+            # always or never met
+            keep = (lower[:, :2] <= 0).all(axis=1) & (upper[:, :2] >= 0).all(axis=1)
+            lower, upper = lower[keep], upper[keep]
+            lower[:, :2], upper[:, :2] = 0, np.array(HSV_LIMITS[:2]) - 1
+
+        limits = np.array(HSV_LIMITS) - 1
+        lower, upper = np.clip(lower, 0, 255), np.clip(upper, -1, limits)
+        same = (lower == lower[:1]).all(axis=0) & (upper == upper[:1]).all(axis=0) if len(lower) \
+            else np.ones(3, bool)
+        bounded = (lower > 0) | (upper < limits)
+        shared_channels = [c for c in range(3) if same[c] and bounded[:, c].any()]
+        self.shared = None
+        if shared_channels and not self.achromatic:
+            l, u = np.zeros(3, np.int32), limits.copy()
+            l[shared_channels], u[shared_channels] = lower[0, shared_channels], upper[0, shared_channels]
+            self.shared = (l, u)
+
+        self.channels = tuple(c for c in range(3) if not same[c] or (self.achromatic and c == 2))
+        self.luts = np.zeros((3, 256), np.uint8)
+        for bit, (l, u) in enumerate(zip(lower, upper)):
+            for c in self.channels:
+                self.luts[c, l[c]:u[c]+1] |= 1 << bit
+        if len(self.channels) == 1:
+            # A single table can emit the final mask directly
+            c = self.channels[0]
+            self.luts[c] = np.where(self.luts[c], 255, 0)
+        self.empty = not len(lower)
+
+    def __call__(self, img):
+        """Computes the mask of pixels whose hsv value falls in any of the ranges
+
+        Args:
+            img (numpy.ndarray): 8-bit BGR image
+
+        Returns:
+            numpy.ndarray: binary mask (0 or 255)
+        """
+        if self.empty:
+            return np.zeros(img.shape[:2], np.uint8)
+        if self.achromatic:
+            b, g, r = cv2.split(img)
+            grey = cv2.bitwise_and(cv2.compare(b, g, cv2.CMP_EQ), cv2.compare(g, r, cv2.CMP_EQ))
+            return cv2.bitwise_and(grey, cv2.LUT(b, self.luts[2]))
+
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        msk = cv2.inRange(hsv, *self.shared) if self.shared is not None else None
+        if self.channels:
+            tables = [cv2.LUT(cv2.extractChannel(hsv, c), self.luts[c]) for c in self.channels]
+            bits = reduce(cv2.bitwise_and, tables)
+            if len(self.channels) > 1:
+                bits = cv2.compare(bits, 0, cv2.CMP_GT)
+            msk = bits if msk is None else cv2.bitwise_and(msk, bits)
+        return msk if msk is not None else np.full(img.shape[:2], 255, np.uint8)
+
 uh = 0
 us = 0
 uv1 = 125
@@ -29,4 +123,4 @@ uv2 = 210
 
 licence_ranges = HSVRanges()
 licence_ranges.add_range([uh,us,uv1], [lh,ls,lv1])
-licence_ranges.add_range([uh,us,uv2],[lh,ls,lv2])
\ No newline at end of file
+licence_ranges.add_range([uh,us,uv2],[lh,ls,lv2])
@@ -0,0 +1,173 @@
+import cv2
+import numpy as np
+
+from ldriver.licence.inference import POPCOUNT
+
+# Part of the warped licence, [x1, y1, x2, y2], that holds the letters. The rest of the licence
+# looks the same on every plate
+HASH_BAND = (0, 110, 300, 255)
+
+def plate_hash(frame, M, band=HASH_BAND, size=(64, 32), freqs=8, oversample=2):
+    """Perceptual hash (DCT pHash) of the letters of a licence. The letter band is warped
+    straight from the camera frame at low resolution, and the signs of its lowest spatial
+    frequencies relative to their median give the bits, so the same plate seen from another
+    distance or slightly off centre differs in only a few bits.
+
+    Args:
+        frame (numpy.ndarray): BGR camera frame
+        M (numpy.ndarray): perspective transform from frame to the warped licence
+        band (tuple, optional): hashed region of the warped licence. Defaults to HASH_BAND.
+        size (tuple, optional): (w, h) the band is reduced to. Defaults to (64, 32).
+        freqs (int, optional): side of the block of DCT coefficients kept. Defaults to 8.
+        oversample (int, optional): the band is warped this many times larger, then area
+        averaged to size, to avoid aliasing. Defaults to 2.
+
+    Returns:
+        numpy.ndarray: (freqs * freqs - 1) bits packed in uint8
+    """
+    x1, y1, x2, y2 = band
+    w, h = size[0] * oversample, size[1] * oversample
+    S = np.float64([[w / float(x2 - x1), 0, -x1 * w / float(x2 - x1)],
+                    [0, h / float(y2 - y1), -y1 * h / float(y2 - y1)],
+                    [0, 0, 1]])
+    img = cv2.warpPerspective(frame, S.dot(M), (w, h))
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    img = cv2.resize(img, tuple(size), interpolation=cv2.INTER_AREA)
+    # The DC term only measures brightness
+    coeffs = cv2.dct(np.float32(img))[:freqs, :freqs].reshape(-1)[1:]
+    return np.packbits(coeffs > np.median(coeffs))
+
+def hamming(a, b):
+    """
+    Args:
+        a (numpy.ndarray): packed hash, or (N, bytes) hashes
+        b (numpy.ndarray): packed hash, or (N, bytes) hashes
+
+    Returns:
+        int or numpy.ndarray: number of differing bits
+    """
+    return POPCOUNT[np.bitwise_xor(a, b)].sum(axis=-1, dtype=np.int32)
+
+# Masks of the bit parallel popcount in popcount64, and the set bits of every 16 bit value
+_M1, _M2, _M4, _H01 = [np.uint64(m) for m in (0x5555555555555555, 0x3333333333333333,
+    0x0f0f0f0f0f0f0f0f, 0x0101010101010101)]
+_POPCOUNT16 = POPCOUNT[np.arange(1 << 16) & 0xff] + POPCOUNT[np.arange(1 << 16) >> 8]
+
+def hash_word(h):
+    """
+    Args:
+        h (numpy.ndarray): packed hash of at most 8 bytes
+
+    Returns:
+        numpy.uint64: the hash bits as one word, the form PlateIndex compares
+    """
+    return np.frombuffer(np.asarray(h, np.uint8).tobytes().ljust(8, b'\0'), np.uint64)[0]
+
+def popcount64(x, table_below=256):
+    """Counts the set bits of every word at once. Short arrays look up each 16 bit quarter in a
+    table, long ones use the bit parallel (SWAR) popcount, a few whole array operations whose
+    fixed cost only pays off over a few hundred words.
+
+    Args:
+        x (numpy.ndarray): uint64 words
+        table_below (int, optional): arrays shorter than this use the table. Defaults to 256.
+
+    Returns:
+        numpy.ndarray: number of set bits of each word
+    """
+    if x.size < table_below:
+        bits = _POPCOUNT16[x.view(np.uint16).reshape(-1, 4)]
+        return bits[:, 0] + bits[:, 1] + bits[:, 2] + bits[:, 3]
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+class PlateIndex(object):
+    """Nearest neighbour index of plate hashes over the Hamming distance. The hashes are kept as
+    one uint64 word each in a contiguous array (see hash_word), so a lookup is one XOR and one
+    popcount64 over the whole array.
+
+    Attributes:
+        stats (dict): number of 'lookups' and hash 'comparisons' they made
+        groups (int): number of distinct plates found by group
+    """
+    def __init__(self, max_distance=6):
+        """
+        Args:
+            max_distance (int, optional): largest distance between hashes of the same plate. Defaults to 6.
+        """
+        self.max_distance = max_distance
+        self.stats = {'lookups': 0, 'comparisons': 0}
+        self.groups = 0
+        self._size = 0
+        # Grown by doubling so adding a hash does not copy the array
+        self._words = np.zeros(64, np.uint64)
+        self._values = []
+
+    def __len__(self):
+        return self._size
+
+    def add(self, h, value):
+        """Inserts a hash
+
+        Args:
+            h (numpy.ndarray): packed hash
+            value (object): returned by nearest for this hash
+        """
+        if self._size == len(self._words):
+            self._words = np.concatenate((self._words, np.zeros_like(self._words)))
+        self._words[self._size] = hash_word(h)
+        self._values.append(value)
+        self._size += 1
+
+    def words(self):
+        """
+        Returns:
+            numpy.ndarray: (N,) every stored hash as a uint64 word, in insertion order
+        """
+        return self._words[:self._size]
+
+    def nearest(self, h, max_distance=None):
+        """Closest stored hash within max_distance
+
+        Args:
+            h (numpy.ndarray): packed hash
+            max_distance (int, optional): search radius. Defaults to the index's max_distance.
+
+        Returns:
+            object: value of the closest hash, None if none is close enough
+            int: its distance, None if none is close enough
+        """
+        radius = self.max_distance if max_distance is None else max_distance
+        self.stats['lookups'] += 1
+        self.stats['comparisons'] += self._size
+        if not self._size:
+            return None, None
+        dists = popcount64(self.words() ^ hash_word(h))
+        i = int(np.argmin(dists))
+        if dists[i] > radius:
+            return None, None
+        return self._values[i], int(dists[i])
+
+    def group(self, h):
+        """Identifies the plate a hash belongs to, starting a new group for unseen plates.
+        Hashes that are not close duplicates of their match are also stored, so a group keeps
+        matching as the view of its plate changes.
+
+        Args:
+            h (numpy.ndarray): packed hash
+
+        Returns:
+            int: group number, numbered from 0 in order of first appearance
+            bool: True if the plate was seen before
+        """
+        value, d = self.nearest(h)
+        if d is None:
+            self.add(h, self.groups)
+            self.groups += 1
+            return self.groups - 1, False
+        if d > self.max_distance // 2:
+            self.add(h, value)
+        return value, True
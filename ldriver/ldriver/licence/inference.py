@@ -0,0 +1,319 @@
+import json
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+def _relu(x):
+    return np.maximum(x, 0, out=x)
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': _relu,
+    'softmax': _softmax,
+}
+
+def conv2d(x, kernel, bias):
+    """Valid, stride 1 convolution as a single matrix product over the image patches (im2col)
+
+    Args:
+        x (numpy.ndarray): (N, H, W, C) input
+        kernel (numpy.ndarray): (kh, kw, C, F) Keras kernel
+        bias (numpy.ndarray): (F,) bias, None for no bias
+
+    Returns:
+        numpy.ndarray: (N, H - kh + 1, W - kw + 1, F) output
+    """
+    x = np.ascontiguousarray(x)
+    n, h, w, c = x.shape
+    kh, kw, _, f = kernel.shape
+    oh, ow = h - kh + 1, w - kw + 1
+    sn, sh, sw, sc = x.strides
+    patches = as_strided(x, (n, oh, ow, kh, kw, c), (sn, sh, sw, sh, sw, sc))
+    out = patches.reshape(n * oh * ow, kh * kw * c).dot(kernel.reshape(kh * kw * c, f))
+    if bias is not None:
+        out += bias
+    return out.reshape(n, oh, ow, f)
+
+def max_pool(x, size):
+    """Valid max pooling with stride equal to the pool size
+
+    Args:
+        x (numpy.ndarray): (N, H, W, C) input
+        size (tuple): (ph, pw) pool size
+
+    Returns:
+        numpy.ndarray: (N, H // ph, W // pw, C) output
+    """
+    ph, pw = size
+    oh, ow = x.shape[1] // ph, x.shape[2] // pw
+    # Elementwise maximum of the strided views is much faster than reducing a reshaped axis
+    out = x[:, :oh*ph:ph, :ow*pw:pw].copy()
+    for i in range(ph):
+        for j in range(pw):
+            if i or j:
+                np.maximum(out, x[:, i:oh*ph:ph, j:ow*pw:pw], out=out)
+    return out
+
+class LetterNet(object):
+    """Forward pass of a Keras Sequential CNN in NumPy, loaded straight from a Keras .h5 file so
+    tensorflow is not needed for inference. Supports the layers LicenceOCR.create_model uses:
+    valid stride 1 Conv2D, MaxPooling2D, Flatten, Dropout and Dense.
+
+    Attributes:
+        layers (list): (kind, config, weights) for each layer, applied in order. weights is the
+        (kernel, bias) of Conv2D and Dense layers and None otherwise
+    """
+    def __init__(self, layers):
+        """
+        Args:
+            layers (list): (kind, config, weights) of each layer, see from_h5
+        """
+        self.layers = layers
+
+    @classmethod
+    def from_h5(cls, path):
+        """Builds the network from the model config and weights stored by Keras' model.save
+
+        Args:
+            path (str): path to the .h5 model file
+
+        Returns:
+            LetterNet: network with the same outputs as the Keras model
+        """
+        import h5py
+        with h5py.File(path, 'r') as f:
+            config = f.attrs['model_config']
+            if isinstance(config, bytes):
+                config = config.decode('utf-8')
+            config = json.loads(config)['config']
+            # Sequential configs are a plain layer list in older Keras versions
+            layer_configs = config['layers'] if isinstance(config, dict) else config
+            weights = f['model_weights']
+            layers = []
+            for layer in layer_configs:
+                kind, conf = layer['class_name'], layer['config']
+                if kind in ('Dropout', 'InputLayer'):
+                    continue
+                cls._check(kind, conf)
+                params = None
+                if kind in ('Conv2D', 'Dense'):
+                    group = weights[conf['name']][conf['name']]
+                    kernel = np.float32(group['kernel:0'][()])
+                    bias = np.float32(group['bias:0'][()]) if conf.get('use_bias', True) \
+                        else np.zeros(kernel.shape[-1], np.float32)
+                    params = (kernel, bias)
+                layers.append((kind, conf, params))
+        return cls(layers)
+
+    @staticmethod
+    def _check(kind, conf):
+        """Raises ValueError for layers, or layer options, that are not implemented"""
+        if kind == 'Conv2D':
+            ok = tuple(conf['strides']) == (1, 1) and conf['padding'] == 'valid' and \
+                tuple(conf.get('dilation_rate', (1, 1))) == (1, 1)
+        elif kind == 'MaxPooling2D':
+            ok = tuple(conf['strides']) == tuple(conf['pool_size']) and conf['padding'] == 'valid'
+        else:
+            ok = kind in ('Dense', 'Flatten')
+        if not ok or conf.get('activation', 'linear') not in ACTIVATIONS:
+            raise ValueError('unsupported layer {} ({})'.format(conf['name'], kind))
+
+    def _weighted(self, i, kind, x, params):
+        """Output of the i-th layer, a Conv2D or Dense layer, before its activation"""
+        kernel, bias = params
+        if kind == 'Conv2D':
+            return conv2d(x, kernel, bias)
+        return x.dot(kernel) + bias
+
+    def run(self, batch, until=None):
+        """
+        Args:
+            batch (numpy.ndarray): (N, 50, 50, 1) letter images
+            until (int, optional): number of layers to run. Defaults to all of them.
+
+        Returns:
+            numpy.ndarray: output of the last layer that was run
+        """
+        x = np.asarray(batch, np.float32)
+        for i, (kind, conf, params) in enumerate(self.layers[:until]):
+            if params is not None:
+                x = ACTIVATIONS[conf.get('activation', 'linear')](self._weighted(i, kind, x, params))
+            elif kind == 'MaxPooling2D':
+                x = max_pool(x, conf['pool_size'])
+            else:
+                x = x.reshape(x.shape[0], -1)
+        return x
+
+    def predict(self, batch):
+        """
+        Args:
+            batch (numpy.ndarray): (N, 50, 50, 1) letter images
+
+        Returns:
+            numpy.ndarray: (N, classes) class probabilities
+        """
+        return self.run(batch)
+
+class CascadeNet(object):
+    """Ensemble of letter networks evaluated as an early exit cascade. Every letter is read by
+    the first network. Only letters whose confidence is below the threshold of their position
+    on the licence go on to the next network, and the scores of every network that read a
+    letter are averaged, so easy letters cost one network and hard ones get the ensemble.
+
+    The cascade always costs more than its first network alone, it gives near ensemble
+    accuracy for less than the whole ensemble's cost. With networks of the same architecture,
+    as LicenceOCR's cascade_models are, that only pays off when few letters escalate, and each
+    later stage still adds its fixed per call cost: on the test frames 2 of 24 letters
+    escalating make it 1.5 times slower than one network (see benchmark.py cascade). Only a
+    cheaper first network, such as the distilled student of distillation.py, can bring it
+    below the cost of one full model.
+
+    Attributes:
+        stats (dict): number of 'letters' read and how many reached each 'stage'
+    """
+    def __init__(self, nets, thresholds=0.5, letters=6):
+        """
+        Args:
+            nets (list): networks with a predict method, in the order they are tried
+            thresholds (float or iterable, optional): confidence each letter position needs to
+            exit the cascade, one value or one per position. Defaults to 0.5.
+            letters (int, optional): letters per licence in a batch. Defaults to 6.
+        """
+        self.nets = nets
+        self.thresholds = np.zeros(letters, np.float32) + thresholds
+        self.letters = letters
+        self.stats = {'letters': 0, 'stage': [0] * len(nets)}
+
+    def predict(self, batch):
+        """
+        Args:
+            batch (numpy.ndarray): (N, 50, 50, 1) letter images, licence by licence
+
+        Returns:
+            numpy.ndarray: (N, classes) class probabilities averaged over the networks that
+            read each letter
+        """
+        total = self.nets[0].predict(batch)
+        count = np.ones(total.shape[0], np.float32)
+        needed = self.thresholds[np.arange(total.shape[0]) % self.letters]
+        active = np.flatnonzero(total.max(axis=1) < needed)
+        self.stats['letters'] += total.shape[0]
+        self.stats['stage'][0] += total.shape[0]
+        for stage, net in enumerate(self.nets[1:], 1):
+            if not active.size:
+                break
+            self.stats['stage'][stage] += active.size
+            total[active] += net.predict(batch[active])
+            count[active] += 1
+            conf = total[active].max(axis=1) / count[active]
+            active = active[conf < needed[active]]
+        return total / count[:, None]
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+
+def letter_hash(batch, block=2, thresh=127):
+    """Perceptual hash of letter images: each block x block cell is averaged, thresholded and
+    the bits are packed, so nearly identical crops differ in only a few bits
+
+    Args:
+        batch (numpy.ndarray): (N, H, W, 1) letter images
+        block (int, optional): side of the averaged cells in pixels. Defaults to 2.
+        thresh (int, optional): cell mean above which the bit is set. Defaults to 127.
+
+    Returns:
+        numpy.ndarray: (N, bytes) uint8 hashes
+    """
+    n, h, w = batch.shape[:3]
+    h, w = h // block, w // block
+    cells = batch[:, :h*block, :w*block, 0].reshape(n, h, block, w, block).mean(axis=4).mean(axis=2)
+    return np.packbits((cells > thresh).reshape(n, -1), axis=1)
+
+class CachedNet(object):
+    """Least recently used cache of class probabilities in front of a letter network, keyed by
+    letter_hash. A letter whose hash is within max_distance bits of a cached one reuses its
+    probabilities, only the other letters are run through the network.
+
+    A hit repeats an earlier reading rather than making a new one, so readings that are fused
+    over frames (see fusion.PlateFusion) must not go through the cache, or must leave out the
+    letters flagged in repeats.
+
+    Attributes:
+        stats (dict): number of cache 'hits', 'misses' and 'evictions'
+        repeats (numpy.ndarray): True for each letter of the last batch answered from the cache
+    """
+    def __init__(self, net, capacity=256, max_distance=8, block=2):
+        """
+        Args:
+            net (object): network with a predict method
+            capacity (int, optional): most letters kept. Defaults to 256.
+            max_distance (int, optional): largest Hamming distance counted as the same letter. Defaults to 8.
+            block (int, optional): hash cell size, see letter_hash. Defaults to 2.
+        """
+        self.net = net
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self.block = block
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.repeats = np.zeros(0, bool)
+        self.clear()
+
+    def clear(self):
+        """Empties the cache"""
+        self._hashes = None
+        self._probs = None
+        self._used = np.full(self.capacity, -1, np.int64)
+        self._clock = 0
+
+    @property
+    def hit_rate(self):
+        """float: fraction of letters answered from the cache"""
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / float(total) if total else 0.0
+
+    def predict(self, batch):
+        """
+        Args:
+            batch (numpy.ndarray): (N, 50, 50, 1) letter images
+
+        Returns:
+            numpy.ndarray: (N, classes) class probabilities
+        """
+        hashes = letter_hash(batch, self.block)
+        n = hashes.shape[0]
+        self._clock += 1
+        if self._hashes is None:
+            slot, hit = np.zeros(n, np.intp), np.zeros(n, bool)
+        else:
+            dists = POPCOUNT[hashes[:, None, :] ^ self._hashes[None]].sum(axis=2, dtype=np.int32)
+            dists[:, self._used < 0] = self.max_distance + 1
+            slot = np.argmin(dists, axis=1)
+            hit = dists[np.arange(n), slot] <= self.max_distance
+        self.repeats = hit
+        self.stats['hits'] += int(np.count_nonzero(hit))
+        self.stats['misses'] += n - int(np.count_nonzero(hit))
+        self._used[slot[hit]] = self._clock
+
+        miss = np.flatnonzero(~hit)
+        if miss.size or self._probs is None:
+            probs = self.net.predict(batch[miss])
+        if self._probs is None:
+            self._hashes = np.zeros((self.capacity, hashes.shape[1]), np.uint8)
+            self._probs = np.zeros((self.capacity,) + probs.shape[1:], np.float32)
+        out = np.empty((n,) + self._probs.shape[1:], np.float32)
+        if miss.size:
+            out[miss] = probs
+            self._insert(hashes[miss], probs)
+        out[hit] = self._probs[slot[hit]]
+        return out
+
+    def _insert(self, hashes, probs):
+        # Empty slots have the lowest use stamp so they are filled before anything is evicted
+        hashes, probs = hashes[-self.capacity:], probs[-self.capacity:]
+        slots = np.argsort(self._used, kind='mergesort')[:hashes.shape[0]]
+        self.stats['evictions'] += int(np.count_nonzero(self._used[slots] >= 0))
+        self._hashes[slots] = hashes
+        self._probs[slots] = probs
+        self._used[slots] = self._clock
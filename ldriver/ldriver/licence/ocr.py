@@ -1,72 +1,87 @@
 from os import stat
-from tensorflow.keras import layers, models, optimizers
-import tensorflow as tf
-from tensorflow.python.keras.backend import set_session
-from tensorflow.python.keras.models import load_model
 import string
 import cv2
 import numpy as np
-from matplotlib import pyplot as plt
 from importlib_resources import files
 import ldriver.data.models
+from ldriver.licence.inference import LetterNet, CascadeNet, CachedNet
+from ldriver.licence.distillation import STUDENT_MODEL
 
 ALL_LETTERS = list(string.ascii_uppercase) + list(map(str,range(0,10)))
-sess1 = tf.Session()    
-graph1 = tf.get_default_graph()
-set_session(sess1)
+# Tensorflow is only imported, and its session created, when the keras engine is used
+sess1 = None
+graph1 = None
+
+def keras_session():
+    """Creates the tensorflow session shared by every keras model on first use
+
+    Returns:
+        tensorflow.Session: the session
+        tensorflow.Graph: its graph
+    """
+    global sess1
+    global graph1
+    if sess1 is None:
+        import tensorflow as tf
+        from tensorflow.python.keras.backend import set_session
+        sess1 = tf.Session()
+        graph1 = tf.get_default_graph()
+        set_session(sess1)
+    return sess1, graph1
 
 
 class LicenceOCR:
     img_shape = (50, 50, 1)
-    # Common missed letters that can 
-    dig2alpha={
-        '1': 'T',
-        '2': 'Z',
-        '3': 'E',
-        '4': 'A',
-        '5': 'S',
-        '6': 'G',
-        '7': 'Z',
-        '8': 'B',
-        '9': 'P',
-        '0': 'C',
-    }
-    alpha2dig={
-        'A': '4',
-        'B': '8',
-        'C': '6',
-        'D': '0',
-        'E': '3',
-        'F': '7',
-        'G': '6',
-        'H': '8',
-        'I': '1',
-        'J': '7',
-        'K': '4',
-        'L': '1',
-        'M': '4',
-        'N': '4',
-        'O': '0',
-        'P': '9',
-        'Q': '0',
-        'R': '9',
-        'S': '5',
-        'T': '1',
-        'U': '0',
-        'V': '4',
-        'W': '1',
-        'X': '4',
-        'Y': '4',
-        'Z': '2',
-    }
-
-    def __init__(self, vtesting=False, experimental=False):
+    # Classes allowed at each licence position: the parking 'P', the spot digit, two letters and
+    # two digits. Everything else is masked out of the probabilities before decoding
+    _digits = np.array([l.isdigit() for l in ALL_LETTERS])
+    position_masks = np.array([np.ones_like(_digits), _digits, ~_digits, ~_digits, _digits, _digits])
+
+    # Models of the cascade engine, in the order letters are passed on to them
+    cascade_models = ('best_letters_2.h5', 'best_letters_3.h5', 'best_letters_1.h5')
+
+    def __init__(self, vtesting=False, experimental=False, engine='numpy', model='best_letters_2.h5',
+            thresholds=0.5, cache_size=0, cache_distance=8):
+        """
+        Args:
+            vtesting (bool, optional): show every letter that is read. Defaults to False.
+            experimental (bool, optional): also show thresholding experiments. Defaults to False.
+            engine (str, optional): 'numpy' runs the model with LetterNet, 'student' runs the
+            distilled STUDENT_MODEL (see distillation.py) instead, 'cascade' runs cascade_models
+            as a CascadeNet and 'keras' runs it with tensorflow. Defaults to 'numpy'.
+            model (str, optional): model file in ldriver.data.models. Defaults to 'best_letters_2.h5'.
+            thresholds (float or iterable, optional): confidence each letter position needs to
+            leave the cascade engine early. Defaults to 0.5, which costs about 1.5 times one
+            model as its stages share an architecture, higher thresholds send more letters
+            through the later stages (see CascadeNet and benchmark.py cascade).
+            cache_size (int, optional): letters whose results are cached, see CachedNet. Readings
+            that are fused over frames must not be cached, so it is opt-in. Defaults to 0, no cache.
+            cache_distance (int, optional): Hamming distance between letter hashes still treated as
+            the same letter. Defaults to 8, the largest that changes no letter in benchmark.py cache.
+        """
         self.vtest = vtesting
         self.exper = experimental
+        self.engine = engine
         # self.model = self.load_weights()
-        model_file = str(files(ldriver.data.models).joinpath('best_letters_2.h5'))
-        print('Loading model file: {}'.format(model_file))
-        self.model = load_model(model_file)
+        if engine == 'student':
+            model = STUDENT_MODEL
+        model_file = str(files(ldriver.data.models).joinpath(model))
+        if engine in ('numpy', 'student', 'keras'):
+            print('Loading model file: {}'.format(model_file))
+        if engine in ('numpy', 'student'):
+            self.model = LetterNet.from_h5(model_file)
+        elif engine == 'cascade':
+            print('Loading cascade of {}'.format(', '.join(self.cascade_models)))
+            self.model = CascadeNet([LetterNet.from_h5(str(files(ldriver.data.models).joinpath(m)))
+                for m in self.cascade_models], thresholds)
+        elif engine == 'keras':
+            keras_session()
+            from tensorflow.python.keras.models import load_model
+            self.model = load_model(model_file)
+        else:
+            raise ValueError('unknown OCR engine {}'.format(engine))
+        if cache_size:
+            self.model = CachedNet(self.model, cache_size, cache_distance)
 
     def read_licence(self, licence):
         """given a LicencePlate, find the letters that make it up by CNN inference
@@ -77,28 +92,113 @@ class LicenceOCR:
         Returns:
             list: list of strings representing letters from licence
         """
-        letter_rois = licence.letters
-        
-        resized_letters = self.process_letters(letter_rois)
+        resized_letters = licence.batch
+        if resized_letters is None:
+            resized_letters = self.process_letters(licence.letters)
 
-        # Reshape
-        a = self.img_shape
-        resized_letters = resized_letters.reshape(resized_letters.shape[0], a[0], a[1], a[2])
+            # Reshape
+            a = self.img_shape
+            resized_letters = resized_letters.reshape(resized_letters.shape[0], a[0], a[1], a[2])
         self.vshow(resized_letters)
-        
-        global sess1
-        global graph1
-        with graph1.as_default():
-            set_session(sess1)
-            preds_oh = self.model.predict(resized_letters)
-            preds = [ALL_LETTERS[np.argmax(p)] for p in preds_oh]
-            conf = np.array([np.max(p) for p in preds_oh])
-        
-        preds[1] = self.alpha2dig.get(preds[1], preds[1])
-        preds[2], preds[3] = self.dig2alpha.get(preds[2], preds[2]), self.dig2alpha.get(preds[3], preds[3])
-        preds[4], preds[5] = self.alpha2dig.get(preds[4], preds[4]), self.alpha2dig.get(preds[5], preds[5])
-        
-        return preds, conf
+        return self.decode(self.predict(resized_letters))
+
+    def read_licences(self, licences):
+        """Reads several LicencePlates with a single CNN inference call
+
+        Args:
+            licences (list): LicencePlates that were found
+
+        Returns:
+            list: (predictions, confidences) for each licence, as returned by read_licence
+        """
+        if not licences:
+            return []
+        return self.read_letters(licences[0].letter_batch(licences), len(licences[0].letters))
+
+    def read_letters(self, batch, n=6):
+        """Reads the letters of several licences stacked into one batch
+
+        Args:
+            batch (numpy.ndarray): (n * licences, 50, 50, 1) letter images, licence by licence
+            n (int, optional): letters per licence. Defaults to 6.
+
+        Returns:
+            list: (predictions, confidences) for each licence, as returned by read_licence
+        """
+        probs = self.read_probs(batch, n)
+        idx, conf = probs.argmax(axis=2), probs.max(axis=2)
+        return [([ALL_LETTERS[i] for i in row], c) for row, c in zip(idx, conf)]
+
+    def read_probs(self, batch, n=6):
+        """Class probabilities of the letters of several licences stacked into one batch,
+        constrained to the classes allowed at each position
+
+        Args:
+            batch (numpy.ndarray): (n * licences, 50, 50, 1) letter images, licence by licence
+            n (int, optional): letters per licence. Defaults to 6.
+
+        Returns:
+            numpy.ndarray: (licences, n, len(ALL_LETTERS)) probabilities
+        """
+        probs = self.predict(batch).reshape(-1, n, len(ALL_LETTERS))
+        if n == len(self.position_masks):
+            probs = self.constrain(probs)
+        return probs
+
+    def warm_up(self, n=6):
+        """Runs a dummy inference so the first licence does not pay for lazy initialisation
+        (graph building with keras, memory allocation with numpy)
+
+        Args:
+            n (int, optional): letters in the dummy batch. Defaults to 6.
+        """
+        self.predict(np.zeros((n,) + self.img_shape, np.float32))
+
+    def predict(self, batch):
+        """Runs the CNN on a batch of letters
+
+        Args:
+            batch (numpy.ndarray): (N, 50, 50, 1) letter images
+
+        Returns:
+            numpy.ndarray: (N, len(ALL_LETTERS)) class probabilities
+        """
+        if self.engine != 'keras':
+            return self.model.predict(batch)
+        from tensorflow.python.keras.backend import set_session
+        sess, graph = keras_session()
+        with graph.as_default():
+            set_session(sess)
+            return self.model.predict(batch)
+
+    @classmethod
+    def constrain(cls, probs):
+        """Restricts letter probabilities to the classes allowed at each licence position and
+        renormalises them, so the best allowed class wins and its confidence is relative to the
+        other allowed classes
+
+        Args:
+            probs (numpy.ndarray): (..., 6, len(ALL_LETTERS)) class probabilities of licences
+
+        Returns:
+            numpy.ndarray: constrained probabilities, same shape
+        """
+        masked = probs * cls.position_masks
+        total = masked.sum(axis=-1, keepdims=True)
+        return masked / np.maximum(total, np.finfo(np.float32).tiny)
+
+    def decode(self, preds_oh):
+        """Turns the class probabilities of one licence's letters into letters
+
+        Args:
+            preds_oh (numpy.ndarray): (6, len(ALL_LETTERS)) class probabilities
+
+        Returns:
+            list: list of strings representing letters from licence
+            numpy.ndarray: confidence of each letter
+        """
+        probs = self.constrain(preds_oh)
+        return [ALL_LETTERS[i] for i in probs.argmax(axis=1)], probs.max(axis=1)
 
     @classmethod
     def process_letters(cls, letters):
@@ -122,10 +222,11 @@ class LicenceOCR:
         """
         if self.vtest:
             for img in imgs:
-                img = np.squeeze(img, axis=2)
+                img = np.squeeze(img, axis=2).astype(np.uint8)
                 cv2.imshow('vtest', img)
                 cv2.waitKey(0)
                 if self.exper:
+                    from matplotlib import pyplot as plt
                     ret,th1 = cv2.threshold(img,60,255,cv2.THRESH_BINARY_INV)
                     th2 = cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY_INV,15,2)
                     th3 = cv2.adaptiveThreshold(img,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,cv2.THRESH_BINARY_INV,15,2)
@@ -156,6 +257,7 @@ class LicenceOCR:
         Returns:
             tensorflow.keras.model : tf model
         """
+        from tensorflow.keras import layers, models, optimizers
         conv_model = models.Sequential()
         conv_model.add(layers.Conv2D(32, (3, 3), activation='relu',
                                     input_shape=self.img_shape))
@@ -179,6 +281,7 @@ class LicenceOCR:
 
     @staticmethod
     def histogram(gray_img):
+        from matplotlib import pyplot as plt
         n, bins, patches = plt.hist(gray_img.flatten(), bins=50)
         plt.show()
 
@@ -0,0 +1,298 @@
+import collections
+import logging
+import multiprocessing
+import threading
+import time
+
+from ldriver.licence.detection import LicencePlate
+from ldriver.licence.identity import hash_word, popcount64
+from ldriver.licence.tracking import PlateTracker
+
+class LatestFrames(object):
+    """Bounded frame queue that keeps only the newest frames. Putting a frame into a full queue
+    drops the oldest one, so a consumer that falls behind skips frames instead of working
+    through a backlog of stale ones.
+
+    Attributes:
+        stats (dict): number of frames 'received', 'dropped' unprocessed and 'taken'
+    """
+    def __init__(self, maxlen=2):
+        """
+        Args:
+            maxlen (int, optional): most frames kept. Defaults to 2.
+        """
+        self.maxlen = maxlen
+        self.stats = {'received': 0, 'dropped': 0, 'taken': 0}
+        self._frames = collections.deque()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, frame):
+        """Adds a frame, dropping the oldest one if the queue is full
+
+        Args:
+            frame (object): frame, e.g. a camera image
+
+        Returns:
+            int: sequence number of the frame, numbered from 0 in arrival order
+        """
+        with self._cond:
+            seq = self.stats['received']
+            self.stats['received'] += 1
+            if len(self._frames) >= self.maxlen:
+                self._frames.popleft()
+                self.stats['dropped'] += 1
+            self._frames.append((seq, time.time(), frame))
+            self._cond.notify()
+        return seq
+
+    def get(self, timeout=None):
+        """Takes the oldest frame still queued, waiting for one if the queue is empty
+
+        Args:
+            timeout (float, optional): longest wait in seconds. Defaults to waiting until a frame
+            arrives or the queue is closed.
+
+        Returns:
+            tuple: (sequence number, arrival time, frame), None on timeout or once closed and empty
+        """
+        with self._cond:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self._frames and not self._closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            if not self._frames:
+                return None
+            self.stats['taken'] += 1
+            return self._frames.popleft()
+
+    @property
+    def depth(self):
+        """int: frames waiting"""
+        return len(self._frames)
+
+    def clear(self):
+        """Drops every queued frame"""
+        with self._cond:
+            self.stats['dropped'] += len(self._frames)
+            self._frames.clear()
+
+    def close(self):
+        """Wakes up waiting consumers, get returns None once the queue is empty"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+# Each detection worker process follows plates across the frames it is given
+_tracker = None
+
+def _init_worker(track):
+    global _tracker
+    _tracker = PlateTracker() if track else None
+
+def detect_plates(frame, engine='components', known=None, max_distance=6):
+    """Finds the valid licences of a frame, in a form that can be sent between processes
+
+    Args:
+        frame (numpy.ndarray): camera frame
+        engine (str, optional): rectangle detector used without a tracker. Defaults to 'components'.
+        known (numpy.ndarray, optional): (N,) uint64 hash words of plates that need no reading,
+        see PlateIndex.words, their letters are not extracted. Defaults to None.
+        max_distance (int, optional): largest hash distance to a known plate. Defaults to 6.
+
+    Returns:
+        list: valid LicencePlates, detached from the frame
+        dict: increase of LicencePlate.cascade_stats for this frame
+    """
+    before = dict(LicencePlate.cascade_stats)
+    plates = [lp for lp in LicencePlate.find_all(frame, engine=engine, tracker=_tracker) if lp.valid]
+    for lp in plates:
+        lp.detach(known is None or not len(known) or popcount64(known ^ hash_word(lp.hash)).min() > max_distance)
+    return plates, dict((k, v - before[k]) for k, v in LicencePlate.cascade_stats.items())
+
+class _Done(object):
+    """Result of a detection run in the calling thread, with the AsyncResult interface used"""
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class DetectionPipeline(object):
+    """Ingests camera frames into a LatestFrames queue and detects licences on a pool of worker
+    processes, so detection is not limited to one core and never delays the camera callback.
+    At most one frame per worker is in flight and results are handed to handle strictly in
+    frame order from a single thread, which is where OCR and bookkeeping belong.
+
+    After idle_after detected frames in a row without a candidate plate, that is frames
+    rejected by the cheap 'mask' or 'candidates' stages of the detection cascade, only one
+    camera frame in idle_stride is detected until a candidate shows up again. With expected,
+    e.g. a PlateMap lookup of the robot pose, every frame is detected while a plate should be
+    in view, and an idle pipeline drops to one frame in background_stride otherwise. A plate
+    found by this background scan ends the idle state, so plates missing from the map are
+    still read.
+
+    Attributes:
+        frames (LatestFrames): ingestion queue
+        stats (dict): frames 'detected', 'skipped' at a lower rate and whose detection or
+        handling 'failed', the wait from arrival to detection ('queue_ms') and from arrival to
+        handling ('age_ms') of the last frame, and their 'max_queue_ms' and 'max_age_ms'
+    """
+    def __init__(self, handle, processes=None, maxlen=2, engine='components', track=True, known=None,
+            idle_after=10, idle_stride=3, expected=None, background_stride=10):
+        """
+        Args:
+            handle (callable): called with (sequence number, arrival time, frame, plates) for
+            every detected frame, in arrival order
+            processes (int, optional): detection worker processes, 0 detects in a thread of this
+            process. Defaults to 2, leaving a core for the rest of the node, or 0 on one core.
+            maxlen (int, optional): newest frames kept waiting for detection. Defaults to 2.
+            engine (str, optional): rectangle detector, see LicencePlate. Defaults to 'components'.
+            track (bool, optional): each worker follows plates with a PlateTracker. Defaults to True.
+            known (callable, optional): returns the uint64 hash words and the distance of plates
+            whose letters are not needed, see detect_plates. Defaults to None.
+            idle_after (int, optional): frames without a candidate plate before the detection
+            rate drops. Defaults to 10.
+            idle_stride (int, optional): one camera frame in idle_stride is detected while idle,
+            1 detects every frame. Defaults to 3.
+            expected (callable, optional): returns True when a plate should be in view. Defaults
+            to None, relying on idle_stride alone.
+            background_stride (int, optional): one camera frame in background_stride is detected
+            while idle and no plate is expected. Defaults to 10.
+        """
+        self.handle = handle
+        self.engine = engine
+        self.known = known
+        self.idle_after = idle_after
+        self.idle_stride = idle_stride
+        self.expected = expected
+        self.background_stride = background_stride
+        self._idle = 0
+        self._last_seq = None
+        self.frames = LatestFrames(maxlen)
+        if processes is None:
+            processes = max(min(2, multiprocessing.cpu_count() - 1), 0)
+        self.stats = {'detected': 0, 'skipped': 0, 'failed': 0, 'queue_ms': 0.0, 'age_ms': 0.0, 'max_queue_ms': 0.0, 'max_age_ms': 0.0}
+        self._pool = multiprocessing.Pool(processes, _init_worker, (track,)) if processes else None
+        if not processes:
+            _init_worker(track)
+        self._slots = threading.Semaphore(max(processes, 1))
+        self._inflight = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._dispatch, name='licence-dispatch'),
+            threading.Thread(target=self._collect, name='licence-results')]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def put(self, frame):
+        """Queues a camera frame, never blocks
+
+        Args:
+            frame (numpy.ndarray): camera frame
+
+        Returns:
+            int: sequence number of the frame
+        """
+        return self.frames.put(frame)
+
+    @property
+    def depth(self):
+        """int: frames waiting for a worker"""
+        return self.frames.depth
+
+    @property
+    def idle(self):
+        """bool: no candidate plate was seen recently, so frames are detected at a lower rate"""
+        return self._idle >= self.idle_after
+
+    @property
+    def stride(self):
+        """int: one camera frame in stride is detected at the moment"""
+        if not self.idle or (self.expected is not None and self.expected()):
+            return 1
+        return self.idle_stride if self.expected is None else self.background_stride
+
+    def _dispatch(self):
+        while True:
+            # Frames are only taken once a worker is free, so the newest ones are detected
+            self._slots.acquire()
+            item = self.frames.get()
+            if item is None:
+                break
+            seq, stamp, frame = item
+            if self._last_seq is not None and seq - self._last_seq < self.stride:
+                self.stats['skipped'] += 1
+                self._slots.release()
+                continue
+            self._last_seq = seq
+            queued = 1e3 * (time.time() - stamp)
+            try:
+                args = (frame, self.engine) + (self.known() if self.known is not None else ())
+                if self._pool is not None:
+                    result = self._pool.apply_async(detect_plates, args)
+                else:
+                    result = _Done(detect_plates(*args))
+            except Exception as e:
+                # Reported by _collect, which releases the slot
+                result = _Done(error=e)
+            with self._cond:
+                self._inflight.append((seq, stamp, frame, queued, result))
+                self._cond.notify()
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _collect(self):
+        while True:
+            with self._cond:
+                while not self._inflight and not self._closed:
+                    self._cond.wait()
+                if not self._inflight:
+                    return
+                seq, stamp, frame, queued, result = self._inflight.popleft()
+            # A failed frame is logged and skipped, the slot must be freed whatever happens or
+            # _dispatch blocks for good
+            try:
+                plates, cascade_stats = result.get()
+            except Exception:
+                logging.exception('licence detection failed on frame {}'.format(seq))
+                self.stats['failed'] += 1
+                continue
+            finally:
+                self._slots.release()
+            if self._pool is not None:
+                for k, v in cascade_stats.items():
+                    LicencePlate.cascade_stats[k] += v
+            if plates or not (cascade_stats['mask'] or cascade_stats['candidates']):
+                self._idle = 0
+            else:
+                self._idle += 1
+            try:
+                self.handle(seq, stamp, frame, plates)
+            except Exception:
+                logging.exception('handling frame {} failed'.format(seq))
+                self.stats['failed'] += 1
+                continue
+            age = 1e3 * (time.time() - stamp)
+            self.stats['detected'] += 1
+            self.stats['queue_ms'], self.stats['age_ms'] = queued, age
+            self.stats['max_queue_ms'] = max(self.stats['max_queue_ms'], queued)
+            self.stats['max_age_ms'] = max(self.stats['max_age_ms'], age)
+
+    def close(self):
+        """Finishes the frames in flight, drops those still queued and stops the workers"""
+        self.frames.clear()
+        self.frames.close()
+        self._slots.release()
+        for t in self._threads:
+            t.join()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
@@ -0,0 +1,285 @@
+"""Map of the licence plates around the track, built offline from frames recorded with their
+odometry by data_collection/scripts/img_cmd.py:
+
+    python -m ldriver.licence.plate_map --data img_cmd_data --out plate_map.json
+"""
+from __future__ import print_function
+import argparse
+import collections
+import json
+import math
+import numpy as np
+
+# Horizontal field of view and frame width of the R1 camera
+CAMERA_FOV = math.radians(80)
+FRAME_WIDTH = 1280
+
+def track_pose(pose):
+    """Pose of the robot on the track, in the frame img_cmd.py records: x and y are the odometry
+    -y and x, and the heading is measured from the track x axis
+
+    Args:
+        pose (geometry_msgs.msg.Pose): odometry pose
+
+    Returns:
+        tuple: (x, y, heading in radians)
+    """
+    q = pose.orientation
+    yaw = math.atan2(2 * (q.w * q.z + q.x * q.y), 1 - 2 * (q.y * q.y + q.z * q.z))
+    return -pose.position.y, pose.position.x, float(wrap_angle(yaw + math.pi / 2))
+
+def wrap_angle(a):
+    """
+    Args:
+        a (float or numpy.ndarray): angle in radians
+
+    Returns:
+        float or numpy.ndarray: the same angle in [-pi, pi)
+    """
+    return (a + np.pi) % (2 * np.pi) - np.pi
+
+def view_bearing(x, width=FRAME_WIDTH, fov=CAMERA_FOV):
+    """
+    Args:
+        x (float): pixel column in the camera frame
+        width (int, optional): frame width. Defaults to FRAME_WIDTH.
+        fov (float, optional): horizontal field of view in radians. Defaults to CAMERA_FOV.
+
+    Returns:
+        float: angle of the column from the camera axis in radians, positive to the left
+    """
+    focal = width / 2.0 / math.tan(fov / 2)
+    return math.atan2(width / 2.0 - x, focal)
+
+def motion_headings(xy, min_step=0.01):
+    """Estimates the heading of recorded poses that have none from the direction of travel
+
+    Args:
+        xy (numpy.ndarray): (N, 2) positions in recording order
+        min_step (float, optional): shortest move that gives a heading. Defaults to 0.01.
+
+    Returns:
+        numpy.ndarray: (N,) heading towards the next position, that of the previous move while
+        standing still
+    """
+    xy = np.asarray(xy, np.float64)
+    headings = np.zeros(len(xy))
+    last = 0.0
+    for i in range(len(xy)):
+        step = xy[i + 1] - xy[i] if i + 1 < len(xy) else xy[i] - xy[max(i - 1, 0)]
+        if np.hypot(*step) >= min_step:
+            last = math.atan2(step[1], step[0])
+        headings[i] = last
+    return headings
+
+def triangulate(origins, angles, min_spread=math.radians(2)):
+    """Point closest, in the least squares sense, to a set of rays
+
+    Args:
+        origins (numpy.ndarray): (N, 2) start of each ray
+        angles (numpy.ndarray): (N,) direction of each ray in radians
+        min_spread (float, optional): smallest root mean square angle of the rays around their
+        mean direction for the point to be well defined. Defaults to 2 degrees.
+
+    Returns:
+        numpy.ndarray: (2,) the point, None if the rays are too close to parallel or it lies
+        behind most of them
+    """
+    origins = np.asarray(origins, np.float64)
+    d = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    # Projection onto the normal of each ray. The smallest eigenvalue of their sum is the sum of
+    # the squared sines of the ray angles around the best direction
+    P = np.eye(2)[None] - d[:, :, None] * d[:, None, :]
+    A, b = P.sum(axis=0), np.einsum('nij,nj->i', P, origins)
+    if np.linalg.eigvalsh(A)[0] < len(origins) * math.sin(min_spread) ** 2:
+        return None
+    pt = np.linalg.solve(A, b)
+    if np.mean(((pt - origins) * d).sum(axis=1) > 0) < 0.5:
+        return None
+    return pt
+
+class PlateMap(object):
+    """Locations of the plates around the track with the distance each was seen from, in a
+    uniform grid so a lookup only checks the plates in the cells around the robot
+
+    Attributes:
+        plates (list): dicts with the 'x', 'y' of each plate, the 'range' it was seen from and
+        the number of 'views' it was located from
+        stats (dict): number of 'lookups' and of plates 'checked' by them
+    """
+    def __init__(self, cell=2.0):
+        """
+        Args:
+            cell (float, optional): side of the grid cells, at least the longest range a plate
+            is seen from. Defaults to 2.0.
+        """
+        self.cell = cell
+        self.plates = []
+        self.stats = {'lookups': 0, 'checked': 0}
+        self._grid = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self.plates)
+
+    def _key(self, x, y):
+        return int(math.floor(x / self.cell)), int(math.floor(y / self.cell))
+
+    def add(self, x, y, seen_range, views=0):
+        """
+        Args:
+            x (float): plate position
+            y (float): plate position
+            seen_range (float): farthest distance the plate was seen from
+            views (int, optional): number of views it was located from. Defaults to 0.
+        """
+        if seen_range > self.cell:
+            raise ValueError('plate seen from {:.2f}, further than the grid cell {:.2f}'.format(seen_range, self.cell))
+        self.plates.append({'x': float(x), 'y': float(y), 'range': float(seen_range), 'views': int(views)})
+        self._grid[self._key(x, y)].append(len(self.plates) - 1)
+
+    def near(self, x, y):
+        """
+        Args:
+            x (float): position
+            y (float): position
+
+        Returns:
+            list: indices of the plates in the cells around the position
+        """
+        cx, cy = self._key(x, y)
+        return [i for dx in (-1, 0, 1) for dy in (-1, 0, 1) for i in self._grid.get((cx + dx, cy + dy), ())]
+
+    def in_view(self, x, y, heading, fov=CAMERA_FOV, margin=math.radians(10), slack=1.25):
+        """Plates the camera of a robot at a pose should see
+
+        Args:
+            x (float): robot position
+            y (float): robot position
+            heading (float): robot heading in radians
+            fov (float, optional): horizontal field of view of the camera. Defaults to CAMERA_FOV.
+            margin (float, optional): extra angle on each side of the field of view, for odometry
+            error. Defaults to 10 degrees.
+            slack (float, optional): plates are expected up to this times the range they were
+            seen from, which must stay within a grid cell. Defaults to 1.25.
+
+        Returns:
+            list: indices of the plates in view
+        """
+        self.stats['lookups'] += 1
+        found = []
+        for i in self.near(x, y):
+            p = self.plates[i]
+            self.stats['checked'] += 1
+            dx, dy = p['x'] - x, p['y'] - y
+            if math.hypot(dx, dy) <= slack * p['range'] and \
+                    abs(wrap_angle(math.atan2(dy, dx) - heading)) <= fov / 2 + margin:
+                found.append(i)
+        return found
+
+    def save(self, path):
+        """
+        Args:
+            path (str): JSON file written
+        """
+        with open(path, 'w') as f:
+            json.dump({'cell': self.cell, 'plates': self.plates}, f, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Args:
+            path (str): JSON file written by save
+
+        Returns:
+            PlateMap: the map
+        """
+        with open(path) as f:
+            data = json.load(f)
+        plate_map = cls(data['cell'])
+        for p in data['plates']:
+            plate_map.add(p['x'], p['y'], p['range'], p.get('views', 0))
+        return plate_map
+
+def build_map(views, max_distance=6, merge_distance=0.5, min_views=3, cell=None):
+    """Locates plates from the rays the camera saw them along. Views are grouped by plate with
+    a PlateIndex of their hashes, each group's rays are triangulated and groups that land
+    within merge_distance of each other, the same plate whose hash changed with distance, are
+    merged.
+
+    Args:
+        views (list): (x, y, angle, hash) of every plate seen: the robot position, the direction
+        of the plate from it in radians (heading plus view_bearing) and the plate hash
+        max_distance (int, optional): largest hash distance within a group. Defaults to 6.
+        merge_distance (float, optional): groups located closer are one plate. Defaults to 0.5.
+        min_views (int, optional): fewest views a plate is located from. Defaults to 3.
+        cell (float, optional): grid cell of the map. Defaults to 1.5 times the longest range a
+        plate was seen from, leaving room for PlateMap.in_view's slack.
+
+    Returns:
+        PlateMap: the located plates
+    """
+    from ldriver.licence.identity import PlateIndex
+    index, groups = PlateIndex(max_distance), collections.defaultdict(list)
+    for x, y, angle, h in views:
+        groups[index.group(h)[0]].append((x, y, angle))
+
+    def locate(rays):
+        rays = np.float64(rays)
+        return triangulate(rays[:, :2], rays[:, 2]) if len(rays) >= min_views else None
+
+    plates = []
+    for rays in groups.values():
+        pt = locate(rays)
+        if pt is None:
+            continue
+        for plate in plates:
+            if np.hypot(*(plate[0] - pt)) <= merge_distance:
+                plate[1].extend(rays)
+                merged = locate(plate[1])
+                plate[0] = plate[0] if merged is None else merged
+                break
+        else:
+            plates.append([pt, list(rays)])
+
+    ranges = [np.hypot(*(np.float64(rays)[:, :2] - pt).T).max() for pt, rays in plates]
+    plate_map = PlateMap(cell if cell is not None else 1.5 * max(ranges + [1.0]))
+    for (pt, rays), seen_range in zip(plates, ranges):
+        plate_map.add(pt[0], pt[1], seen_range, len(rays))
+    return plate_map
+
+def main():
+    import cv2
+    from ldriver.licence.detection import LicencePlate
+    from ldriver.licence.quality import plate_corners
+    parser = argparse.ArgumentParser(description='Build the plate map from frames recorded by img_cmd.py')
+    parser.add_argument('--data', default='img_cmd_data', help='directory with commands.json and the frames')
+    parser.add_argument('--out', default='plate_map.json', help='map file written')
+    parser.add_argument('--fov', type=float, default=math.degrees(CAMERA_FOV), help='camera field of view in degrees')
+    parser.add_argument('--merge', type=float, default=0.5, help='distance under which plates are merged')
+    parser.add_argument('--min-views', type=int, default=3, help='fewest views a plate is located from')
+    args = parser.parse_args()
+
+    with open('{}/commands.json'.format(args.data)) as f:
+        records = sorted(json.load(f).items(), key=lambda r: int(r[0]))
+    states = [r[1]['state'] for r in records]
+    moved = motion_headings([(s['x'], s['y']) for s in states])
+    views = []
+    for (img_id, _), state, heading in zip(records, states, moved):
+        img = cv2.imread('{}/{}.png'.format(args.data, img_id))
+        if img is None:
+            continue
+        # Recordings made before img_cmd.py saved the heading fall back to the direction of travel
+        heading = state.get('yaw', heading)
+        for lp in LicencePlate.find_all(img, engine='components'):
+            if lp.valid:
+                bearing = view_bearing(plate_corners(lp.M)[:, 0].mean(), img.shape[1], math.radians(args.fov))
+                views.append((state['x'], state['y'], heading + bearing, lp.hash))
+    plate_map = build_map(views, merge_distance=args.merge, min_views=args.min_views)
+    plate_map.save(args.out)
+    print('{} plates located from {} views in {} frames, saved to {}'.format(len(plate_map), len(views),
+        len(records), args.out))
+    for p in plate_map.plates:
+        print('  ({x:.2f}, {y:.2f}) seen up to {range:.2f} away, {views} views'.format(**p))
+
+if __name__ == '__main__':
+    main()
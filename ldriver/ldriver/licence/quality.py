@@ -0,0 +1,128 @@
+import collections
+import cv2
+import numpy as np
+
+from ldriver.licence import geometry
+from ldriver.licence.identity import HASH_BAND
+
+def plate_blur(frame, M, band=HASH_BAND, size=(150, 72)):
+    """Sharpness of the letters of a licence, the variance of the Laplacian (see
+    detection.measure_blur) of the letter band warped straight from the camera frame at a fixed
+    size. Unlike the Laplacian of the whole frame it only looks at the plate, and it costs the
+    same small amount for every plate.
+
+    Args:
+        frame (numpy.ndarray): BGR camera frame
+        M (numpy.ndarray): perspective transform from frame to the warped licence
+        band (tuple, optional): measured region of the warped licence. Defaults to HASH_BAND.
+        size (tuple, optional): (w, h) the band is warped to. Defaults to (150, 72).
+
+    Returns:
+        float: variance of the Laplacian, higher is sharper
+    """
+    x1, y1, x2, y2 = band
+    w, h = size
+    S = np.float64([[w / float(x2 - x1), 0, -x1 * w / float(x2 - x1)],
+                    [0, h / float(y2 - y1), -y1 * h / float(y2 - y1)],
+                    [0, 0, 1]])
+    img = cv2.warpPerspective(frame, S.dot(M), (w, h))
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return float(cv2.Laplacian(img, cv2.CV_32F).var())
+
+def plate_corners(M, size=(300, 300)):
+    """
+    Args:
+        M (numpy.ndarray): perspective transform from the camera frame to the warped licence
+        size (tuple, optional): (w, h) of the warped licence. Defaults to (300, 300).
+
+    Returns:
+        numpy.ndarray: (4, 2) licence corners in the frame, clockwise on screen from the top left
+    """
+    w, h = size
+    pts = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    return cv2.perspectiveTransform(pts[None], np.linalg.inv(M))[0].astype(np.float64)
+
+def plate_skew(corners):
+    """
+    Args:
+        corners (numpy.ndarray): (4, 2) licence corners in order around the plate
+
+    Returns:
+        float: ratio of the shorter to the longer of each pair of opposite sides, multiplied,
+        1 for a plate seen straight on
+    """
+    sides = np.hypot(*(np.roll(corners, -1, axis=0) - corners).T)
+    ratios = np.minimum(sides[:2], sides[2:]) / np.maximum(np.maximum(sides[:2], sides[2:]), 1e-6)
+    return float(ratios.prod())
+
+def plate_quality(M, blur, blur_ref=200.0, area_ref=20000.0):
+    """Scores how readable a licence is likely to be from its sharpness, its apparent size and
+    how obliquely it is seen. Each term is scaled to [0, 1] and the terms are multiplied, so a
+    plate has to be good on all three to score well.
+
+    Args:
+        M (numpy.ndarray): perspective transform from the camera frame to the warped licence
+        blur (float): sharpness of the licence, see plate_blur
+        blur_ref (float, optional): sharpness from which letters are crisp. Defaults to 200.0.
+        area_ref (float, optional): area in pixels from which a licence is close enough to be
+        read reliably. Defaults to 20000.0.
+
+    Returns:
+        float: score in [0, 1]
+    """
+    corners = plate_corners(M)
+    area = abs(float(geometry.polygon_area(corners)))
+    return min(blur / blur_ref, 1.0) * min(area / area_ref, 1.0) * plate_skew(corners)
+
+class QualityGate(object):
+    """Decides which plate views are worth reading. A view is read only if it scores at least
+    min_score and is among the keep best of the last window views, so once a plate has been
+    seen well the worse views that follow, blurred by a turn or seen while driving away, are
+    skipped. If no view was read for a whole window, the best view of the window is read
+    whatever its score, so a plate that is only ever seen poorly is still read now and then.
+
+    The window is not split by plate: plate hashes of small, blurred views, the ones the gate
+    is for, are not stable enough to tell plates apart. Views of committed plates should not
+    reach the gate, so the window mostly holds the plates still being read.
+
+    Attributes:
+        stats (dict): views 'scored', 'admitted', rejected as 'low' quality and 'outranked' by
+        recent views
+    """
+    def __init__(self, window=8, keep=3, min_score=0.4):
+        """
+        Args:
+            window (int, optional): recent views a view is ranked against. Defaults to 8.
+            keep (int, optional): best views of the window that are read. Defaults to 3.
+            min_score (float, optional): lowest score read, see plate_quality. Defaults to 0.4.
+        """
+        self.window = window
+        self.keep = keep
+        self.min_score = min_score
+        self.stats = {'scored': 0, 'admitted': 0, 'low': 0, 'outranked': 0}
+        self._scores = collections.deque(maxlen=window)
+        self._unread = 0
+
+    def admit(self, score):
+        """Records a plate view and decides whether to read it
+
+        Args:
+            score (float): quality of the view, see plate_quality
+
+        Returns:
+            bool: True if the view should be read
+        """
+        better = sum(s > score for s in self._scores)
+        self._scores.append(score)
+        self._unread += 1
+        self.stats['scored'] += 1
+        if score < self.min_score and (self._unread < self.window or better):
+            self.stats['low'] += 1
+            return False
+        if better >= self.keep:
+            self.stats['outranked'] += 1
+            return False
+        self._unread = 0
+        self.stats['admitted'] += 1
+        return True
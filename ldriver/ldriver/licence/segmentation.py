@@ -0,0 +1,143 @@
+import cv2
+import numpy as np
+
+def profile_runs(profile, min_value):
+    """Finds the runs of a projection profile that reach min_value
+
+    Args:
+        profile (numpy.ndarray): 1D projection profile
+        min_value (number): smallest value counted as part of a run
+
+    Returns:
+        numpy.ndarray: start index of each run
+        numpy.ndarray: end index (exclusive) of each run
+    """
+    on = np.concatenate(([False], profile >= min_value, [False]))
+    edges = np.flatnonzero(on[1:] != on[:-1])
+    return edges[0::2], edges[1::2]
+
+def ink_mask(band):
+    """Separates characters from the plate background of a colour crop. Black characters are
+    darker than the grey plate and blue ones are bluer, so each pixel is scored by the larger of
+    its darkness and its blueness, both taken relative to the median of the crop, which is the
+    plate. The score is split with Otsu's threshold. Unlike the darkness alone it does not mark
+    the shaded plate around blurred blue letters as ink.
+
+    Args:
+        band (numpy.ndarray): BGR crop of a row of characters
+
+    Returns:
+        numpy.ndarray: boolean mask, True on characters
+    """
+    b, g, r = cv2.split(band)
+    dark = cv2.subtract(255, cv2.max(cv2.max(b, g), r))
+    blue = cv2.subtract(b, cv2.min(g, r))
+    score = cv2.max(cv2.subtract(dark, int(np.median(dark))), cv2.subtract(blue, int(np.median(blue))))
+    _, ink = cv2.threshold(score, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return ink.view(bool)
+
+def split_runs(profile, starts, ends, centres):
+    """Matches column runs to the nominal character centres. Runs holding no centre, such as the
+    dash between the letters and digits, are dropped, and a run holding several, touching
+    characters, is cut at the lowest column of the profile between each pair of centres.
+
+    Args:
+        profile (numpy.ndarray): column projection profile
+        starts (numpy.ndarray): start index of each run
+        ends (numpy.ndarray): end index (exclusive) of each run
+        centres (numpy.ndarray): nominal centre column of each character, in increasing order
+
+    Returns:
+        numpy.ndarray: start index of each character run
+        numpy.ndarray: end index (exclusive) of each character run
+    """
+    cuts = []
+    for a, b in zip(centres[:-1], centres[1:]):
+        # The cut leaves each centre on its own side
+        lo, hi = int(np.floor(a)) + 1, int(np.floor(b))
+        if lo <= hi and np.any((starts <= a) & (ends > b)):
+            cuts.append(lo + int(np.argmin(profile[lo:hi + 1])))
+    cuts = np.array(cuts, starts.dtype)
+    bounds = np.sort(np.concatenate((starts, ends, cuts, cuts)))
+    starts, ends = bounds[0::2], bounds[1::2]
+    held = (starts[:, None] <= centres) & (ends[:, None] > centres)
+    keep = held.any(axis=1)
+    return starts[keep], ends[keep]
+
+def segment_row(ink, boxes, min_ink=3, min_width=3, min_height=0.5):
+    """Locates the characters of a row from the column and row projection profiles of its ink
+    mask. Column runs touching the sides of the mask are dropped, the others are matched to the
+    nominal boxes (see split_runs), and runs much shorter than the tallest one are dropped.
+
+    Args:
+        ink (numpy.ndarray): boolean mask of a row of characters
+        boxes (numpy.ndarray): (N, 4) nominal character boxes [x1, x2, y1, y2] in ink coordinates
+        min_ink (int, optional): ink pixels a column needs to be part of a character. Defaults to 3.
+        min_width (int, optional): narrowest character in pixels. Defaults to 3.
+        min_height (float, optional): shortest character as a fraction of the tallest. Defaults to 0.5.
+
+    Returns:
+        numpy.ndarray: (N, 4) character boxes [x1, x2, y1, y2] in ink coordinates, None if the
+        profiles do not show exactly one character per box
+    """
+    count = len(boxes)
+    profile = np.count_nonzero(ink, axis=0)
+    starts, ends = profile_runs(profile, min_ink)
+    keep = (starts > 0) & (ends < ink.shape[1])
+    starts, ends = split_runs(profile, starts[keep], ends[keep], (boxes[:, 0] + boxes[:, 1]) / 2.0)
+    keep = ends - starts >= min_width
+    starts, ends = starts[keep], ends[keep]
+    if starts.size < count:
+        return None
+
+    # Row profile of every run at once: OR the columns between each start and end
+    rows = np.logical_or.reduceat(ink, np.ravel(np.column_stack((starts, ends))), axis=1)[:, ::2]
+    top = np.argmax(rows, axis=0)
+    bottom = ink.shape[0] - np.argmax(rows[::-1], axis=0)
+    height = bottom - top
+    tall = height >= min_height * height.max()
+    if np.count_nonzero(tall) != count:
+        return None
+    return np.column_stack((starts, ends, top, bottom))[tall]
+
+def matches_boxes(glyphs, boxes, max_shift=0.5, max_width=1.1):
+    """Checks that located characters are where the nominal letter boxes expect them, which
+    rejects merged or split characters that happen to give the right count
+
+    Args:
+        glyphs (numpy.ndarray): (N, 4) character boxes [x1, x2, y1, y2]
+        boxes (numpy.ndarray): (N, 4) nominal letter boxes [x1, x2, y1, y2], same coordinates
+        max_shift (float, optional): largest centre offset as a fraction of the box width. Defaults to 0.5.
+        max_width (float, optional): widest character as a fraction of the box width, a little
+        over 1 as touching characters are cut with a sliver of their neighbour. Defaults to 1.1.
+
+    Returns:
+        bool: True if every character is within max_shift of its box centre and no wider than
+        max_width of it
+    """
+    w = boxes[:, 1] - boxes[:, 0]
+    shift = np.abs((glyphs[:, 0] + glyphs[:, 1]) - (boxes[:, 0] + boxes[:, 1])) / 2.0
+    return bool(np.all(shift <= max_shift * w) and np.all(glyphs[:, 1] - glyphs[:, 0] <= max_width * w))
+
+def centre_boxes(glyphs, boxes, shape, slack=0.05):
+    """Moves fixed size letter boxes onto the located characters, keeping them inside the row.
+    Offsets within slack of the box size are left alone, as the nominal boxes are already
+    centred when the licence corners are right and the located character is often lopsided.
+
+    Args:
+        glyphs (numpy.ndarray): (N, 4) character boxes [x1, x2, y1, y2]
+        boxes (numpy.ndarray): (N, 4) nominal letter boxes [x1, x2, y1, y2], same coordinates
+        shape (tuple): shape of the row image
+        slack (float, optional): offset ignored as a fraction of the box size. Defaults to 0.05.
+
+    Returns:
+        numpy.ndarray: (N, 4) letter boxes the size of boxes centred on glyphs
+    """
+    w, h = boxes[:, 1] - boxes[:, 0], boxes[:, 3] - boxes[:, 2]
+    dx = (glyphs[:, 0] + glyphs[:, 1] - boxes[:, 0] - boxes[:, 1]) // 2
+    dy = (glyphs[:, 2] + glyphs[:, 3] - boxes[:, 2] - boxes[:, 3]) // 2
+    dx = np.sign(dx) * np.maximum(np.abs(dx) - np.int32(slack * w), 0)
+    dy = np.sign(dy) * np.maximum(np.abs(dy) - np.int32(slack * h), 0)
+    x1 = np.clip(boxes[:, 0] + dx, 0, shape[1] - w)
+    y1 = np.clip(boxes[:, 2] + dy, 0, shape[0] - h)
+    return np.column_stack((x1, x1 + w, y1, y1 + h))
@@ -0,0 +1,232 @@
+"""Shared licence OCR service.
+
+One process loads the letter model and serves every node over a Unix socket, batching the
+licences of all clients together. Start it with e.g.:
+
+    python -m ldriver.licence.service --engine numpy
+
+and use OCRClient wherever a LicenceOCR was used.
+"""
+from __future__ import print_function
+import argparse
+import os
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+from ldriver.licence.batching import MicroBatcher
+from ldriver.licence.ocr import LicenceOCR
+
+DEFAULT_SOCKET = '/tmp/ldriver_ocr.sock'
+# Request: letter count then uint8 letter images. Response: letter and class counts then
+# float32 class probabilities
+HEADER = struct.Struct('!I')
+RESPONSE_HEADER = struct.Struct('!II')
+
+def recv_exactly(conn, n):
+    """
+    Args:
+        conn (socket.socket): connected socket
+        n (int): number of bytes to read
+
+    Returns:
+        bytearray: the bytes, None if the connection closed first
+    """
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = conn.recv_into(view[got:], n - got)
+        if not k:
+            return None
+        got += k
+    return buf
+
+class OCRServer(object):
+    """Owns one LicenceOCR and answers letter batches from any number of clients. The licences
+    of every client go through one MicroBatcher so concurrent requests share inference calls.
+
+    Attributes:
+        stats (dict): number of 'clients' served and 'requests' answered
+    """
+    def __init__(self, ocr, path=DEFAULT_SOCKET, max_batch=8, max_wait_ms=10, timeout=30):
+        """
+        Args:
+            ocr (LicenceOCR): loaded OCR
+            path (str, optional): Unix socket path. Defaults to DEFAULT_SOCKET.
+            max_batch (int, optional): most licences per inference call. Defaults to 8.
+            max_wait_ms (float, optional): longest a licence waits for others. Defaults to 10.
+            timeout (float, optional): seconds a request waits for its licences to be read
+            before its connection is closed. Defaults to 30.
+        """
+        self.ocr = ocr
+        self.path = path
+        self.timeout = timeout
+        self.letters = 6
+        self.batcher = MicroBatcher(self._predict, max_batch, max_wait_ms, self.letters, ocr.img_shape)
+        self.stats = {'clients': 0, 'requests': 0}
+        self._sock = None
+
+    def _predict(self, batch):
+        probs = self.ocr.predict(batch)
+        return [(probs[i:i+self.letters],) for i in range(0, probs.shape[0], self.letters)]
+
+    def serve_forever(self):
+        """Accepts clients until close is called, each on its own thread"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(8)
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            self.stats['clients'] += 1
+            handler = threading.Thread(target=self._handle, args=(conn,), name='ocr-client')
+            handler.daemon = True
+            handler.start()
+
+    def close(self):
+        """Stops accepting clients, finishes queued licences and removes the socket"""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        self.batcher.close()
+
+    def _handle(self, conn):
+        h, w, c = self.ocr.img_shape
+        size = h * w * c
+        try:
+            while True:
+                header = recv_exactly(conn, HEADER.size)
+                if header is None:
+                    return
+                n, = HEADER.unpack(bytes(header))
+                data = recv_exactly(conn, n * size)
+                if data is None:
+                    return
+                if n % self.letters:
+                    raise ValueError('requests must hold whole licences of {} letters'.format(self.letters))
+                letters = np.float32(np.frombuffer(data, np.uint8).reshape(n, h, w, c))
+                conn.sendall(self._answer(letters))
+                self.stats['requests'] += 1
+        finally:
+            conn.close()
+
+    def _answer(self, letters):
+        """Reads the licences of one request through the shared batcher and encodes the reply.
+        Raises if a licence could not be read in time, which closes the client's connection."""
+        parts = letters.shape[0] // self.letters
+        results = [None] * parts
+        done = threading.Event()
+        remaining = [parts]
+        errors = []
+        lock = threading.Lock()
+
+        def fail(e):
+            errors.append(e)
+            done.set()
+
+        def collect(i, probs):
+            results[i] = probs
+            with lock:
+                remaining[0] -= 1
+                if not remaining[0]:
+                    done.set()
+
+        if not parts:
+            done.set()
+        for i in range(parts):
+            self.batcher.submit_letters(letters[i*self.letters:(i+1)*self.letters],
+                lambda probs, i=i: collect(i, probs), fail)
+        if not done.wait(self.timeout):
+            raise RuntimeError('licences not read within {}s'.format(self.timeout))
+        if errors:
+            raise errors[0]
+        probs = np.concatenate(results) if parts else np.zeros((0, 0), np.float32)
+        return RESPONSE_HEADER.pack(*probs.shape) + np.float32(probs).tobytes()
+
+class OCRClient(LicenceOCR):
+    """LicenceOCR that sends its letters to an OCRServer instead of loading a model, so every
+    LicenceOCR method (read_licence, read_licences, read_letters, decode...) works unchanged
+    """
+    def __init__(self, path=DEFAULT_SOCKET, vtesting=False, experimental=False, connect_timeout=30):
+        """
+        Args:
+            path (str, optional): Unix socket of the server. Defaults to DEFAULT_SOCKET.
+            vtesting (bool, optional): see LicenceOCR. Defaults to False.
+            experimental (bool, optional): see LicenceOCR. Defaults to False.
+            connect_timeout (float, optional): seconds to keep retrying while the server starts. Defaults to 30.
+        """
+        self.vtest = vtesting
+        self.exper = experimental
+        self.engine = 'service'
+        self.path = path
+        self._lock = threading.Lock()
+        deadline = time.time() + connect_timeout
+        while True:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self._sock.connect(path)
+                break
+            except socket.error:
+                self._sock.close()
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def predict(self, batch):
+        """Runs the server's CNN on a batch of whole licences
+
+        Args:
+            batch (numpy.ndarray): (6 * licences, 50, 50, 1) letter images
+
+        Returns:
+            numpy.ndarray: (N, len(ALL_LETTERS)) class probabilities
+        """
+        # Letters are binarised 0-255 images, uint8 carries them exactly at a quarter of the size
+        letters = np.uint8(np.clip(np.rint(batch), 0, 255))
+        with self._lock:
+            self._sock.sendall(HEADER.pack(letters.shape[0]) + letters.tobytes())
+            header = recv_exactly(self._sock, RESPONSE_HEADER.size)
+            if header is None:
+                raise socket.error('OCR server closed the connection')
+            n, classes = RESPONSE_HEADER.unpack(bytes(header))
+            data = recv_exactly(self._sock, n * classes * 4)
+        return np.frombuffer(data, np.float32).reshape(n, classes)
+
+    def close(self):
+        """Disconnects from the server"""
+        self._sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--engine', default='numpy')
+    parser.add_argument('--model', default='best_letters_2.h5')
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    parser.add_argument('--cache-size', type=int, default=0,
+        help='letters whose results are cached, keep 0 for clients that fuse readings over frames')
+    args = parser.parse_args()
+
+    ocr = LicenceOCR(engine=args.engine, model=args.model, cache_size=args.cache_size)
+    ocr.warm_up()
+    server = OCRServer(ocr, args.socket, args.max_batch, args.max_wait_ms)
+    print('serving licence OCR on {}'.format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        print('batches: {}, requests: {}'.format(server.batcher.stats, server.stats))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import cv2
+import numpy as np
+
+from ldriver.licence import geometry
+from ldriver.licence.detection import LicencePlate, locate_plate, padded_roi, plate_transform, LICENCE_SIZE
+
+class Track(object):
+    """Corner state of one tracked plate
+
+    Attributes:
+        corners (numpy.ndarray): last measured corners, [tl, bl, tr, br]
+        velocity (numpy.ndarray): smoothed corner motion in pixels per frame
+    """
+    __slots__ = ('corners', 'velocity', 'M', 'M_corners')
+
+    def __init__(self, corners):
+        self.corners = corners
+        self.velocity = np.zeros((4, 2))
+        self.M = None
+        self.M_corners = None
+
+    def predict(self):
+        return self.corners + self.velocity
+
+    def update(self, corners, smoothing):
+        self.velocity = smoothing * (corners - self.corners) + (1 - smoothing) * self.velocity
+        self.corners = corners
+
+class PlateTracker(object):
+    """Follows licence plates across consecutive camera frames. The corners of each plate are
+    predicted with a constant velocity model and only a padded region around the prediction is
+    searched. When a plate is not found there, or every full_every frames so new plates are
+    picked up, the whole frame is searched again.
+
+    Attributes:
+        tracks (list): Track for each plate currently followed, largest plate first
+        stats (dict): number of 'roi' searches, 'full' searches, 'lost' tracks and 'reused' warps
+    """
+    def __init__(self, engine='contours', scale=1, pad=0.25, min_pad=16, smoothing=0.5, reuse_thresh=1.0,
+            full_every=10):
+        """
+        Args:
+            engine (str, optional): rectangle detector, a key of RECT_ENGINES. Defaults to 'contours'.
+            scale (int, optional): pyramid downscale factor for full frame searches. Defaults to 1.
+            pad (float, optional): ROI padding as a fraction of the plate size. Defaults to 0.25.
+            min_pad (int, optional): minimum ROI padding in pixels. Defaults to 16.
+            smoothing (float, optional): weight of the newest motion in the velocity. Defaults to 0.5.
+            reuse_thresh (float, optional): corner motion in pixels under which the previous
+            perspective transform is reused. Defaults to 1.0.
+            full_every (int, optional): frames between full searches while tracking. Defaults to 10.
+        """
+        self.engine = engine
+        self.scale = scale
+        self.pad = pad
+        self.min_pad = min_pad
+        self.smoothing = smoothing
+        self.reuse_thresh = reuse_thresh
+        self.full_every = full_every
+        self.stats = {'roi': 0, 'full': 0, 'lost': 0, 'reused': 0}
+        self.reset()
+
+    def reset(self):
+        """Forgets every track"""
+        self.tracks = []
+        self._since_full = 0
+
+    @property
+    def corners(self):
+        """numpy.ndarray: corners of the largest tracked plate, None when nothing is tracked"""
+        return self.tracks[0].corners if self.tracks else None
+
+    def predict(self):
+        """
+        Returns:
+            numpy.ndarray: expected corners of the largest plate in the next frame, None when
+            there is no track
+        """
+        return self.tracks[0].predict() if self.tracks else None
+
+    def _search_roi(self, image, track):
+        predicted = track.predict()
+        size = predicted.max(axis=0) - predicted.min(axis=0)
+        pad = int(max(self.min_pad, self.pad * size.max()) + np.abs(track.velocity).max())
+        x0, y0, x1, y1 = padded_roi(predicted, image.shape, pad)
+        pts = locate_plate(image[y0:y1, x0:x1], self.engine)
+        self.stats['roi'] += 1
+        return pts + np.int32([x0, y0]) if pts.shape[0] else pts
+
+    def _search_full(self, image, stats):
+        plates = LicencePlate.locate_licences(image, self.engine, self.scale, stats)
+        self.stats['full'] += 1
+        self._since_full = 0
+        measured = [geometry.order_corners(np.float64(pts)) for pts in plates]
+
+        # Keep following the track closest to each plate
+        tracks, unmatched = [], list(self.tracks)
+        for corners in measured:
+            centre = corners.mean(axis=0)
+            dists = [np.linalg.norm(t.predict().mean(axis=0) - centre) for t in unmatched]
+            size = np.abs(corners[3] - corners[0]).max()
+            if dists and min(dists) < size:
+                track = unmatched.pop(int(np.argmin(dists)))
+                track.update(corners, self.smoothing)
+            else:
+                track = Track(corners)
+            tracks.append(track)
+        self.stats['lost'] += len(unmatched)
+        self.tracks = tracks
+
+    def locate_all(self, image, stats=None):
+        """Finds the corners of every tracked plate, searching around their predicted positions
+
+        Args:
+            image (numpy.ndarray): camera frame
+            stats (dict, optional): rejections per stage of full frame searches. Defaults to None.
+
+        Returns:
+            list: ordered corners of each plate, largest first
+            list: perspective transform from the frame to each licence
+        """
+        self._since_full += 1
+        found = bool(self.tracks) and self._since_full < self.full_every
+        if found:
+            measured = [self._search_roi(image, t) for t in self.tracks]
+            found = all(pts.shape[0] for pts in measured)
+            if found:
+                for t, pts in zip(self.tracks, measured):
+                    t.update(geometry.order_corners(np.float64(pts)), self.smoothing)
+        if not found:
+            self._search_full(image, stats)
+        return [t.corners for t in self.tracks], [self._transform(t) for t in self.tracks]
+
+    def locate(self, image, stats=None):
+        """Finds the corners of the largest plate, see locate_all
+
+        Returns:
+            numpy.ndarray: ordered corners, empty array if not found
+        """
+        corners, _ = self.locate_all(image, stats)
+        return corners[0] if corners else np.array([])
+
+    def _transform(self, track):
+        """Perspective transform from the plate corners to the licence image, reusing the
+        previous one when the corners have barely moved
+        """
+        if track.M is not None and np.abs(track.corners - track.M_corners).max() < self.reuse_thresh:
+            self.stats['reused'] += 1
+            return track.M
+        track.M = plate_transform(track.corners)
+        track.M_corners = track.corners
+        return track.M
+
+    def transform(self, pts):
+        """Perspective transform for the tracked plate at pts
+
+        Args:
+            pts (numpy.ndarray): ordered plate corners returned by locate
+
+        Returns:
+            numpy.ndarray: 3x3 perspective transform
+        """
+        for t in self.tracks:
+            if t.corners is pts:
+                return self._transform(t)
+        return plate_transform(pts)
+
+    def find_licence(self, image):
+        """Tracking replacement for LicencePlate.find_licence
+
+        Args:
+            image (numpy.ndarray): camera frame
+
+        Returns:
+            bool: True if a licence was found
+            numpy.ndarray: extracted licence image, None if not found
+        """
+        pts = self.locate(image)
+        if not pts.shape[0]:
+            return False, None
+        return True, cv2.warpPerspective(image, self.transform(pts), LICENCE_SIZE)
@@ -342,6 +342,11 @@ if __name__ == "__main__":
     start_msg, end_msg = String(), String()
     start_msg.data, end_msg.data = format_message(0,"0000"), format_message(-1,"0000")
     timer_pub = rospy.Publisher("/license_plate", String, queue_size=1)
+    # Wait for the licence node to be able to read plates before driving off
+    try:
+        rospy.wait_for_message("/licence_ready", Bool, timeout=15)
+    except rospy.ROSException:
+        rospy.logwarn("licence OCR not ready, starting anyway")
     rospy.sleep(0.5)
     timer_pub.publish(start_msg)
 
@@ -1,74 +1,157 @@
 #!/usr/bin/env python2
 from ldriver.licence.detection import LicencePlate
+from ldriver.licence.batching import MicroBatcher
+from ldriver.licence.fusion import PlateFusion
+from ldriver.licence.identity import PlateIndex
+from ldriver.licence.ocr import ALL_LETTERS
+from ldriver.licence.pipeline import DetectionPipeline
+from ldriver.licence.plate_map import PlateMap, track_pose
+from ldriver.licence.quality import QualityGate
 import cv2
-from matplotlib.pyplot import imshow
+import threading
+import time
 from cv_bridge import CvBridge
 from sensor_msgs.msg import Image
+from nav_msgs.msg import Odometry
 import rospy
-from ldriver.licence.ocr import LicenceOCR
 import numpy as np
-from itertools import starmap
-from std_msgs.msg import String, Int16
+from std_msgs.msg import String, Int16, Bool
 from scoring import TEAM_NAME, TEAM_PWD
 
 HOR_LINE = '-' * 30
 
 class LicenceDetector:
-    def __init__(self):
-        self.best = {}
+    def __init__(self, max_batch=4, max_wait_ms=20, processes=None, max_frames=2, margin=8.0, min_frames=2,
+            min_quality=0.4, quality_window=8, quality_keep=3, idle_stride=3, plate_map=None, background_stride=10,
+            max_unseen=10, max_age=3.0):
+        # Readings of each plate are fused over frames until they are certain enough to publish,
+        # or until the plate is left behind
+        self.fusion = PlateFusion(ALL_LETTERS, margin=margin, min_frames=min_frames, max_unseen=max_unseen,
+            max_age=max_age)
+        self.fusion_lock = threading.Lock()
+        # Appearance of committed plates, their frames skip letter extraction and OCR
+        self.registry = PlateIndex()
+        self.registry_lock = threading.Lock()
+        self.views = {}
+        self.skipped = 0
+        # Only the best views of each plate are read, blurred and distant ones are left out
+        self.gate = QualityGate(window=quality_window, keep=quality_keep, min_score=min_quality)
+        # With a map of the plates, the odometry pose tells when a plate should be in view
+        self.plate_map = plate_map
+        self.pose = None
+        # Camera frames are detected on worker processes, only the newest max_frames wait. Fewer
+        # frames are detected while no plate is in sight
+        self.pipeline = DetectionPipeline(self.handle_plates, processes=processes, maxlen=max_frames,
+            known=self.known_plates, idle_stride=idle_stride, background_stride=background_stride,
+            expected=self.plate_expected if plate_map is not None else None)
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        # Set once the OCR is loaded and warm, frames before that only get detection
+        self.ocr = None
+        self.batcher = None
+
+    def load_ocr(self, ready_pub):
+        """Loads and warms up the OCR, then starts reading plates and announces it on ready_pub.
+        Run on a background thread so frames are processed while it loads.
+        """
+        start = time.time()
+        # With ~ocr_socket set, plates are read by a shared ldriver.licence.service process
+        socket_path = rospy.get_param('~ocr_socket', None)
+        if socket_path:
+            from ldriver.licence.service import OCRClient
+            ocr = OCRClient(socket_path)
+        else:
+            from ldriver.licence.ocr import LicenceOCR
+            # No result cache: a hit would be fused again as if it were a new reading
+            ocr = LicenceOCR(cache_size=0)
+        loaded = time.time()
+        ocr.warm_up()
+        rospy.loginfo('licence OCR ready: import and load {:.2f}s, warm up {:.2f}s'.format(
+            loaded - start, time.time() - loaded))
+        self.ocr = ocr
+        # Plates from consecutive frames are read together, results arrive in record
+        self.batcher = MicroBatcher(lambda batch: [(probs,) for probs in ocr.read_probs(batch)],
+            max_batch=self.max_batch, max_wait_ms=self.max_wait_ms)
+        ready_pub.publish(Bool(True))
 
     def process_image(self, data):
-        cv_img = bridge.imgmsg_to_cv2(data, desired_encoding='bgr8')
-        lp = LicencePlate(cv_img) 
-        if not lp.valid:
+        self.pipeline.put(bridge.imgmsg_to_cv2(data, desired_encoding='bgr8'))
+
+    def process_odom(self, data):
+        self.pose = track_pose(data.pose.pose)
+
+    def plate_expected(self):
+        """A plate of the map should be in view, or the pose is not known yet"""
+        pose = self.pose
+        return pose is None or bool(self.plate_map.in_view(*pose))
+
+    def handle_plates(self, seq, stamp, frame, plates):
+        """Shows and reads the plates of a frame, called in frame order by the pipeline"""
+        if not plates:
             return
 
-        cv2.imshow('plate', lp.img)
+        cv2.imshow('plate', np.hstack([lp.img for lp in plates]))
         cv2.waitKey(1)
-        preds, conf = locr.read_licence(lp)
-        p_space = preds[1]
-        def publish_to_scoring(id):
-            pred_str = ''.join(self.best[id]['pred'])
-            publish_scoring(plate_id=p_space, plate_num=pred_str[-4:])
-        
-        # Replace old letter predictions if new predictions have a higher confidence
-        if p_space in self.best:
-            if np.all((conf < self.best[p_space]['conf'])):
-                print('less confidence')
-            elif preds == self.best[p_space]['pred']:
-                print('same prediction')
-            else:
-                prev = self.best[p_space]
-                # Print confidence
-                print('comparing {} to {}'.format(prev['pred'], preds))
-                print('comparing {} to {}'.format(prev['conf'], conf))
-                old = ''.join(prev['pred'])
-
-                # Replace new predictions if confidence is higher
-                prev['pred'] = list(starmap(
-                    (lambda l,l_old,c,c_old: l if c > c_old else l_old), zip(preds,prev['pred'],conf,prev['conf'])))
-                
-                # Replace confidence values
-                prev['conf'] = np.maximum(prev['conf'], conf)
-
-                # Print predictions
-                new = ''.join(prev['pred'])
-                print('replaced {} with {}\n{}'.format(old, new, prev['conf']))
-                publish_to_scoring(p_space)
-        else:
-            self.best[p_space] = {
-                'conf': conf,
-                'pred': preds
-            }
-            print('recorded {} at {}'.format(self.best[p_space]['pred'], self.best[p_space]['conf']))
-            publish_to_scoring(p_space)
-        
+        for lp in plates:
+            with self.registry_lock:
+                plate_id, _ = self.registry.nearest(lp.hash)
+            if plate_id is not None:
+                # Already published, only the id the autopilot turns on is refreshed
+                self.skipped += 1
+                lid_pub.publish(Int16(int(plate_id)))
+            elif self.batcher is not None and self.gate.admit(lp.quality):
+                self.batcher.submit(lp, lambda probs, h=lp.hash, t=stamp: self.record(probs, h, t))
+
+    def known_plates(self):
+        """Hashes of committed plates and their match distance, for the detection workers"""
+        with self.registry_lock:
+            return self.registry.words(), self.registry.max_distance
+
+    def log_stats(self, event=None):
+        frames = self.pipeline.frames
+        rospy.loginfo('licence frames: {} received, {} dropped, {} skipped while idle, queue depth {}, '
+            'age {:.0f}ms (max {:.0f}ms)'.format(
+            frames.stats['received'], frames.stats['dropped'], self.pipeline.stats['skipped'], frames.depth,
+            self.pipeline.stats['age_ms'], self.pipeline.stats['max_age_ms']))
+
+    def record(self, probs, plate_hash, stamp):
+        with self.fusion_lock:
+            p_space, commits = self.fusion.update(probs, stamp)
+            self.views.setdefault(p_space, []).append(plate_hash)
+            for plate_id, letters, margins in commits:
+                self.publish(plate_id, letters, margins)
+            self.register()
+            if p_space not in self.fusion.committed:
+                print('{} pending, reading {}'.format(p_space, ''.join(self.fusion.reading(p_space))))
+
         # Publish to Licence ID publisher for turning into the center decision
         lid_pub.publish(Int16(int(p_space)))
 
         # print horizontal line
         print(HOR_LINE)
-    
+
+    def expire_plates(self, event=None):
+        """Publishes the pending plates that went out of sight without a new reading"""
+        with self.fusion_lock:
+            for plate_id, letters, margins in self.fusion.expire():
+                self.publish(plate_id, letters, margins)
+            self.register()
+
+    def register(self):
+        """Moves the views of committed plates into the registry. A view that already matches a
+        registered plate is left out, so a frame whose plate id was misread can not claim it.
+        """
+        with self.registry_lock:
+            for plate_id in [p for p in self.views if p in self.fusion.committed]:
+                for h in self.views.pop(plate_id):
+                    if self.registry.nearest(h)[1] is None:
+                        self.registry.add(h, plate_id)
+
+    def publish(self, plate_id, letters, margins):
+        pred_str = ''.join(letters)
+        print('committed {} with margins {}'.format(pred_str, np.round(margins, 1)))
+        publish_scoring(plate_id=plate_id, plate_num=pred_str[-4:])
+
 def publish_scoring(plate_id, plate_num):
     if plate_id == 0:
         return
@@ -82,15 +165,50 @@ def publish_scoring(plate_id, plate_num):
 
 if __name__ == '__main__':
     rospy.init_node('licensedriver')
-    ld = LicenceDetector()
-    locr = LicenceOCR()
+    # Built offline with python -m ldriver.licence.plate_map, without it the detection rate only
+    # drops after a stretch of frames without a plate
+    map_path = rospy.get_param('~plate_map', None)
+    ld = LicenceDetector(processes=rospy.get_param('~detect_processes', None),
+        max_frames=rospy.get_param('~max_frames', 2), margin=rospy.get_param('~fusion_margin', 8.0),
+        min_frames=rospy.get_param('~fusion_min_frames', 2), min_quality=rospy.get_param('~min_quality', 0.4),
+        quality_window=rospy.get_param('~quality_window', 8), quality_keep=rospy.get_param('~quality_keep', 3),
+        idle_stride=rospy.get_param('~idle_stride', 3), plate_map=PlateMap.load(map_path) if map_path else None,
+        background_stride=rospy.get_param('~background_stride', 10), max_unseen=rospy.get_param('~fusion_max_unseen', 10),
+        max_age=rospy.get_param('~fusion_max_age', 3.0))
     bridge = CvBridge()
     scoring_pub = rospy.Publisher('/license_plate', String, queue_size=1)
     lid_pub = rospy.Publisher('/license_id', Int16, queue_size=1)
+    # Latched so nodes that start waiting after the OCR is ready still see it
+    ready_pub = rospy.Publisher('/licence_ready', Bool, queue_size=1, latch=True)
+    loader = threading.Thread(target=ld.load_ocr, args=(ready_pub,), name='licence-ocr-loader')
+    loader.daemon = True
+    loader.start()
     rospy.sleep(1)
     # scoring_pub.publish(str('{},{},0,XR58').format(
     #     TEAM_NAME,
     #     TEAM_PWD
     # ))
-    rospy.Subscriber("/R1/pi_camera/image_raw", Image, ld.process_image)
+    def shutdown():
+        ld.pipeline.close()
+        ld.log_stats()
+        rospy.loginfo('licence cascade: {}'.format(LicencePlate.cascade_stats))
+        if ld.plate_map is not None:
+            rospy.loginfo('licence plate map: {} plates, {}'.format(len(ld.plate_map), ld.plate_map.stats))
+        if ld.batcher is not None:
+            ld.batcher.close()
+            rospy.loginfo('licence batches: {}'.format(ld.batcher.stats))
+            with ld.fusion_lock:
+                for plate_id, letters, margins in ld.fusion.flush():
+                    ld.publish(plate_id, letters, margins)
+            rospy.loginfo('licence quality gate: {}'.format(ld.gate.stats))
+            rospy.loginfo('licence fusion: {}'.format(ld.fusion.stats))
+            rospy.loginfo('licence registry: {} views of {} committed plates, {} readings skipped'.format(
+                len(ld.registry), len(ld.fusion.committed), ld.skipped))
+    rospy.on_shutdown(shutdown)
+    rospy.Timer(rospy.Duration(10), ld.log_stats)
+    rospy.Timer(rospy.Duration(0.5), ld.expire_plates)
+    # Only the newest camera message is buffered, the buffer must hold a whole image for that
+    rospy.Subscriber("/R1/pi_camera/image_raw", Image, ld.process_image, queue_size=1, buff_size=2**24)
+    if ld.plate_map is not None:
+        rospy.Subscriber("/R1/odom", Odometry, ld.process_odom, queue_size=1)
     rospy.spin()
\ No newline at end of file
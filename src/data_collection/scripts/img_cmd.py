@@ -10,6 +10,7 @@ from cv_bridge import CvBridge
 from pathlib2 import Path
 import os
 import cv2
+from ldriver.licence.plate_map import track_pose
 
 class ImgCmdCollector:
     data_dir = Path('img_cmd_data')
@@ -40,14 +41,15 @@ class ImgCmdCollector:
         img_f = str(self.data_dir/'{}.png'.format(self.cur_img_id))
         print('saving {}'.format(img_f))
         cv2.imwrite('./'+img_f, cv_image)
-        pose = odom.pose.pose
+        x, y, yaw = track_pose(odom.pose.pose)
         twist = odom.twist.twist
         self.commands[self.cur_img_id] = {
             'linear': cmd.linear.x,
             'angular': cmd.angular.z,
             'state': {
-                'x': -pose.position.y,
-                'y': pose.position.x,
+                'x': x,
+                'y': y,
+                'yaw': yaw,
                 'linear': twist.linear.x,
                 'angular': twist.angular.z
             }
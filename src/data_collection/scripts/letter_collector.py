@@ -1,6 +1,7 @@
 #!/usr/bin/env python2
 import json
 from ldriver.licence.detection import LicencePlate
+from ldriver.licence.identity import PlateIndex
 from ldriver.licence.ocr import LicenceOCR
 import cv2
 from cv_bridge import CvBridge
@@ -23,25 +24,38 @@ class ImgCollector:
             l = 0
         self.cur_img_id = int(l)+1
         print('started collecting images at index {}'.format(self.cur_img_id))
-        self.prev = None
-        self.best_of_group = None
+        # Every plate seen this run, so a plate that comes back into view joins its old group
+        self.index = PlateIndex(LicencePlate._compare_bits)
+        self.group = None
+        self.best_of_group = {}
+        self.saved = set()
 
     def proccess_image(self, data):
         cv_img = bridge.imgmsg_to_cv2(data, desired_encoding='bgr8')
         lp = LicencePlate(cv_img)
         if lp.valid:
-            if not self.prev:
-                self.prev = lp
-            if lp == self.prev:
-                self.best_of_group = lp if lp.blur > self.prev.blur else self.prev
-            else:
-                letters = LicenceOCR.process_letters(self.best_of_group.letters)
-                for l in letters[1:]:
-                    img_f = str(self.data_dir/'{}.png'.format(self.cur_img_id))
-                    cv2.imwrite('./'+img_f, l)
-                    self.cur_img_id += 1
-                    print('saved {}'.format(img_f))
-            self.prev = lp
+            group, _ = self.index.group(lp.hash)
+            if group != self.group and self.group is not None:
+                self.save(self.group)
+            self.group = group
+            best = self.best_of_group.get(group)
+            if best is None or lp.blur > best.blur:
+                # Only the licence sized fields of retained plates are kept alive
+                lp.detach()
+                self.best_of_group[group] = lp
+
+    def save(self, group):
+        """Saves the letters of the sharpest view of a plate once its group ends, unless that
+        plate was already saved"""
+        if group in self.saved:
+            return
+        self.saved.add(group)
+        letters = LicenceOCR.process_letters(self.best_of_group[group].letters)
+        for l in letters[1:]:
+            img_f = str(self.data_dir/'{}.png'.format(self.cur_img_id))
+            cv2.imwrite('./'+img_f, l)
+            self.cur_img_id += 1
+            print('saved {}'.format(img_f))
 
 
 if __name__ == '__main__':